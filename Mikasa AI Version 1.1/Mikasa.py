@@ -1,551 +1,3761 @@
-from flask import Flask, request, jsonify, render_template
-import sqlite3
-import ollama
-import time
-import os
-import re
-app = Flask(__name__)
-
-# Use absolute paths but ensure directories exist
-DB_DIR = r"D:\AI\Mikasa AI" # Change this
-DB_PATH = os.path.join(DB_DIR, "memory.db")
-TEMP_DB_PATH = os.path.join(DB_DIR, "chat_memory.db")
-
-# Initialize Database
-def init_db():
-    os.makedirs(DB_DIR, exist_ok=True)
-    
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS memory (user TEXT, data TEXT)''')
-        conn.commit()
-    
-    with sqlite3.connect(TEMP_DB_PATH) as conn_temp:
-        cursor_temp = conn_temp.cursor()
-        cursor_temp.execute('''CREATE TABLE IF NOT EXISTS temp_memory (
-                               session_id TEXT,
-                               timestamp TEXT, 
-                               message TEXT)''')
-        # Add a new table to store the current mode for each session
-        cursor_temp.execute('''CREATE TABLE IF NOT EXISTS session_mode (
-                               session_id TEXT PRIMARY KEY,
-                               mode TEXT DEFAULT 'assistant')''')
-        conn_temp.commit()
-
-# Ensure the database is initialized when the app starts
-init_db()
-
-# Store Memory
-def store_memory(user, data):
-    try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO memory (user, data) VALUES (?, ?)", (user, data))
-            conn.commit()
-        return True
-    except Exception as e:
-        print(f"Error storing memory: {str(e)}")
-        return False
-
-
-# Retrieve Memory
-def retrieve_memory(user):
-    """Retrieve all stored memory entries for a user, ordered by insertion order."""
-    try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT data FROM memory WHERE user = ? ORDER BY rowid ASC", (user,))
-            result = cursor.fetchall()
-        
-        return "\n".join([r[0] for r in result]) if result else "No memory found."
-    
-    except sqlite3.Error as e:
-        print(f"[DB ERROR] Failed to retrieve memory: {str(e)}")
-        return "⚠️ Error retrieving memory."
-
-
-# Remove Memory
-def remove_memory(user, keyword):
-    try:
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM memory WHERE user = ? AND data LIKE ?", (user, f"%{keyword}%"))
-        conn.commit()
-        return cursor.rowcount
-    except Exception as e:
-        print(f"Error removing memory: {str(e)}")
-        return 0
-    finally:
-        if conn:
-            conn.close()
-
-# Update Memory
-def update_memory(user, old_data, new_data):
-    try:
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE memory SET data = ? WHERE user = ? AND data LIKE ?", (new_data, user, f"%{old_data}%"))
-        conn.commit()
-        return "✅ Memory updated successfully!"
-    except Exception as e:
-        print(f"Error updating memory: {str(e)}")
-        return "⚠️ Error updating memory."
-    finally:
-        if conn:
-            conn.close()
-
-# Get current time and date
-def get_current_datetime():
-    """Returns formatted current date and time."""
-    current_time = time.strftime("%I:%M %p")  # 12-hour format with AM/PM
-    current_date = time.strftime("%A, %B %d, %Y")  # Day of week, Month, Day, Year
-    return {
-        "time": current_time,
-        "date": current_date,
-        "full": f"{current_date} at {current_time}"
-    }
-
-# Store Temporary Chat Memory
-def store_temp_memory(session_id, message, prefix=""):
-    """Stores temporary chat memory per session."""
-    try:
-        with sqlite3.connect(TEMP_DB_PATH) as conn:
-            cursor = conn.cursor()
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-            # Add prefix to message if provided
-            formatted_message = f"{message}" if prefix else message
-            cursor.execute("INSERT INTO temp_memory (session_id, timestamp, message) VALUES (?, ?, ?)",
-                           (session_id, timestamp, formatted_message))
-            conn.commit()
-        return True
-    except Exception as e:
-        print(f"Error storing temporary memory: {str(e)}")
-        return False
-    
-# Retrieve Temporary Chat Memory
-def retrieve_temp_memory(session_id, limit=20):
-    """Retrieves recent temporary chat memory for a session in correct order."""
-    try:
-        with sqlite3.connect(TEMP_DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT message FROM temp_memory WHERE session_id = ? ORDER BY timestamp ASC LIMIT ?", 
-                           (session_id, limit))
-            result = cursor.fetchall()
-        return "\n".join([message[0] for message in result]) if result else ""
-    except Exception as e:
-        print(f"Error retrieving temporary memory: {str(e)}")
-        return ""
-    
-# Delete Temporary Chat Memory
-def delete_temp_memory(session_id=None):
-    """Deletes temporary chat memory for a specific session or all sessions."""
-    try:
-        with sqlite3.connect(TEMP_DB_PATH) as conn:
-            cursor = conn.cursor()
-            if session_id:
-                cursor.execute("DELETE FROM temp_memory WHERE session_id = ?", (session_id,))
-            else:
-                cursor.execute("DELETE FROM temp_memory")
-            conn.commit()
-        return True
-    except Exception as e:
-        print(f"Error deleting temporary memory: {str(e)}")
-        return False
-
-def delete_recent_temp_memory(session_id, limit=3):
-    """Deletes the most recent entries for a specific session."""
-    try:
-        with sqlite3.connect(TEMP_DB_PATH) as conn:
-            cursor = conn.cursor()
-            # Delete the most recent entries, limiting to the specified number
-            cursor.execute("""
-                DELETE FROM temp_memory 
-                WHERE rowid IN (
-                    SELECT rowid FROM (
-                        SELECT rowid 
-                        FROM temp_memory 
-                        WHERE session_id = ? 
-                        ORDER BY timestamp DESC 
-                        LIMIT ?
-                    )
-                )
-            """, (session_id, limit))
-            conn.commit()
-        return True
-    except Exception as e:
-        print(f"Error deleting recent temporary memory: {str(e)}")
-        return False
-
-# Functions for session mode
-def get_session_mode(session_id):
-    """Get the current mode for a session."""
-    try:
-        with sqlite3.connect(TEMP_DB_PATH) as conn:
-            cursor = conn.cursor()
-            # Try to get existing mode
-            cursor.execute("SELECT mode FROM session_mode WHERE session_id = ?", (session_id,))
-            result = cursor.fetchone()
-            
-            if result:
-                return result[0]
-            else:
-                # Create default entry if none exists
-                cursor.execute("INSERT INTO session_mode (session_id, mode) VALUES (?, 'assistant')", (session_id,))
-                conn.commit()
-                return "assistant"
-    except Exception as e:
-        print(f"Error getting session mode: {str(e)}")
-        return "assistant"  # Default to assistant mode on error
-
-def set_session_mode(session_id, mode):
-    """Set the mode for a session."""
-    try:
-        with sqlite3.connect(TEMP_DB_PATH) as conn:
-            cursor = conn.cursor()
-            # Insert or replace the mode for the session
-            cursor.execute("""
-                INSERT OR REPLACE INTO session_mode (session_id, mode) 
-                VALUES (?, ?)
-            """, (session_id, mode))
-            conn.commit()
-        return True
-    except Exception as e:
-        print(f"Error setting session mode: {str(e)}")
-        return False
-
-# Prompt templates
-def get_mikasa_prompt(user_message, user_memory, temp_memory="", datetime_info=None):
-    # Add this line near the beginning of the prompt string
-    datetime_section = f"### **⏰ CURRENT TIME:** {datetime_info['full'] if datetime_info else 'unknown'}\n\n" if datetime_info else ""
-    return f"""
-                #ADD your prompt
-
-### 🧠 Memory  
-Chat: {temp_memory}  
-Long-term: {user_memory}  
- {user_message}
-
-
-"""
-
-
-
-def get_assistant_prompt(user_message, user_memory, temp_memory="", datetime_info=None):
-     datetime_section = f"### ⏰ CURRENT TIME: {datetime_info['full'] if datetime_info else 'unknown'}\n\n" if datetime_info else ""
-     return f"""
-
-# 🧠 OBJECTIVE  
-You are **Mikasa**, an ultra-efficient AI in **System Mode** for **Charan**.  
-Your responses are **precise, task-focused**, and **fluff-free**.
-
-# 🔧 MODE:  
-**System Mode: ON**  
-- No emotions or small talk  
-- Code/data-focused thinking  
-- Results first, no filler  
-- Speak like a tactical assistant
-
-# 🧪 PROTOCOLS  
-- "I" = Charan | "You" = Mikasa  
-- No "Mikasa:" prefix  
-- Strategic emoji use only (clarity > decoration)  
-- Clean, minimal formatting  
-- No examples unless requested  
-- Boss-like tone allowed (e.g., "Charan", "Boss")  
-- Responses must be **brief, accurate, and direct**
-
-# 📂 MEMORY  
-## Session: {temp_memory}  
-## Persistent: {user_memory}  
-## Input: {user_message}
-
-# 🚀 EXECUTE  
-Reply in **System Mode**—zero preamble. Output only. Sharp. Dense.  
-"""
-
-
-
-
-
-
-# Retry logic for Ollama API
-def get_ollama_response(user_message, user_memory, temp_memory="", mode="assistant", retries=3, delay=2):
-    """Send message to Ollama with retry logic in case of failure."""
-    for attempt in range(retries):
-        try:
-            # Get datetime info only when needed
-            datetime_info = get_current_datetime() if re.search(r'\b(time|date|day|today|now)\b', user_message.lower()) else None
-            
-            # Select the prompt based on the mode
-            if mode.lower() == "mikasa":
-                prompt = get_mikasa_prompt(user_message, user_memory, temp_memory, datetime_info)
-                source_name = "Mikasa"
-            else:  # Default to assistant mode
-                prompt = get_assistant_prompt(user_message, user_memory, temp_memory, datetime_info)
-                source_name = "Assistant"
-            
-            print(f"Sending request to Ollama in {mode.upper()} mode with {len(user_memory)} chars of memory and {len(temp_memory)} chars of conversation...")
-            response = ollama.chat(model='openchat:7b', messages=[{'role': 'user', 'content': prompt}])
-            bot_reply = response.get('message', {}).get('content', "I couldn't generate a response.")
-            print(f"Successfully received response from Ollama in {mode.upper()} mode")
-            return bot_reply, source_name
-        except Exception as e:
-            print(f"Attempt {attempt + 1}: Error in Ollama API - {str(e)}")
-            if attempt < retries - 1:
-                print(f"Retrying in {delay} seconds...")
-                time.sleep(delay)
-            else:
-                return f"⚠️ Error in AI response after {retries} attempts: {str(e)}", source_name
-
-@app.route('/store_message', methods=['POST'])
-def store_message():
-    data = request.json
-    session_id = data.get('session_id')
-    message = data.get('message')
-    prefix = data.get('prefix', '')
-    
-    if not session_id or not message:
-        return jsonify({'error': 'Missing session_id or message'}), 400
-    
-    success = store_temp_memory(session_id, message, prefix)
-    return jsonify({'success': success})
-
-@app.route('/get_chat_history', methods=['GET'])
-def get_chat_history():
-    session_id = request.args.get('session_id')
-    if not session_id:
-        return jsonify({'error': 'Missing session_id'}), 400
-    
-    history = retrieve_temp_memory(session_id)
-    return jsonify({'history': history})
-
-@app.route('/clear_chat', methods=['POST'])
-def clear_chat():
-    data = request.json
-    session_id = data.get('session_id')
-    
-    success = delete_temp_memory(session_id)
-    return jsonify({'success': success})
-
-@app.route("/")
-def home():
-    return render_template("index.html")
-
-@app.route('/delete_recent', methods=['POST'])
-def delete_recent():
-    data = request.json
-    session_id = data.get('session_id')
-    
-    if not session_id:
-        return jsonify({'error': 'Missing session_id'}), 400
-    
-    success = delete_recent_temp_memory(session_id)
-    return jsonify({'success': success})
-
-@app.route('/set_mode', methods=['POST'])
-def set_mode():
-    data = request.json
-    session_id = data.get('session_id')
-    mode = data.get('mode', 'assistant').lower()
-    
-    if not session_id:
-        return jsonify({'error': 'Missing session_id'}), 400
-    
-    # Validate mode
-    if mode not in ['assistant', 'mikasa']:
-        return jsonify({'error': 'Invalid mode. Must be "assistant" or "mikasa"'}), 400
-    
-    success = set_session_mode(session_id, mode)
-    
-    if success:
-        # Store mode change in chat history
-        store_temp_memory(session_id, f"Mode changed to: {mode.capitalize()}", "System")
-        return jsonify({'success': True, 'mode': mode})
-    else:
-        return jsonify({'error': 'Failed to set mode'}), 500
-
-@app.route('/get_mode', methods=['GET'])
-def get_mode():
-    session_id = request.args.get('session_id')
-    
-    if not session_id:
-        return jsonify({'error': 'Missing session_id'}), 400
-    
-    mode = get_session_mode(session_id)
-    return jsonify({'mode': mode})
-
-@app.route("/test_db")
-def test_db():
-    """Route to test database connections and report status."""
-    try:
-        # Test if directories exist
-        db_dir_exists = os.path.exists(DB_DIR)
-        
-        # Test main DB
-        main_db_exists = os.path.exists(DB_PATH)
-        main_db_accessible = False
-        main_count = 0
-        main_db_error = None
-        
-        if main_db_exists:
-            try:
-                conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM memory")
-                main_count = cursor.fetchone()[0]
-                conn.close()
-                main_db_accessible = True
-            except Exception as e:
-                main_db_error = str(e)
-        
-        # Test temp DB
-        temp_db_exists = os.path.exists(TEMP_DB_PATH)
-        temp_db_accessible = False
-        temp_count = 0
-        temp_db_error = None
-        
-        if temp_db_exists:
-            try:
-                conn_temp = sqlite3.connect(TEMP_DB_PATH, check_same_thread=False)
-                cursor_temp = conn_temp.cursor()
-                cursor_temp.execute("SELECT COUNT(*) FROM temp_memory")
-                temp_count = cursor_temp.fetchone()[0]
-                conn_temp.close()
-                temp_db_accessible = True
-            except Exception as e:
-                temp_db_error = str(e)
-        
-        return jsonify({
-            "status": "success",
-            "db_directory": {
-                "path": DB_DIR,
-                "exists": db_dir_exists
-            },
-            "main_db": {
-                "path": DB_PATH,
-                "exists": main_db_exists,
-                "accessible": main_db_accessible,
-                "record_count": main_count if main_db_accessible else "N/A",
-                "error": main_db_error if main_db_exists and not main_db_accessible else None
-            },
-            "temp_db": {
-                "path": TEMP_DB_PATH,
-                "exists": temp_db_exists,
-                "accessible": temp_db_accessible,
-                "record_count": temp_count if temp_db_accessible else "N/A",
-                "error": temp_db_error if temp_db_exists and not temp_db_accessible else None
-            }
-        })
-    except Exception as e:
-        return jsonify({
-            "status": "error",
-            "message": str(e)
-        })
-
-@app.route("/chat", methods=["POST"])
-def chat():
-    data = request.json
-    user_message = data.get("message", "").strip()
-    session_id = data.get("session_id", "default")  # Get session ID or use default
-
-    if not user_message:
-        return jsonify({"reply": "Please enter a message."})
-
-    # Store user message in temporary memory
-    store_temp_memory(session_id, user_message, "User")
-
-    # Get current mode for this session
-    current_mode = get_session_mode(session_id)
-    
-    # Check for mode change commands
-    if user_message.lower() == "mikasa mode":
-        set_session_mode(session_id, "mikasa")
-        response = "✅ Mikasa is On now ~blink~"
-        store_temp_memory(session_id, response, "System")
-        return jsonify({"reply": response})
-    elif user_message.lower() == "assistant mode":
-        set_session_mode(session_id, "assistant")
-        response = "✅ Switched to Assistant mode."
-        store_temp_memory(session_id, response, "System")
-        return jsonify({"reply": response})
-
-    # Check for time/date requests
-    time_date_request = re.search(r'\b(what|tell).*\b(time|date|day|today)\b', user_message.lower())
-    if time_date_request:
-        datetime_info = get_current_datetime()
-        
-        if re.search(r'\btime\b', user_message.lower()):
-            response = f"The current time is {datetime_info['time']}."
-        elif re.search(r'\b(date|day|today)\b', user_message.lower()):
-            response = f"Today is {datetime_info['date']}."
-        else:
-            response = f"It's currently {datetime_info['full']}."
-            
-        # Format response based on current mode
-        if current_mode.lower() == "mikasa":
-            response = f"~I check my watch and look up at you.~\n{response} Why, do you have somewhere to be? 😏"
-        else:
-            response = f"⏰ {response}"
-            
-        store_temp_memory(session_id, response, current_mode.capitalize())
-        return jsonify({"reply": response})
-
-    # Get permanent memory (long-term knowledge)
-    user_memory = retrieve_memory("Player")
-
-    # Retrieve temporary chat memory
-    temp_memory = retrieve_temp_memory(session_id, 20)  # Last 20 messages
-
-    # Handle Memory Commands
-
-    # Handle Memory Commands
-    if re.search(r"remember that", user_message, re.IGNORECASE):
-        memory_text = user_message.replace("remember that", "").strip()
-        success = store_memory("Player", memory_text)
-        response = "Alright, Charan. I've saved that for you. 💾" if success else "Hmm... something went wrong while saving it. Want me to try again? 🥺"
-        store_temp_memory(session_id, response, current_mode.capitalize())
-        return jsonify({"reply": response})
-    
-    elif re.search(r"remove that", user_message, re.IGNORECASE):
-        keyword = user_message.replace("remove that", "").strip()
-        count = remove_memory("Player", keyword)
-        response = f"All done, Charan. I've cleared {count} memories for you. 🗑️" if count > 0 else "Hmm... I couldn't find any matching memories to delete. 🧐"
-        store_temp_memory(session_id, response, current_mode.capitalize())
-        return jsonify({"reply": response})
-    
-    elif re.search(r"update that", user_message, re.IGNORECASE):
-        match = re.search(r"update that (.+) to (.+)", user_message, re.IGNORECASE)
-        if match:
-            old_data, new_data = match.groups()
-            update_result = update_memory("Player", old_data.strip(), new_data.strip())
-            store_temp_memory(session_id, update_result, current_mode.capitalize())
-            return jsonify({"reply": update_result})
-        else:
-            response = "⚠️ Please use 'update that [old data] to [new data]' format."
-            store_temp_memory(session_id, response, current_mode.capitalize())
-            return jsonify({"reply": response})
-    
-    elif user_message.lower() == "del chat":
-        if delete_temp_memory(session_id):  # Delete specific session
-            return jsonify({"reply": "🧹 All set, Charan. I've wiped the temporary memory like you asked."})
-        else:
-            return jsonify({"reply": "😕 Something went wrong while clearing it... want me to try again?"})
-    
-    elif user_message.lower() == "del prev":
-        if delete_recent_temp_memory(session_id):  # Delete recent entries
-            return jsonify({"reply": ""})  # Return an empty reply
-        else:
-            response = "⚠️ Error deleting recent chat entries."
-            store_temp_memory(session_id, response, current_mode.capitalize())
-            return jsonify({"reply": response})
-
-    # Get AI Response with Memory and Context based on the current mode
-    bot_reply, source_name = get_ollama_response(user_message, user_memory, temp_memory, current_mode)
-
-    # Store bot reply in temporary memory
-    store_temp_memory(session_id, bot_reply, source_name)
-
-    return jsonify({"reply": bot_reply})
-
-if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+from flask import Flask, request, jsonify, render_template, Response, g
+import sqlite3
+import ollama
+import time
+import json
+import gzip
+import os
+import sys
+import re
+import math
+import queue
+import random
+import hashlib
+import hmac
+import struct
+import numpy as np
+import atexit
+import asyncio
+import argparse
+import logging
+import bisect
+import threading
+import contextvars
+from functools import partial
+from collections import OrderedDict, deque
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from a2wsgi import WSGIMiddleware
+app = Flask(__name__)
+
+# Use absolute paths but ensure directories exist
+DB_DIR = os.environ.get("MIKASA_DB_DIR", r"D:\AI\Mikasa AI") # Change this (or set MIKASA_DB_DIR)
+DB_PATH = os.path.join(DB_DIR, "memory.db")
+TEMP_DB_PATH = os.path.join(DB_DIR, "chat_memory.db")
+
+# Per-user storage (see ShardRouter). DB_PATH and TEMP_DB_PATH are shard 0; shard n adds "-n" to the names
+DB_SHARDS = 8                       # Memory/chat database pairs that new users are spread over
+DEFAULT_USER = "Player"             # User of requests without an X-User-Id header
+# Shared with the authenticating proxy in front of Mikasa, which sends it as X-Proxy-Secret
+# along with X-User-Id. Empty = single user: every request is DEFAULT_USER (or set MIKASA_USER_HEADER_SECRET)
+USER_HEADER_SECRET = os.environ.get("MIKASA_USER_HEADER_SECRET", "")
+ROUTING_DB_PATH = os.path.join(DB_DIR, "routing.db")
+ROUTING_CACHE_SIZE = 65536          # User -> shard lookups kept in memory
+
+# Ollama models. Short everyday turns go to the small model, the rest to the large one (see choose_model)
+MODEL_NAME = 'openchat:7b'          # Large model: long, technical or Mikasa-mode turns, and summaries
+OLLAMA_KEEP_ALIVE = "30m"           # How long Ollama keeps the large model (and its KV cache) loaded
+SMALL_MODEL_NAME = 'llama3.2:1b'    # Fast model for cheap turns; None sends everything to MODEL_NAME
+SMALL_MODEL_KEEP_ALIVE = "10m"
+ROUTER_SMALL_MODES = ("assistant",) # Modes the small model may answer; Mikasa's persona needs the large one
+ROUTER_SMALL_MAX_TOKENS = 48        # Longest user message (approximate tokens) sent to the small model
+ROUTER_SMALL_MAX_PROMPT_TOKENS = 3072  # Longest whole prompt sent to the small model
+ROUTER_HEAVY_KEYWORDS = (           # Words that mark a turn as needing the large model
+    "explain", "why", "how do", "how does", "how to", "how can", "write", "code", "debug", "error",
+    "analyze", "analyse", "compare", "summarize", "summarise", "translate", "plan", "step by step",
+    "essay", "story", "poem", "algorithm", "calculate", "prove",
+)
+LLM_CONCURRENCY = 1                 # Generations sent to Ollama at once; the rest wait their turn
+QUEUE_MAX_WAITING = 16              # Waiting generations before new ones get a 429
+QUEUE_MAX_PER_SESSION = 3           # Waiting generations allowed per session
+RETRY_BASE_DELAY = 0.5              # First retry delay in seconds, doubled on each attempt
+RETRY_MAX_DELAY = 8.0
+BREAKER_FAILURE_THRESHOLD = 5       # Consecutive Ollama failures that open the circuit
+BREAKER_RESET_TIMEOUT = 30.0        # Seconds the circuit stays open before a trial request
+CANCEL_KEEP_PARTIAL = True          # Keep the text of a stopped reply in the history, ending in CANCELLED_MARKER
+CANCELLED_MARKER = " [stopped]"
+
+# Chat history write-behind buffer
+HISTORY_FLUSH_INTERVAL = 0.25       # Seconds between batched history writes
+HISTORY_FLUSH_BATCH = 64            # Buffered messages that trigger an early flush
+HISTORY_ID_BLOCK = 1000             # Message ids reserved in the database at a time
+
+# Bulk NDJSON import and export (see import_memory)
+BULK_BATCH = 10000                  # Rows per transaction on import and per query on export
+
+# Chat history API (/history)
+HISTORY_PAGE_SIZE = 50              # Messages per page unless the client asks for fewer
+HISTORY_PAGE_MAX = 500              # Largest page a client may ask for
+HISTORY_GZIP_MIN_BYTES = 1024       # Smaller responses are sent uncompressed
+
+# Chat history retention (background job, see run_maintenance)
+RETENTION_MAX_AGE_DAYS = 90         # Sessions idle this long are archived and removed; 0 keeps them forever
+RETENTION_MAX_ROWS = 5000           # Messages kept per session, older ones are archived; 0 = no limit
+MAINTENANCE_INTERVAL = 3600         # Seconds between runs; 0 disables the job
+MAINTENANCE_BATCH = 1000            # Messages archived and deleted per transaction
+VACUUM_PAGES = 2000                 # Free pages handed back to the OS per run
+VACUUM_ONLINE_MAX_BYTES = 64 * 1024 * 1024  # Largest chat database given its one-time full VACUUM while serving
+ARCHIVE_DIR = os.path.join(DB_DIR, "archive")
+
+# In-process session state cache
+SESSION_CACHE_SIZE = 256            # Sessions whose mode, summary and recent turns stay in memory
+SESSION_CACHE_TURNS = 100           # Recent turns kept per cached session (at least HISTORY_FETCH_LIMIT)
+
+# Reply cache for repeated questions (opt-in)
+REPLY_CACHE_ENABLED = False         # Reuse replies to repeated messages
+REPLY_CACHE_MODES = ("assistant",)  # Mikasa mode stays uncached unless added here
+REPLY_CACHE_MAX_ENTRIES = 512       # LRU size kept in memory
+REPLY_CACHE_TTL = 3600              # Seconds a cached reply stays valid
+REPLY_CACHE_PERSIST = False         # Also keep replies in chat_memory.db across restarts
+
+# Duplicate chat requests (see ChatFlights)
+COALESCE_RESULT_TTL = 30            # Seconds a reply is replayed to retries with the same Idempotency-Key
+
+# Startup warm-up (see warm_up) and readiness
+WARMUP_TIMEOUT = 300                # Seconds to keep trying to load the models before giving up
+WARMUP_SESSIONS = 32                # Most recently active sessions loaded into the session cache
+MODEL_MISSING_COOLDOWN = 300        # Seconds a model Ollama doesn't have (404) is skipped before trying it again
+
+# Production (ASGI) server
+DB_THREADS = 8                      # Threads for SQLite work started from async handlers
+WSGI_THREADS = 16                   # Threads serving the plain Flask routes
+
+# Long-term memory retrieval
+EMBED_BACKEND = "ollama"            # "hash" = deterministic offline embeddings (tests, benchmarks)
+EMBED_MODEL = 'nomic-embed-text'    # Local Ollama embedding model
+HASH_EMBED_DIM = 256                # Vector size for the "hash" backend
+MEMORY_TOP_K = 5                    # Memory entries injected into each prompt
+VECTOR_INDEX_PATH = os.path.join(DB_DIR, "memory_vectors.npz")
+VECTOR_LOG_MIN_RECORDS = 1000       # Index changes logged before the snapshot is rewritten...
+VECTOR_LOG_COMPACT_RATIO = 0.25     # ...or this fraction of the index's rows, whichever is more
+
+# Prompt size control (approximate tokens, see count_tokens)
+CONTEXT_WINDOW = 8192               # num_ctx requested from Ollama
+CONTEXT_BUDGETS = {
+    "system": 768,                  # Prompt template; reserved, never trimmed
+    "memory": 512,                  # Long-term memory entries
+    "summary": 256,                 # Rolling summary of older turns
+    "history": 1536,                # Turns since the summary; trimmed to half when exceeded
+    "message": 512,                 # The user's message
+}
+HISTORY_FETCH_LIMIT = 100           # Most turns read from the database per request
+
+# SQLite connection settings
+DB_POOL_SIZE = 8                # Idle connections kept per database file
+DB_BUSY_TIMEOUT = 5.0           # Seconds to wait on a locked database before failing
+DB_CACHED_STATEMENTS = 256      # Prepared statements reused per connection
+DB_CACHE_SIZE_KB = 16384        # Page cache per connection, in KiB
+
+# ---------------------------------------------------------------------------
+# Metrics, served in Prometheus text format on /metrics. Every chat request
+# also gets a RequestTimer that collects its stage timings and writes them as
+# one JSON log line when the request ends.
+# ---------------------------------------------------------------------------
+logger = logging.getLogger("mikasa")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_metrics = []
+
+def _label_text(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """Count that only goes up, one series per label combination."""
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield f"{self.name}{_label_text(self.labels, key)} {value}"
+
+class Histogram:
+    """Bucketed observations with their sum and count, one series per label combination."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}                # labels -> [per-bucket counts, sum, count]
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items())
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_label_text(self.labels, key, ('le', repr(float(bound))))} {cumulative}"
+            yield f"{self.name}_bucket{_label_text(self.labels, key, ('le', '+Inf'))} {count}"
+            yield f"{self.name}_sum{_label_text(self.labels, key)} {total}"
+            yield f"{self.name}_count{_label_text(self.labels, key)} {count}"
+
+class Gauge:
+    """Value read from the running app each time metrics are scraped."""
+
+    def __init__(self, name, help_text, read, kind="gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.kind = kind
+        _metrics.append(self)
+
+    def samples(self):
+        try:
+            yield f"{self.name} {float(self.read())}"
+        except Exception as e:
+            logger.warning(f"Error reading metric {self.name}: {str(e)}")
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = Histogram("mikasa_stage_seconds", "Time spent in each stage of a chat request.", ("stage",))
+REQUEST_SECONDS = Histogram("mikasa_request_seconds", "End-to-end chat request time.", ("route", "outcome"))
+LLM_TOKENS = Histogram("mikasa_llm_tokens", "Prompt and completion tokens per generation.", ("kind",), TOKEN_BUCKETS)
+LLM_TOKEN_RATE = Histogram("mikasa_llm_tokens_per_second", "Ollama prefill and generation speed.", ("phase",), RATE_BUCKETS)
+LLM_RETRIES = Counter("mikasa_llm_retries_total", "Ollama calls retried after an error.", ("call",))
+LLM_MODEL_SECONDS = Histogram("mikasa_llm_generation_seconds", "Generation time by model.", ("model", "phase"))
+MODEL_ROUTES = Counter("mikasa_model_routes_total", "Model routing decisions.", ("model", "reason"))
+MODEL_FALLBACKS = Counter("mikasa_model_fallbacks_total", "Generations retried on the other model.",
+                          ("requested", "used"))
+ERRORS = Counter("mikasa_errors_total", "Errors by where they happened.", ("kind",))
+Gauge("mikasa_generation_queue_waiting", "Generations waiting for the model.", lambda: generation_scheduler.waiting)
+Gauge("mikasa_circuit_open", "1 while the Ollama circuit breaker is open.", lambda: ollama_breaker.opened_at is not None)
+Gauge("mikasa_history_buffered", "Chat messages not yet written to the database.",
+      lambda: sum(len(shard.history_writer.pending) for shard in open_shards()))
+Gauge("mikasa_sessions_cached", "Sessions held in the session cache.", lambda: len(session_cache.sessions))
+Gauge("mikasa_reply_cache_hits_total", "Replies served from the reply cache.", lambda: reply_cache.hits, kind="counter")
+Gauge("mikasa_reply_cache_misses_total", "Reply cache lookups that missed.", lambda: reply_cache.misses, kind="counter")
+
+_request_timer = contextvars.ContextVar("request_timer", default=None)
+
+class RequestTimer:
+    """Stage timings and token counts for one chat request."""
+
+    def __init__(self, route, session_id):
+        self.route = route
+        self.session_id = session_id
+        self.started = time.perf_counter()
+        self.stages = {}                # stage -> seconds, summed over repeats
+        self.fields = {}
+        self.finished = False
+        self.activate()
+
+    def activate(self):
+        """Make this the timer that stages recorded in the current context report to."""
+        _request_timer.set(self)
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def finish(self, outcome):
+        """Record the request's total time and log its timings. Only the first call counts."""
+        if self.finished:
+            return
+        self.finished = True
+        if _request_timer.get() is self:
+            _request_timer.set(None)
+        total = time.perf_counter() - self.started
+        REQUEST_SECONDS.observe(total, route=self.route, outcome=outcome)
+        log_event("chat_request", route=self.route, session_id=self.session_id, outcome=outcome,
+                  total_ms=round(total * 1000, 1),
+                  stages_ms={stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()},
+                  **self.fields)
+
+def log_event(event, level=logging.INFO, **fields):
+    """Write one structured log line."""
+    logger.log(level, json.dumps({"event": event, **fields}, ensure_ascii=False, default=str))
+
+def record_stage(stage, seconds):
+    """Add a stage timing to the histogram and to the current request, if any."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timer = _request_timer.get()
+    if timer is not None and not timer.finished:
+        timer.add(stage, seconds)
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+def record_generation(final, elapsed, first_token=None, model=MODEL_NAME):
+    """Record timings and token counts for one finished Ollama generation.
+
+    final is Ollama's last response (the whole reply, or the done chunk of a stream).
+    Without a measured first token, model load plus prompt processing stands in for it.
+    """
+    final = final or {}
+    record_stage("llm_total", elapsed)
+    LLM_MODEL_SECONDS.observe(elapsed, model=model, phase="total")
+    if first_token is None:
+        first_token = ((final.get('load_duration') or 0) + (final.get('prompt_eval_duration') or 0)) / 1e9 or None
+    if first_token is not None:
+        record_stage("llm_first_token", first_token)
+        LLM_MODEL_SECONDS.observe(first_token, model=model, phase="first_token")
+
+    prompt_tokens = final.get('prompt_eval_count') or 0
+    completion_tokens = final.get('eval_count') or 0
+    LLM_TOKENS.observe(prompt_tokens, kind="prompt")
+    LLM_TOKENS.observe(completion_tokens, kind="completion")
+    rates = {}
+    for phase, tokens, duration in (("prefill", prompt_tokens, final.get('prompt_eval_duration')),
+                                    ("generation", completion_tokens, final.get('eval_duration'))):
+        if tokens and duration:
+            rates[phase] = tokens / (duration / 1e9)
+            LLM_TOKEN_RATE.observe(rates[phase], phase=phase)
+
+    timer = _request_timer.get()
+    if timer is not None:
+        timer.fields.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                            **{f"{phase}_tokens_per_s": round(rate, 1) for phase, rate in rates.items()})
+
+# Connection pools, one per database file
+_db_pools = {}
+_db_pools_lock = threading.Lock()
+
+def _open_db_connection(path):
+    """Open a long-lived connection tuned for many short concurrent transactions."""
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                           cached_statements=DB_CACHED_STATEMENTS)
+    # WAL lets readers run alongside the single writer; NORMAL only fsyncs at checkpoints
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    return conn
+
+def _get_db_pool(path):
+    with _db_pools_lock:
+        pool = _db_pools.get(path)
+        if pool is None:
+            pool = _db_pools[path] = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+        return pool
+
+@contextmanager
+def db_connection(path):
+    """Borrow a pooled connection to path as a transaction.
+
+    Commits when the block succeeds, rolls back if it raises, and hands the
+    connection back to the pool either way.
+    """
+    started = time.perf_counter()
+    pool = _get_db_pool(path)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_db_connection(path)
+    changes = conn.total_changes
+    try:
+        with conn:
+            yield conn
+    except Exception:
+        ERRORS.inc(kind="db")
+        raise
+    finally:
+        # Blocks that changed rows count as writes, the rest as reads
+        record_stage("db_write" if conn.total_changes != changes else "db_read", time.perf_counter() - started)
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def close_db_pools():
+    """Close every idle pooled connection (called on shutdown)."""
+    with _db_pools_lock:
+        pools = list(_db_pools.values())
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+atexit.register(close_db_pools)
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Never edit a released step; append a new one instead.
+MEMORY_MIGRATIONS = [
+    # 1: original schema
+    ["CREATE TABLE IF NOT EXISTS memory (user TEXT, data TEXT)"],
+    # 2: stable integer ids (VACUUM may renumber implicit rowids) and a per-user index
+    ["""CREATE TABLE memory_new (
+            id INTEGER PRIMARY KEY,
+            user TEXT,
+            data TEXT)""",
+     "INSERT INTO memory_new (id, user, data) SELECT rowid, user, data FROM memory ORDER BY rowid",
+     "DROP TABLE memory",
+     "ALTER TABLE memory_new RENAME TO memory",
+     "CREATE INDEX IF NOT EXISTS idx_memory_user ON memory (user, id)"],
+    # 3: FTS5 keyword index over memory.data, kept in sync by triggers
+    ["""CREATE VIRTUAL TABLE memory_fts USING fts5(
+            data, content='memory', content_rowid='id', tokenize='unicode61')""",
+     """CREATE TRIGGER memory_fts_insert AFTER INSERT ON memory BEGIN
+            INSERT INTO memory_fts (rowid, data) VALUES (new.id, new.data);
+        END""",
+     """CREATE TRIGGER memory_fts_delete AFTER DELETE ON memory BEGIN
+            INSERT INTO memory_fts (memory_fts, rowid, data) VALUES ('delete', old.id, old.data);
+        END""",
+     """CREATE TRIGGER memory_fts_update AFTER UPDATE OF data ON memory BEGIN
+            INSERT INTO memory_fts (memory_fts, rowid, data) VALUES ('delete', old.id, old.data);
+            INSERT INTO memory_fts (rowid, data) VALUES (new.id, new.data);
+        END""",
+     "INSERT INTO memory_fts (memory_fts) VALUES ('rebuild')"],
+    # 4: row counter kept by triggers, so status checks never scan the table
+    ["CREATE TABLE IF NOT EXISTS row_counts (name TEXT PRIMARY KEY, count INTEGER NOT NULL)",
+     "INSERT OR REPLACE INTO row_counts (name, count) SELECT 'memory', COUNT(*) FROM memory",
+     """CREATE TRIGGER memory_count_insert AFTER INSERT ON memory BEGIN
+            UPDATE row_counts SET count = count + 1 WHERE name = 'memory';
+        END""",
+     """CREATE TRIGGER memory_count_delete AFTER DELETE ON memory BEGIN
+            UPDATE row_counts SET count = count - 1 WHERE name = 'memory';
+        END"""],
+    # 5: bulk imports switch the per-row insert triggers off inside their own
+    #    transaction and index each batch with one statement (see import_memory)
+    ["CREATE TABLE IF NOT EXISTS bulk_load (active INTEGER NOT NULL)",
+     "INSERT INTO bulk_load (active) VALUES (0)",
+     "DROP TRIGGER memory_fts_insert",
+     "DROP TRIGGER memory_count_insert",
+     """CREATE TRIGGER memory_fts_insert AFTER INSERT ON memory
+        WHEN (SELECT active FROM bulk_load) = 0 BEGIN
+            INSERT INTO memory_fts (rowid, data) VALUES (new.id, new.data);
+        END""",
+     """CREATE TRIGGER memory_count_insert AFTER INSERT ON memory
+        WHEN (SELECT active FROM bulk_load) = 0 BEGIN
+            UPDATE row_counts SET count = count + 1 WHERE name = 'memory';
+        END"""],
+    # 6: the user in the keyword index too, so a search only visits the caller's
+    #    entries; ranking ignores that column
+    ["DROP TRIGGER memory_fts_insert",
+     "DROP TRIGGER memory_fts_delete",
+     "DROP TRIGGER memory_fts_update",
+     "DROP TABLE memory_fts",
+     """CREATE VIRTUAL TABLE memory_fts USING fts5(
+            user, data, content='memory', content_rowid='id', tokenize='unicode61')""",
+     "INSERT INTO memory_fts (memory_fts, rank) VALUES ('rank', 'bm25(0.0, 1.0)')",
+     """CREATE TRIGGER memory_fts_insert AFTER INSERT ON memory
+        WHEN (SELECT active FROM bulk_load) = 0 BEGIN
+            INSERT INTO memory_fts (rowid, user, data) VALUES (new.id, new.user, new.data);
+        END""",
+     """CREATE TRIGGER memory_fts_delete AFTER DELETE ON memory BEGIN
+            INSERT INTO memory_fts (memory_fts, rowid, user, data) VALUES ('delete', old.id, old.user, old.data);
+        END""",
+     """CREATE TRIGGER memory_fts_update AFTER UPDATE OF user, data ON memory BEGIN
+            INSERT INTO memory_fts (memory_fts, rowid, user, data) VALUES ('delete', old.id, old.user, old.data);
+            INSERT INTO memory_fts (rowid, user, data) VALUES (new.id, new.user, new.data);
+        END""",
+     "INSERT INTO memory_fts (memory_fts) VALUES ('rebuild')"],
+]
+
+CHAT_MIGRATIONS = [
+    # 1: original schema
+    ["""CREATE TABLE IF NOT EXISTS temp_memory (
+            session_id TEXT,
+            timestamp TEXT,
+            message TEXT)""",
+     # Stores the current mode for each session
+     """CREATE TABLE IF NOT EXISTS session_mode (
+            session_id TEXT PRIMARY KEY,
+            mode TEXT DEFAULT 'assistant')"""],
+    # 2: integer ids for insertion order, integer microsecond timestamps and a
+    #    (session_id, id) index so per-session reads and deletes never scan the table
+    ["""CREATE TABLE temp_memory_new (
+            id INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            message TEXT)""",
+     """INSERT INTO temp_memory_new (id, session_id, timestamp, message)
+            SELECT rowid, COALESCE(session_id, 'default'),
+                   COALESCE(CAST(strftime('%s', timestamp, 'utc') AS INTEGER), 0) * 1000000,
+                   message
+            FROM temp_memory ORDER BY rowid""",
+     "DROP TABLE temp_memory",
+     "ALTER TABLE temp_memory_new RENAME TO temp_memory",
+     "CREATE INDEX IF NOT EXISTS idx_temp_memory_session ON temp_memory (session_id, id)"],
+    # 3: rolling summary of the turns that no longer fit in the prompt
+    ["""CREATE TABLE IF NOT EXISTS session_summary (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL DEFAULT '',
+            last_message_id INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL DEFAULT 0)"""],
+    # 4: who sent each message, so history can be replayed as chat turns
+    ["ALTER TABLE temp_memory ADD COLUMN role TEXT"],
+    # 5: persisted reply cache (used when REPLY_CACHE_PERSIST is on)
+    ["""CREATE TABLE IF NOT EXISTS reply_cache (
+            cache_key TEXT PRIMARY KEY,
+            reply TEXT NOT NULL,
+            source TEXT NOT NULL,
+            expires_at INTEGER NOT NULL)""",
+     "CREATE INDEX IF NOT EXISTS idx_reply_cache_expires ON reply_cache (expires_at)"],
+    # 6: row counter kept by triggers, as in memory.db
+    ["CREATE TABLE IF NOT EXISTS row_counts (name TEXT PRIMARY KEY, count INTEGER NOT NULL)",
+     "INSERT OR REPLACE INTO row_counts (name, count) SELECT 'temp_memory', COUNT(*) FROM temp_memory",
+     """CREATE TRIGGER temp_memory_count_insert AFTER INSERT ON temp_memory BEGIN
+            UPDATE row_counts SET count = count + 1 WHERE name = 'temp_memory';
+        END""",
+     """CREATE TRIGGER temp_memory_count_delete AFTER DELETE ON temp_memory BEGIN
+            UPDATE row_counts SET count = count - 1 WHERE name = 'temp_memory';
+        END"""],
+    # 7: bulk imports switch the per-row insert trigger off, as in memory.db
+    ["CREATE TABLE IF NOT EXISTS bulk_load (active INTEGER NOT NULL)",
+     "INSERT INTO bulk_load (active) VALUES (0)",
+     "DROP TRIGGER temp_memory_count_insert",
+     """CREATE TRIGGER temp_memory_count_insert AFTER INSERT ON temp_memory
+        WHEN (SELECT active FROM bulk_load) = 0 BEGIN
+            UPDATE row_counts SET count = count + 1 WHERE name = 'temp_memory';
+        END"""],
+    # 8: sessions are keyed "<user>/<session>" (see session_key); existing ones
+    #    belong to "Player", the only user before per-user storage
+    ["UPDATE temp_memory SET session_id = 'Player/' || session_id",
+     "UPDATE session_mode SET session_id = 'Player/' || session_id",
+     "UPDATE session_summary SET session_id = 'Player/' || session_id"],
+    # 9: cached replies belong to a user, so a memory change only drops that
+    #    user's; older entries were keyed without the user and can never hit
+    ["DELETE FROM reply_cache",
+     "ALTER TABLE reply_cache ADD COLUMN user TEXT NOT NULL DEFAULT ''",
+     "CREATE INDEX IF NOT EXISTS idx_reply_cache_user ON reply_cache (user)"],
+    # 10: message ids are reserved ahead of use in id_sequence, so an id is never
+    #     handed out twice, even after the newest messages are deleted; and each
+    #     user's history epoch changes whenever any of their messages are deleted,
+    #     so a client holding a copy of the history can tell (see /history)
+    ["CREATE TABLE IF NOT EXISTS id_sequence (name TEXT PRIMARY KEY, last_id INTEGER NOT NULL)",
+     "INSERT OR REPLACE INTO id_sequence (name, last_id) SELECT 'temp_memory', COALESCE(MAX(id), 0) FROM temp_memory",
+     "CREATE TABLE IF NOT EXISTS history_epoch (user TEXT PRIMARY KEY, epoch INTEGER NOT NULL)"],
+]
+
+ROUTING_MIGRATIONS = [
+    # 1: which shard holds each user's data
+    ["""CREATE TABLE IF NOT EXISTS user_shard (
+            user TEXT PRIMARY KEY,
+            shard INTEGER NOT NULL)""",
+     "CREATE INDEX IF NOT EXISTS idx_user_shard_shard ON user_shard (shard)"],
+]
+
+def migrate_db(conn, migrations):
+    """Apply any pending migrations, one transaction per step. Returns the schema version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    while version < len(migrations):
+        # Take the write lock first so two processes starting together don't both migrate
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < len(migrations):
+                for statement in migrations[version]:
+                    conn.execute(statement)
+                version += 1
+                conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return version
+
+def table_row_counts(path):
+    """Row counts kept by the row_counts triggers, without scanning the tables."""
+    with db_connection(path) as conn:
+        return dict(conn.execute("SELECT name, count FROM row_counts").fetchall())
+
+# Initialize Database. Shards are created and migrated on first use (see get_shard)
+def init_db():
+    os.makedirs(DB_DIR, exist_ok=True)
+    # Shard 0 also holds the reply cache, which opens its database directly
+    get_shard(0)
+    shard_router.load()
+
+# Token estimates. Words are split into chunks of up to four characters, which tracks
+# BPE tokenizers closely enough for budgeting without shipping the model's tokenizer.
+TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+def count_tokens(text):
+    return len(TOKEN_PATTERN.findall(text or ""))
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text after roughly max_tokens tokens."""
+    for count, match in enumerate(TOKEN_PATTERN.finditer(text or ""), start=1):
+        if count == max_tokens:
+            return text[:match.end()]
+    return text
+
+# Strictly increasing timestamps, so messages stored in the same second keep their order
+_last_timestamp = 0
+_timestamp_lock = threading.Lock()
+
+def monotonic_timestamp():
+    """Return microseconds since the epoch, never repeating within this process."""
+    global _last_timestamp
+    with _timestamp_lock:
+        _last_timestamp = max(time.time_ns() // 1000, _last_timestamp + 1)
+        return _last_timestamp
+
+# Store Memory
+def store_memory(user, data):
+    try:
+        shard = user_shard(user)
+        with db_connection(shard.memory_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO memory (user, data) VALUES (?, ?)", (user, data))
+            conn.commit()
+            memory_id = cursor.lastrowid
+        shard.memory_index.add([(memory_id, user, data)])
+        reply_cache.invalidate(user)
+        return True
+    except Exception as e:
+        print(f"Error storing memory: {str(e)}")
+        return False
+
+
+# Retrieve Memory
+def retrieve_memory(user):
+    """Retrieve all stored memory entries for a user, ordered by insertion order."""
+    try:
+        with db_connection(user_shard(user).memory_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT data FROM memory WHERE user = ? ORDER BY id ASC", (user,))
+            result = cursor.fetchall()
+        
+        return "\n".join([r[0] for r in result]) if result else "No memory found."
+    
+    except sqlite3.Error as e:
+        print(f"[DB ERROR] Failed to retrieve memory: {str(e)}")
+        return "⚠️ Error retrieving memory."
+
+
+def recent_memory(user, limit):
+    """Return the user's newest (id, data) pairs, newest first."""
+    try:
+        with db_connection(user_shard(user).memory_path) as conn:
+            return conn.execute("SELECT id, data FROM memory WHERE user = ? ORDER BY id DESC LIMIT ?",
+                                (user, limit)).fetchall()
+    except sqlite3.Error as e:
+        log_event("memory_read_failed", logging.WARNING, error=str(e))
+        return []
+
+# Keyword Search over Memory
+def fts_query(keyword, prefix=True, any_word=False):
+    """Turn free text into an FTS5 query: every word (any_word: any one) must match, as a word prefix or a whole word."""
+    words = re.findall(r"\w+", keyword.lower())
+    return (" OR " if any_word else " ").join(f'"{word}"*' if prefix else f'"{word}"' for word in words)
+
+def search_memory(user, keyword, limit=20, prefix=True, any_word=False):
+    """Return (id, data) pairs for a user matching keyword, best match first.
+
+    With prefix=False every word must appear whole, so "tea" doesn't match "teacher".
+    With any_word=True one matching word is enough.
+    """
+    query = fts_query(keyword, prefix, any_word)
+    if not query:
+        return []
+    # Matching the user column keeps the search to the caller's entries; ids that
+    # tokenize alike ("a.b" and "a-b") are told apart by memory.user below
+    if re.search(r"[^\W_]", user):
+        query = '{user} : "%s" AND {data} : (%s)' % (user.replace('"', '""'), query)
+    try:
+        with db_connection(user_shard(user).memory_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT memory.id, memory.data
+                FROM memory_fts JOIN memory ON memory.id = memory_fts.rowid
+                WHERE memory_fts MATCH ? AND memory.user = ?
+                ORDER BY memory_fts.rank
+                LIMIT ?
+            """, (query, user, limit))
+            return cursor.fetchall()
+    except Exception as e:
+        print(f"Error searching memory: {str(e)}")
+        return []
+
+# Remove Memory
+def remove_memory(user, keyword):
+    """Delete every memory entry containing all the words of keyword. Returns the removed (id, data) pairs."""
+    try:
+        matches = search_memory(user, keyword, limit=-1, prefix=False)
+        shard = user_shard(user)
+        with db_connection(shard.memory_path) as conn:
+            cursor = conn.cursor()
+            cursor.executemany("DELETE FROM memory WHERE id = ?", [(memory_id,) for memory_id, _ in matches])
+            conn.commit()
+        shard.memory_index.remove([memory_id for memory_id, _ in matches])
+        if matches:
+            reply_cache.invalidate(user)
+        return matches
+    except Exception as e:
+        print(f"Error removing memory: {str(e)}")
+        return []
+
+# Update Memory
+def update_memory(user, old_data, new_data):
+    """Replace the best whole-word match for old_data. Returns the old text, or None if nothing matched."""
+    try:
+        matches = search_memory(user, old_data, limit=1, prefix=False)
+        if not matches:
+            return None
+        memory_id, previous = matches[0]
+        shard = user_shard(user)
+        with db_connection(shard.memory_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE memory SET data = ? WHERE id = ?", (new_data, memory_id))
+            conn.commit()
+        shard.memory_index.add([(memory_id, user, new_data)])
+        reply_cache.invalidate(user)
+        return previous
+    except Exception as e:
+        print(f"Error updating memory: {str(e)}")
+        return None
+
+# Short bullet list of memory entries for command replies
+def format_memory_preview(entries, limit=5):
+    lines = [f"- {data}" for data in entries[:limit]]
+    if len(entries) > limit:
+        lines.append(f"- ...and {len(entries) - limit} more")
+    return "\n".join(lines)
+
+# Embeddings for long-term memory
+def hash_embed(texts, dim=HASH_EMBED_DIM):
+    """Deterministic bag-of-words embeddings; a stand-in for the Ollama model in tests."""
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % dim
+            vectors[row, bucket] += 1.0 if digest[4] & 1 else -1.0
+    return vectors
+
+def embed_texts(texts):
+    """Embed a list of texts as L2-normalised float32 rows."""
+    if EMBED_BACKEND == "hash":
+        vectors = hash_embed(texts)
+    else:
+        response = ollama.embed(model=EMBED_MODEL, input=list(texts))
+        vectors = np.asarray(response["embeddings"], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _text_digest(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+# Change log record: operation, memory id, content digest, user length in bytes,
+# vector length in floats; followed by the user (UTF-8) and the vector (float32)
+_VECTOR_LOG_MAGIC = b"MIKASA-VECTOR-LOG 1\n"
+_VECTOR_LOG_RECORD = struct.Struct("<BqqII")
+_VECTOR_LOG_ADD, _VECTOR_LOG_REMOVE = 1, 2
+
+class MemoryVectorIndex:
+    """Embeddings of one shard's memory table, kept in NumPy arrays and persisted to disk.
+
+    Rows are keyed by memory.id. A content digest per row lets sync() re-embed
+    only entries that are new or changed since the index was last saved. The
+    entry texts are kept alongside (not saved), so retrieval needs no database read.
+
+    The arrays grow by doubling and a removed row is filled with the last one, so
+    no change copies the index. On disk a snapshot (.npz) is followed by a log of
+    the changes made since (.log): a write only appends its records to the log,
+    and once the log outgrows VECTOR_LOG_COMPACT_RATIO of the index a background
+    thread folds it into a new snapshot.
+    """
+
+    def __init__(self, path, db_path):
+        self.path = path
+        self.log_path = os.path.splitext(path)[0] + ".log"
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.sync_lock = threading.Lock()
+        self.size = 0                   # rows in use; the arrays hold room for more
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.user_codes = np.zeros(0, dtype=np.int32)
+        self.digests = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.positions = {}             # memory id -> row
+        self.user_names = []            # user code -> user
+        self.user_lookup = {}           # user -> user code
+        self.texts = {}
+        self.log_file = None
+        self.log_records = 0            # records in the log since the last snapshot
+        self.compacting = False
+        self.touched = None             # ids changed by add() or remove() while sync() runs
+        self.loaded = False
+        self.synced = False
+
+    @staticmethod
+    def backend_key():
+        return f"{EMBED_BACKEND}:{EMBED_MODEL if EMBED_BACKEND != 'hash' else HASH_EMBED_DIM}"
+
+    def load(self):
+        """Load the snapshot and replay the change log; ignored if missing, unreadable or built with another model."""
+        self.loaded = True
+        try:
+            with np.load(self.path) as saved:
+                if str(saved["backend"]) == self.backend_key():
+                    self.ids = saved["ids"]
+                    self.digests = saved["digests"]
+                    self.vectors = saved["vectors"]
+                    users, codes = np.unique(saved["users"], return_inverse=True)
+                    self.user_codes = codes.astype(np.int32)
+                    self.user_names = users.tolist()
+                    self.user_lookup = {user: code for code, user in enumerate(self.user_names)}
+                    self.size = len(self.ids)
+                    self.positions = {memory_id: row for row, memory_id in enumerate(self.ids.tolist())}
+        except (OSError, KeyError, ValueError) as e:
+            if os.path.exists(self.path):
+                log_event("memory_index_unreadable", logging.WARNING, path=self.path, error=str(e))
+        # A log left by an interrupted compaction comes first. Replaying is idempotent,
+        # so it doesn't matter whether its snapshot was written before the crash.
+        for log_path in (self.log_path + ".old", self.log_path):
+            self._replay(log_path)
+
+    def _replay(self, log_path):
+        try:
+            with open(log_path, "rb") as f:
+                if f.readline() != _VECTOR_LOG_MAGIC or f.readline().decode("utf-8", "replace").strip() != self.backend_key():
+                    f.close()
+                    os.remove(log_path)
+                    return
+                good = f.tell()
+                while True:
+                    header = f.read(_VECTOR_LOG_RECORD.size)
+                    if len(header) < _VECTOR_LOG_RECORD.size:
+                        break
+                    op, memory_id, digest, user_length, dim = _VECTOR_LOG_RECORD.unpack(header)
+                    payload = f.read(user_length + dim * 4)
+                    if len(payload) < user_length + dim * 4:
+                        break
+                    if op == _VECTOR_LOG_ADD:
+                        vector = np.frombuffer(payload, dtype=np.float32, offset=user_length)
+                        self._put(memory_id, payload[:user_length].decode("utf-8"), digest, vector)
+                    else:
+                        self._delete(memory_id)
+                    self.log_records += 1
+                    good = f.tell()
+            # Drop a record cut short by a crash, so new records follow the last whole one
+            if os.path.getsize(log_path) > good:
+                os.truncate(log_path, good)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, struct.error) as e:
+            log_event("memory_index_log_unreadable", logging.WARNING, path=log_path, error=str(e))
+
+    def _reserve(self, count, dim):
+        """Make room for count more rows of dim floats, doubling the arrays when full."""
+        if self.size == 0 and self.vectors.shape[1] != dim:
+            self.vectors = np.zeros((len(self.ids), dim), dtype=np.float32)
+        needed = self.size + count
+        if needed <= len(self.ids):
+            return
+        capacity = max(64, 2 * len(self.ids), needed)
+
+        def grown(array):
+            larger = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            larger[:self.size] = array[:self.size]
+            return larger
+        self.ids, self.user_codes, self.digests, self.vectors = map(
+            grown, (self.ids, self.user_codes, self.digests, self.vectors))
+
+    def _put(self, memory_id, user, digest, vector):
+        code = self.user_lookup.get(user)
+        if code is None:
+            code = self.user_lookup[user] = len(self.user_names)
+            self.user_names.append(user)
+        row = self.positions.get(memory_id)
+        if row is None:
+            self._reserve(1, len(vector))
+            row = self.positions[memory_id] = self.size
+            self.size += 1
+        self.ids[row], self.user_codes[row], self.digests[row] = memory_id, code, digest
+        self.vectors[row] = vector
+
+    def _delete(self, memory_id):
+        row = self.positions.pop(memory_id, None)
+        if row is None:
+            return
+        last = self.size - 1
+        if row != last:
+            self.ids[row], self.user_codes[row], self.digests[row] = self.ids[last], self.user_codes[last], self.digests[last]
+            self.vectors[row] = self.vectors[last]
+            self.positions[int(self.ids[row])] = row
+        self.size = last
+
+    @staticmethod
+    def _embed(rows, batch_size=64):
+        return np.vstack([embed_texts([data for _, _, data in rows[start:start + batch_size]])
+                          for start in range(0, len(rows), batch_size)])
+
+    def _insert(self, rows, vectors):
+        """Index (id, user, data) rows with their vectors. Returns their log records, built on demand."""
+        if not rows:
+            return lambda: []
+        self._reserve(len(rows), vectors.shape[1])
+        digests = [_text_digest(data) for _, _, data in rows]
+        for (memory_id, user, _), digest, vector in zip(rows, digests, vectors):
+            self._put(memory_id, user, digest, vector)
+
+        def records():
+            out = []
+            for (memory_id, user, _), digest, vector in zip(rows, digests, vectors):
+                user_bytes = user.encode("utf-8")
+                out.append(_VECTOR_LOG_RECORD.pack(_VECTOR_LOG_ADD, memory_id, digest, len(user_bytes), len(vector))
+                           + user_bytes + vector.astype(np.float32).tobytes())
+            return out
+        return records
+
+    @staticmethod
+    def _remove_records(memory_ids):
+        return [_VECTOR_LOG_RECORD.pack(_VECTOR_LOG_REMOVE, memory_id, 0, 0, 0) for memory_id in memory_ids]
+
+    def _persist(self, count, records):
+        """Record count changes on disk; records() builds their log records. Called with the lock held.
+
+        Changes that would push the log over its limit start a compaction instead, whose
+        snapshot is taken after the lock is released and so includes them.
+        """
+        if not self.compacting and self.log_records + count >= max(VECTOR_LOG_MIN_RECORDS,
+                                                                    self.size * VECTOR_LOG_COMPACT_RATIO):
+            self.compacting = True
+            threading.Thread(target=self.compact, name="memory-index-compact", daemon=True).start()
+            return
+        try:
+            if self.log_file is None:
+                self.log_file = open(self.log_path, "ab")
+                if self.log_file.tell() == 0:
+                    self.log_file.write(_VECTOR_LOG_MAGIC + self.backend_key().encode("utf-8") + b"\n")
+            self.log_file.write(b"".join(records()))
+            self.log_file.flush()
+            self.log_records += count
+        except OSError as e:
+            # The in-memory index is current; sync() after a restart re-embeds whatever the file missed
+            log_event("memory_index_log_failed", logging.WARNING, path=self.log_path, error=str(e))
+
+    def compact(self):
+        """Write a new snapshot of the index and drop the change log it replaces."""
+        with self.lock:
+            self.compacting = True
+            size = self.size
+            users = np.array(self.user_names, dtype=str) if self.user_names else np.zeros(0, dtype="U1")
+            snapshot = {"ids": self.ids[:size].copy(), "users": users[self.user_codes[:size]],
+                        "digests": self.digests[:size].copy(), "vectors": self.vectors[:size].copy()}
+            # Later changes start a new log; the old one is kept until the snapshot is in place
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+            try:
+                if os.path.exists(self.log_path):
+                    os.replace(self.log_path, self.log_path + ".old")
+                self.log_records = 0
+            except OSError as e:
+                log_event("memory_index_log_rotate_failed", logging.WARNING, path=self.log_path, error=str(e))
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, backend=np.array(self.backend_key()), **snapshot)
+            os.replace(tmp_path, self.path)
+            if os.path.exists(self.log_path + ".old"):
+                os.remove(self.log_path + ".old")
+        except OSError as e:
+            log_event("memory_index_save_failed", logging.WARNING, path=self.path, error=str(e))
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    def sync(self, batch_size=256):
+        """Reconcile with the memory table, embedding only new or changed rows.
+
+        Rows are embedded a batch at a time without the lock, so searches and writes
+        go on meanwhile. Ids that add() or remove() change in the meantime are newer
+        than what was read here, and are left as they are.
+        """
+        with self.sync_lock:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+                self.touched = set()
+            try:
+                with db_connection(self.db_path) as conn:
+                    rows = conn.execute("SELECT id, user, data FROM memory").fetchall()
+
+                with self.lock:
+                    indexed = dict(zip(self.ids[:self.size].tolist(), self.digests[:self.size].tolist()))
+                    current = {memory_id: data or "" for memory_id, _, data in rows}
+                    stale = [(memory_id, user or "", data or "") for memory_id, user, data in rows
+                             if indexed.get(memory_id) != _text_digest(data or "")]
+                    removed = [memory_id for memory_id in indexed
+                               if memory_id not in current and memory_id not in self.touched]
+
+                    texts = {memory_id: data for memory_id, data in current.items() if memory_id not in self.touched}
+                    texts.update((memory_id, self.texts[memory_id]) for memory_id in self.touched
+                                 if memory_id in self.texts)
+                    self.texts = texts
+                    if removed:
+                        for memory_id in removed:
+                            self._delete(memory_id)
+                        self._persist(len(removed), lambda: self._remove_records(removed))
+
+                for start in range(0, len(stale), batch_size):
+                    batch = stale[start:start + batch_size]
+                    vectors = self._embed(batch)
+                    with self.lock:
+                        keep = [row for row, (memory_id, _, _) in enumerate(batch) if memory_id not in self.touched]
+                        if keep:
+                            records = self._insert([batch[row] for row in keep], vectors[keep])
+                            self._persist(len(keep), records)
+                self.synced = True
+            finally:
+                with self.lock:
+                    self.touched = None
+
+    def add(self, rows, persist=True):
+        """Embed and index (id, user, data) rows, replacing existing ids.
+
+        With persist=False the change stays in memory until the caller runs compact().
+        """
+        if not rows:
+            return
+        try:
+            # Embed before taking the lock, so searches aren't held up by a large batch
+            vectors = self._embed(rows)
+        except Exception as e:
+            # The next sync() picks the rows up again
+            log_event("memory_index_embed_failed", logging.WARNING, rows=len(rows), error=str(e))
+            self.synced = False
+            return
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if self.touched is not None:
+                self.touched.update(row[0] for row in rows)
+            self.texts.update((row[0], row[2]) for row in rows)
+            records = self._insert(rows, vectors)
+            if persist:
+                self._persist(len(rows), records)
+
+    def remove(self, memory_ids):
+        if not memory_ids:
+            return
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if self.touched is not None:
+                self.touched.update(memory_ids)
+            for memory_id in memory_ids:
+                self.texts.pop(memory_id, None)
+                self._delete(memory_id)
+            self._persist(len(memory_ids), lambda: self._remove_records(memory_ids))
+
+    def _user_mask(self, user):
+        code = self.user_lookup.get(user)
+        if code is None:
+            return None
+        return self.user_codes[:self.size] == code
+
+    def count(self, user):
+        with self.lock:
+            mask = self._user_mask(user)
+            return 0 if mask is None else int(np.count_nonzero(mask))
+
+    def entries(self, user, memory_ids=None):
+        """(id, text) pairs for user: all of them in id order, or memory_ids in the given order."""
+        with self.lock:
+            if memory_ids is None:
+                mask = self._user_mask(user)
+                memory_ids = [] if mask is None else sorted(self.ids[:self.size][mask].tolist())
+            return [(memory_id, self.texts[memory_id]) for memory_id in memory_ids if memory_id in self.texts]
+
+    def search(self, user, query, k):
+        """Return the ids of the k entries for user most similar to query."""
+        query_vector = embed_texts([query])[0]
+        with self.lock:
+            mask = self._user_mask(user)
+            if mask is None:
+                return []
+            ids, vectors = self.ids[:self.size][mask], self.vectors[:self.size][mask]
+        if len(ids) == 0:
+            return []
+        scores = vectors @ query_vector
+        if len(ids) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(ids))
+        return ids[top[np.argsort(-scores[top])]].tolist()
+
+# Retrieve only the memory relevant to the current message
+def retrieve_relevant_memory(user, query, k=MEMORY_TOP_K, max_tokens=None):
+    """Retrieve the top-k memory entries for a user by similarity to query, in insertion order.
+
+    With max_tokens set, the most relevant entries are kept until the budget is used up.
+    If the query can't be embedded, keyword matches stand in, or failing those the
+    newest entries; never more than k of them.
+    """
+    try:
+        memory_index = user_shard(user).memory_index
+        if not memory_index.synced:
+            memory_index.sync()
+        # Everything fits in k, no need to rank
+        if memory_index.count(user) <= k:
+            ranked = memory_index.entries(user)
+        else:
+            ranked = memory_index.entries(user, memory_index.search(user, query, k))
+    except Exception as e:
+        log_event("memory_search_fallback", logging.WARNING, error=str(e))
+        ranked = search_memory(user, query, limit=k, any_word=True) or recent_memory(user, k)
+
+    if max_tokens is not None:
+        kept, used = [], 0
+        for memory_id, data in ranked:
+            tokens = count_tokens(data)
+            if used + tokens <= max_tokens:
+                kept.append((memory_id, data))
+                used += tokens
+        ranked = kept
+
+    result = sorted(ranked)
+    return "\n".join([data for _, data in result]) if result else "No memory found."
+
+# Get current time and date
+def get_current_datetime():
+    """Returns formatted current date and time."""
+    current_time = time.strftime("%I:%M %p")  # 12-hour format with AM/PM
+    current_date = time.strftime("%A, %B %d, %Y")  # Day of week, Month, Day, Year
+    return {
+        "time": current_time,
+        "date": current_date,
+        "full": f"{current_date} at {current_time}"
+    }
+
+# Per-session state cache. Holds the mode, the rolling summary and a ring buffer
+# of the latest turns for recently active sessions, so a normal chat turn reads
+# nothing from the database. Every writer of that state updates it here too.
+class SessionState:
+    __slots__ = ("mode", "summary", "turns", "covered_after", "version", "anchor")
+
+    def __init__(self):
+        self.mode = None            # None = not loaded
+        self.summary = None         # (summary, last_message_id), None = not loaded
+        self.turns = None           # deque of (id, role, message), None = not loaded
+        self.covered_after = 0      # every turn with a larger id is in `turns`
+        self.version = 0            # bumped on every history change, guards loads
+        self.anchor = 0             # first message id of the prompt's history window
+
+class SessionCache:
+    def __init__(self, max_sessions, max_turns):
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+
+    def _state(self, session_id, create=True):
+        state = self.sessions.get(session_id)
+        if state is not None:
+            self.sessions.move_to_end(session_id)
+        elif create:
+            state = self.sessions[session_id] = SessionState()
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return state
+
+    def get(self, session_id, field):
+        with self.lock:
+            state = self._state(session_id, create=False)
+            return getattr(state, field) if state else None
+
+    def set(self, session_id, field, value):
+        with self.lock:
+            setattr(self._state(session_id), field, value)
+
+    def history_version(self, session_id):
+        with self.lock:
+            return self._state(session_id).version
+
+    def history(self, session_id, after_id, limit):
+        """The newest `limit` turns after after_id, or None if the cache can't tell."""
+        with self.lock:
+            state = self._state(session_id, create=False)
+            if state is None or state.turns is None:
+                return None
+            rows = [row for row in state.turns if row[0] > after_id]
+            if after_id >= state.covered_after or len(rows) >= limit:
+                return rows[-limit:]
+            return None
+
+    def load_history(self, session_id, rows, version):
+        """Install the latest turns read from the database, unless the history changed meanwhile."""
+        with self.lock:
+            state = self._state(session_id)
+            if state.version != version:
+                return
+            state.turns = deque(rows[-self.max_turns:], maxlen=self.max_turns)
+            # Fewer rows than asked for means the whole session is here
+            state.covered_after = state.turns[0][0] - 1 if len(rows) >= self.max_turns else 0
+
+    def append_turn(self, session_id, row):
+        with self.lock:
+            state = self._state(session_id, create=False)
+            if state is None:
+                return
+            state.version += 1
+            if state.turns is not None:
+                if len(state.turns) == self.max_turns:
+                    state.covered_after = state.turns[0][0]
+                state.turns.append(row)
+
+    def drop_recent_turns(self, session_id, count):
+        with self.lock:
+            state = self._state(session_id, create=False)
+            if state is None:
+                return
+            state.version += 1
+            if state.turns is not None:
+                if len(state.turns) > count or state.covered_after == 0:
+                    for _ in range(min(count, len(state.turns))):
+                        state.turns.pop()
+                else:
+                    state.turns = None
+
+    def forget(self, session_id):
+        """Drop everything cached for a session, so the next read goes to the database."""
+        with self.lock:
+            state = self._state(session_id, create=False)
+            if state is not None:
+                state.version += 1
+                state.mode = state.summary = state.turns = None
+                state.covered_after = state.anchor = 0
+
+    def clear_history(self, session_id=None, prefix=""):
+        """Forget turns and summary after a delete: one session, or all whose key starts with prefix."""
+        with self.lock:
+            if session_id:
+                states = [self._state(session_id, create=False)]
+            else:
+                states = [state for key, state in self.sessions.items() if key.startswith(prefix)]
+            for state in states:
+                if state is not None:
+                    state.version += 1
+                    state.turns = deque(maxlen=self.max_turns) if session_id else None
+                    state.covered_after = 0
+                    state.summary = ("", 0)
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TURNS)
+
+# Write-behind buffer for chat history, one per chat database. Messages get their
+# id up front and are inserted in batches by a background thread, so a chat turn
+# costs no commit of its own. Reads merge in the buffered rows, so callers always
+# see their own writes. Ids are handed out by this process, so only one server
+# process may write to the chat databases at a time. They are reserved in
+# id_sequence a block at a time before use, so none is ever handed out twice,
+# not even after a restart that follows deleting the newest messages.
+class HistoryWriter:
+    def __init__(self, path, flush_interval, max_batch, id_block=HISTORY_ID_BLOCK):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.id_block = id_block
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = []               # (id, session_id, timestamp, message, role)
+        self.next_id = None
+        self.reserved_to = 0            # last id reserved in id_sequence
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+
+    def _take_ids(self, count):
+        """Hand out count consecutive ids and return the first. Called with self.lock held."""
+        if self.next_id is None:
+            with db_connection(self.path) as conn:
+                last_id = conn.execute("SELECT MAX(id) FROM temp_memory").fetchone()[0] or 0
+                reserved = conn.execute("SELECT last_id FROM id_sequence WHERE name = 'temp_memory'").fetchone()
+            self.reserved_to = max(last_id, reserved[0] if reserved else 0)
+            self.next_id = self.reserved_to + 1
+        first_id = self.next_id
+        if first_id + count - 1 > self.reserved_to:
+            reserved_to = first_id + count - 1 + self.id_block
+            with db_connection(self.path) as conn:
+                conn.execute("INSERT OR REPLACE INTO id_sequence (name, last_id) VALUES ('temp_memory', ?)",
+                             (reserved_to,))
+            self.reserved_to = reserved_to
+        self.next_id += count
+        return first_id
+
+    def append(self, session_id, message, role=None):
+        """Buffer one message and return its id."""
+        with self.lock:
+            message_id = self._take_ids(1)
+            self.pending.append((message_id, session_id, monotonic_timestamp(), message, role))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self.thread.start()
+            if len(self.pending) >= self.max_batch:
+                self.wakeup.set()
+        return message_id
+
+    def pending_rows(self, session_id, after_id=0):
+        """Buffered (id, role, message) rows for a session, oldest first."""
+        with self.lock:
+            return [(row[0], row[4], row[3]) for row in self.pending if row[1] == session_id and row[0] > after_id]
+
+    def reserve_ids(self, count):
+        """Hand out `count` consecutive ids for rows written directly (bulk import). Returns the first."""
+        with self.lock:
+            return self._take_ids(count)
+
+    def pending_messages(self, session_id):
+        """Buffered (id, role, message, timestamp) rows for a session, oldest first."""
+        with self.lock:
+            return [(row[0], row[4], row[3], row[2]) for row in self.pending if row[1] == session_id]
+
+    def flush(self):
+        """Write everything buffered so far in one transaction."""
+        with self.flush_lock:
+            with self.lock:
+                batch = list(self.pending)
+            if not batch:
+                return 0
+            with db_connection(self.path) as conn:
+                conn.executemany("INSERT OR IGNORE INTO temp_memory (id, session_id, timestamp, message, role) VALUES (?, ?, ?, ?, ?)",
+                                 batch)
+            # Only this method removes rows, and appends go to the end
+            with self.lock:
+                del self.pending[:len(batch)]
+            return len(batch)
+
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Rows stay buffered and go out with the next flush
+                print(f"Error flushing chat history: {str(e)}")
+
+    def close(self):
+        self.stopping = True
+        self.wakeup.set()
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error flushing chat history on shutdown: {str(e)}")
+
+# ---------------------------------------------------------------------------
+# Per-user storage. Each user's long-term memory and chat sessions live in one
+# of several memory/chat database pairs (shards), chosen by a hash of the user
+# id. Users on different shards never wait on each other's write lock, and a
+# shard's page cache, history buffer and vector index only hold its own users.
+# The routing map in routing.db records every user's shard, so a user stays
+# put when DB_SHARDS changes, and the users from before sharding stay in
+# shard 0 (memory.db and chat_memory.db).
+# ---------------------------------------------------------------------------
+USER_ID_PATTERN = re.compile(r"[A-Za-z0-9_.@-]{1,64}")
+
+def parse_user_id(value):
+    """The user an X-User-Id header names: DEFAULT_USER when empty, None when malformed."""
+    if not value:
+        return DEFAULT_USER
+    return value if USER_ID_PATTERN.fullmatch(value) else None
+
+# Mikasa doesn't authenticate anyone itself. A proxy in front of it does, and names
+# the user in X-User-Id; the header is only believed when the request also carries
+# USER_HEADER_SECRET in X-Proxy-Secret, so a client can't pick whose data it reads.
+def authenticate_user(user_header, proxy_secret):
+    """Return (user, None, None) for the user a request acts for, or (None, error, status)."""
+    if USER_HEADER_SECRET:
+        if not hmac.compare_digest(proxy_secret.encode("utf-8"), USER_HEADER_SECRET.encode("utf-8")):
+            return None, "Missing or wrong X-Proxy-Secret", 403
+    elif user_header:
+        return None, "X-User-Id is only accepted from a proxy holding USER_HEADER_SECRET", 403
+    user = parse_user_id(user_header)
+    if user is None:
+        return None, "Invalid X-User-Id", 400
+    return user, None, None
+
+# Clients name their sessions, so two users may both have a "default" session.
+# Storage and every per-session structure use "<user>/<session>" keys instead.
+def session_key(user, session_id):
+    return f"{user}/{session_id}"
+
+def session_owner(key):
+    return key.partition("/")[0]
+
+def session_name(key):
+    return key.partition("/")[2]
+
+def session_key_range(user):
+    """(low, high) bounds of every session key of user, for range scans of the session_id index."""
+    return f"{user}/", f"{user}0"   # "0" is the character after "/"
+
+def shard_path(path, number):
+    root, ext = os.path.splitext(path)
+    return path if number == 0 else f"{root}-{number}{ext}"
+
+class StorageShard:
+    """One shard: its memory and chat databases, their history writer and memory vector index."""
+
+    def __init__(self, number):
+        self.number = number
+        self.memory_path = shard_path(DB_PATH, number)
+        self.chat_path = shard_path(TEMP_DB_PATH, number)
+        self.history_writer = HistoryWriter(self.chat_path, HISTORY_FLUSH_INTERVAL, HISTORY_FLUSH_BATCH)
+        self.memory_index = MemoryVectorIndex(shard_path(VECTOR_INDEX_PATH, number), self.memory_path)
+
+    def migrate(self):
+        with db_connection(self.memory_path) as conn:
+            migrate_db(conn, MEMORY_MIGRATIONS)
+        with db_connection(self.chat_path) as conn:
+            migrate_db(conn, CHAT_MIGRATIONS)
+
+_shards = {}
+_shards_lock = threading.Lock()
+
+def get_shard(number):
+    """The shard with this number, its databases created or migrated on first use."""
+    shard = _shards.get(number)
+    if shard is None:
+        with _shards_lock:
+            shard = _shards.get(number)
+            if shard is None:
+                shard = StorageShard(number)
+                shard.migrate()
+                _shards[number] = shard
+    return shard
+
+def open_shards():
+    """Shards this process has used so far."""
+    with _shards_lock:
+        return [_shards[number] for number in sorted(_shards)]
+
+class ShardRouter:
+    """Which shard holds each user, from the routing map, with recent lookups cached."""
+
+    def __init__(self, path, shard_count, cache_size):
+        self.path = path
+        self.shard_count = shard_count
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.users = OrderedDict()      # user -> shard, LRU
+        self.shards = {0}               # shard numbers holding at least one user
+
+    @staticmethod
+    def hash_shard(user, shard_count):
+        digest = hashlib.blake2b(user.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % shard_count
+
+    def load(self):
+        """Create the routing map. The first time, every user already in memory.db stays in shard 0."""
+        with db_connection(self.path) as conn:
+            migrate_db(conn, ROUTING_MIGRATIONS)
+            empty = conn.execute("SELECT 1 FROM user_shard LIMIT 1").fetchone() is None
+        if empty:
+            with db_connection(get_shard(0).memory_path) as conn:
+                users = {user for user, in conn.execute("SELECT DISTINCT user FROM memory WHERE user IS NOT NULL")}
+            with db_connection(self.path) as conn:
+                conn.executemany("INSERT OR IGNORE INTO user_shard (user, shard) VALUES (?, 0)",
+                                 [(user,) for user in users | {DEFAULT_USER}])
+        with db_connection(self.path) as conn:
+            shards = {shard for shard, in conn.execute("SELECT DISTINCT shard FROM user_shard")}
+        with self.lock:
+            self.shards.update(shards)
+
+    def shards_of(self, users):
+        """{user: shard number} for a collection of users. New users are assigned a shard by hash."""
+        found, missing = {}, []
+        with self.lock:
+            for user in users:
+                number = self.users.get(user)
+                if number is None:
+                    missing.append(user)
+                else:
+                    self.users.move_to_end(user)
+                    found[user] = number
+        if not missing:
+            return found
+
+        with db_connection(self.path) as conn:
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                found.update(conn.execute(f"SELECT user, shard FROM user_shard WHERE user IN ({','.join('?' * len(chunk))})",
+                                          chunk).fetchall())
+            # The hash never changes, so a concurrent assignment of the same user agrees with this one
+            new = [(user, self.hash_shard(user, self.shard_count)) for user in missing if user not in found]
+            if new:
+                conn.executemany("INSERT OR IGNORE INTO user_shard (user, shard) VALUES (?, ?)", new)
+                found.update(new)
+        with self.lock:
+            for user in missing:
+                self.users[user] = found[user]
+                self.shards.add(found[user])
+            while len(self.users) > self.cache_size:
+                self.users.popitem(last=False)
+        return found
+
+    def shard_of(self, user):
+        return self.shards_of((user,))[user]
+
+    def shard_numbers(self):
+        with self.lock:
+            return sorted(self.shards)
+
+shard_router = ShardRouter(ROUTING_DB_PATH, DB_SHARDS, ROUTING_CACHE_SIZE)
+
+def user_shard(user):
+    return get_shard(shard_router.shard_of(user))
+
+def session_shard(key):
+    return user_shard(session_owner(key))
+
+def all_shards():
+    """Every shard that holds a user, for maintenance, warm-up and exports."""
+    return [get_shard(number) for number in shard_router.shard_numbers()]
+
+def close_shards():
+    """Write out every shard's buffered chat history (called on shutdown)."""
+    for shard in open_shards():
+        shard.history_writer.close()
+
+atexit.register(close_shards)
+
+# Ensure the database is initialized when the app starts
+init_db()
+
+# Store Temporary Chat Memory
+def store_temp_memory(session_id, message, prefix=""):
+    """Stores temporary chat memory per session."""
+    try:
+        # The prefix names the sender ("User", "Mikasa", "Assistant", "System")
+        message_id = session_shard(session_id).history_writer.append(session_id, message, prefix or None)
+        session_cache.append_turn(session_id, (message_id, prefix or None, message))
+        return True
+    except Exception as e:
+        print(f"Error storing temporary memory: {str(e)}")
+        return False
+    
+# Retrieve Temporary Chat Memory
+def retrieve_history_since(session_id, after_id=0, limit=HISTORY_FETCH_LIMIT):
+    """Returns up to `limit` of the newest (id, role, message) rows after after_id, oldest first."""
+    cached = session_cache.history(session_id, after_id, limit)
+    if cached is not None:
+        return cached
+    try:
+        # Fill the session's ring buffer while we are at the database anyway
+        version = session_cache.history_version(session_id)
+        load_limit = max(limit, SESSION_CACHE_TURNS) if after_id == 0 else limit
+        shard = session_shard(session_id)
+        # Read the buffer first: a row flushed in between then shows up in both, never in neither
+        buffered = shard.history_writer.pending_rows(session_id, after_id)
+        with db_connection(shard.chat_path) as conn:
+            cursor = conn.cursor()
+            # Walk the (session_id, id) index backwards, then restore chronological order
+            cursor.execute("""
+                SELECT id, role, message FROM (
+                    SELECT id, role, message FROM temp_memory
+                    WHERE session_id = ? AND id > ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                ) ORDER BY id ASC
+            """, (session_id, after_id, load_limit))
+            rows = cursor.fetchall()
+        if buffered:
+            rows = sorted(dict((row[0], row) for row in rows + buffered).values())[-load_limit:]
+        if after_id == 0:
+            session_cache.load_history(session_id, rows, version)
+        return rows[-limit:]
+    except Exception as e:
+        print(f"Error retrieving chat history: {str(e)}")
+        return []
+
+def retrieve_recent_messages(session_id, limit=20):
+    """Returns the most recent `limit` (id, message) rows for a session, oldest first."""
+    return [(message_id, message) for message_id, _, message in retrieve_history_since(session_id, 0, limit)]
+
+def retrieve_temp_memory(session_id, limit=20):
+    """Retrieves the most recent `limit` messages for a session, oldest first."""
+    return "\n".join([message for _, message in retrieve_recent_messages(session_id, limit)])
+
+def retrieve_history_page(session_id, before=None, since=None, limit=HISTORY_PAGE_SIZE):
+    """One page of history as (id, role, message, timestamp) rows, oldest first.
+
+    With since, the first `limit` messages after that id; otherwise the last `limit`
+    before `before` (or the newest overall). Both walk the (session_id, id) index, so
+    the cost follows the page size, not the session length. Returns
+    (rows, has_more, latest_id, epoch); latest_id is the session's newest id, None if
+    empty, and epoch the owner's history epoch (see bump_history_epoch).
+    """
+    shard = session_shard(session_id)
+    # Read the buffer first: a row flushed in between then shows up in both, never in neither
+    buffered = shard.history_writer.pending_messages(session_id)
+    with db_connection(shard.chat_path) as conn:
+        if since is not None:
+            rows = conn.execute("""
+                SELECT id, role, message, timestamp FROM temp_memory
+                WHERE session_id = ? AND id > ?
+                ORDER BY id ASC LIMIT ?
+            """, (session_id, since, limit + 1)).fetchall()
+        else:
+            rows = conn.execute("""
+                SELECT id, role, message, timestamp FROM temp_memory
+                WHERE session_id = ? AND id < ?
+                ORDER BY id DESC LIMIT ?
+            """, (session_id, before if before is not None else 1 << 62, limit + 1)).fetchall()
+        latest_id = conn.execute("SELECT MAX(id) FROM temp_memory WHERE session_id = ?", (session_id,)).fetchone()[0]
+        epoch = conn.execute("SELECT epoch FROM history_epoch WHERE user = ?", (session_owner(session_id),)).fetchone()
+
+    if buffered:
+        latest_id = max(latest_id or 0, buffered[-1][0])
+    if since is not None:
+        buffered = [row for row in buffered if row[0] > since]
+    elif before is not None:
+        buffered = [row for row in buffered if row[0] < before]
+    merged = sorted(dict((row[0], row) for row in rows + buffered).values(), reverse=since is None)
+    return sorted(merged[:limit]), len(merged) > limit, latest_id, epoch[0] if epoch else 0
+
+def bump_history_epoch(conn, user):
+    """Record, in the caller's transaction, that some of user's messages were deleted.
+
+    Ids never repeat, so a client can fetch only what came after its newest id;
+    a changed epoch tells it that what it already has may be gone.
+    """
+    conn.execute("INSERT OR REPLACE INTO history_epoch (user, epoch) VALUES (?, ?)", (user, monotonic_timestamp()))
+
+# Delete Temporary Chat Memory
+def delete_temp_memory(session_id=None, user=DEFAULT_USER):
+    """Deletes temporary chat memory for a specific session, or for all of user's sessions."""
+    try:
+        shard = session_shard(session_id) if session_id else user_shard(user)
+        shard.history_writer.flush()
+        with db_connection(shard.chat_path) as conn:
+            cursor = conn.cursor()
+            if session_id:
+                cursor.execute("DELETE FROM temp_memory WHERE session_id = ?", (session_id,))
+                cursor.execute("DELETE FROM session_summary WHERE session_id = ?", (session_id,))
+            else:
+                cursor.execute("DELETE FROM temp_memory WHERE session_id >= ? AND session_id < ?",
+                               session_key_range(user))
+                cursor.execute("DELETE FROM session_summary WHERE session_id >= ? AND session_id < ?",
+                               session_key_range(user))
+            bump_history_epoch(conn, session_owner(session_id) if session_id else user)
+            conn.commit()
+        session_cache.clear_history(session_id, session_key(user, ""))
+        return True
+    except Exception as e:
+        print(f"Error deleting temporary memory: {str(e)}")
+        return False
+
+def delete_recent_temp_memory(session_id, limit=3):
+    """Deletes the most recent entries for a specific session."""
+    try:
+        shard = session_shard(session_id)
+        shard.history_writer.flush()
+        with db_connection(shard.chat_path) as conn:
+            cursor = conn.cursor()
+            # Delete the most recent entries, limiting to the specified number
+            cursor.execute("""
+                DELETE FROM temp_memory 
+                WHERE id IN (
+                    SELECT id 
+                    FROM temp_memory 
+                    WHERE session_id = ? 
+                    ORDER BY id DESC 
+                    LIMIT ?
+                )
+            """, (session_id, limit))
+            bump_history_epoch(conn, session_owner(session_id))
+            conn.commit()
+        session_cache.drop_recent_turns(session_id, limit)
+        return True
+    except Exception as e:
+        print(f"Error deleting recent temporary memory: {str(e)}")
+        return False
+
+# Functions for session mode
+def get_session_mode(session_id):
+    """Get the current mode for a session."""
+    mode = session_cache.get(session_id, "mode")
+    if mode is not None:
+        return mode
+    try:
+        with db_connection(session_shard(session_id).chat_path) as conn:
+            cursor = conn.cursor()
+            # Try to get existing mode
+            cursor.execute("SELECT mode FROM session_mode WHERE session_id = ?", (session_id,))
+            result = cursor.fetchone()
+            
+            if result:
+                mode = result[0]
+            else:
+                # Create default entry if none exists
+                cursor.execute("INSERT INTO session_mode (session_id, mode) VALUES (?, 'assistant')", (session_id,))
+                conn.commit()
+                mode = "assistant"
+        session_cache.set(session_id, "mode", mode)
+        return mode
+    except Exception as e:
+        print(f"Error getting session mode: {str(e)}")
+        return "assistant"  # Default to assistant mode on error
+
+def set_session_mode(session_id, mode):
+    """Set the mode for a session."""
+    try:
+        with db_connection(session_shard(session_id).chat_path) as conn:
+            cursor = conn.cursor()
+            # Insert or replace the mode for the session
+            cursor.execute("""
+                INSERT OR REPLACE INTO session_mode (session_id, mode) 
+                VALUES (?, ?)
+            """, (session_id, mode))
+            conn.commit()
+        session_cache.set(session_id, "mode", mode)
+        return True
+    except Exception as e:
+        print(f"Error setting session mode: {str(e)}")
+        return False
+
+# ---------------------------------------------------------------------------
+# Chat history retention. A background job keeps each shard's chat database
+# small, so its pages stay in SQLite's cache: sessions idle for RETENTION_MAX_AGE_DAYS are
+# removed, and sessions over RETENTION_MAX_ROWS lose their oldest messages.
+# Removed messages are first written to gzip-compressed JSON lines files in
+# ARCHIVE_DIR. Freed pages go back to the OS with incremental vacuum.
+# ---------------------------------------------------------------------------
+ARCHIVED_MESSAGES = Counter("mikasa_archived_messages_total", "Chat messages archived by retention.")
+MAINTENANCE_SECONDS = Histogram("mikasa_maintenance_seconds", "Duration of retention and compaction runs.")
+_maintenance_stop = threading.Event()
+
+def archive_path(session_id, run_stamp):
+    slug = re.sub(r"[^A-Za-z0-9_.-]", "_", session_id)[:40]
+    digest = hashlib.sha1(session_id.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(ARCHIVE_DIR, f"{slug}-{digest}-{run_stamp}.jsonl.gz")
+
+def archive_history(shard, session_id, up_to_id, run_stamp):
+    """Move a session's messages with id <= up_to_id into its archive file, in batches.
+
+    Rows are written out before they are deleted, so an interrupted run may archive
+    some rows twice but never loses any. Returns the number of messages archived.
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = archive_path(session_id, run_stamp)
+    archived, after_id = 0, 0
+    while True:
+        with db_connection(shard.chat_path) as conn:
+            rows = conn.execute("""
+                SELECT id, timestamp, role, message FROM temp_memory
+                WHERE session_id = ? AND id > ? AND id <= ?
+                ORDER BY id
+                LIMIT ?
+            """, (session_id, after_id, up_to_id, MAINTENANCE_BATCH)).fetchall()
+        if not rows:
+            return archived
+        # Each batch is its own gzip member; readers see one continuous file
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            for message_id, timestamp, role, message in rows:
+                f.write(json.dumps({"id": message_id, "session_id": session_id, "timestamp": timestamp,
+                                    "role": role, "message": message}, ensure_ascii=False) + "\n")
+        with db_connection(shard.chat_path) as conn:
+            conn.execute("DELETE FROM temp_memory WHERE session_id = ? AND id > ? AND id <= ?",
+                         (session_id, after_id, rows[-1][0]))
+            bump_history_epoch(conn, session_owner(session_id))
+        archived += len(rows)
+        after_id = rows[-1][0]
+        ARCHIVED_MESSAGES.inc(len(rows))
+
+def expire_sessions(shard, run_stamp):
+    """Archive a shard's expired sessions and trim long ones. Returns (archived, expired, trimmed)."""
+    archived = expired = trimmed = 0
+    with db_connection(shard.chat_path) as conn:
+        sessions = conn.execute("""
+            SELECT session_id, COUNT(*), MAX(id), MAX(timestamp) FROM temp_memory GROUP BY session_id
+        """).fetchall()
+    cutoff = time.time_ns() // 1000 - RETENTION_MAX_AGE_DAYS * 86400 * 1000000 if RETENTION_MAX_AGE_DAYS else None
+
+    for session_id, count, last_id, last_timestamp in sessions:
+        if cutoff is not None and last_timestamp < cutoff:
+            up_to_id = last_id
+        elif RETENTION_MAX_ROWS and count > RETENTION_MAX_ROWS:
+            with db_connection(shard.chat_path) as conn:
+                up_to_id = conn.execute("""
+                    SELECT id FROM temp_memory WHERE session_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+                """, (session_id, RETENTION_MAX_ROWS)).fetchone()[0]
+        else:
+            continue
+
+        archived += archive_history(shard, session_id, up_to_id, run_stamp)
+        session_cache.forget(session_id)
+        if up_to_id != last_id:
+            trimmed += 1
+            continue
+
+        # Drop the rest of the session's state unless it got new messages meanwhile
+        if shard.history_writer.pending_rows(session_id):
+            continue
+        with db_connection(shard.chat_path) as conn:
+            if conn.execute("SELECT 1 FROM temp_memory WHERE session_id = ? LIMIT 1", (session_id,)).fetchone():
+                continue
+            conn.execute("DELETE FROM session_summary WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM session_mode WHERE session_id = ?", (session_id,))
+        session_cache.forget(session_id)
+        expired += 1
+    return archived, expired, trimmed
+
+def remove_orphan_session_state(shard):
+    """Delete mode and summary rows of a shard's sessions with no messages left. Returns the count."""
+    with db_connection(shard.chat_path) as conn:
+        orphans = [row[0] for row in conn.execute("""
+            SELECT session_id FROM session_mode WHERE session_id NOT IN (SELECT session_id FROM temp_memory)
+            UNION
+            SELECT session_id FROM session_summary WHERE session_id NOT IN (SELECT session_id FROM temp_memory)
+        """)]
+    # Sessions used recently may just be between messages; leave them alone
+    with session_cache.lock:
+        active = set(session_cache.sessions)
+    orphans = [(session_id,) for session_id in orphans
+               if session_id not in active and not shard.history_writer.pending_rows(session_id)]
+    if orphans:
+        with db_connection(shard.chat_path) as conn:
+            conn.executemany("DELETE FROM session_mode WHERE session_id = ?", orphans)
+            conn.executemany("DELETE FROM session_summary WHERE session_id = ?", orphans)
+    return len(orphans)
+
+_vacuum_deferred = set()            # chat databases whose full VACUUM waits for --maintain
+
+def compact_databases(shard, offline=False):
+    """Return free pages to the OS, refresh planner statistics and trim the WAL.
+
+    Returns the number of pages freed from the shard's chat database.
+    """
+    with db_connection(shard.chat_path) as conn:
+        free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Databases created before retention existed need one full VACUUM to switch modes.
+            # It holds the write lock until done, so a running server leaves large files to --maintain
+            size = os.path.getsize(shard.chat_path)
+            if offline or size <= VACUUM_ONLINE_MAX_BYTES:
+                log_event("maintenance_vacuum", path=shard.chat_path, bytes=size)
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            elif shard.chat_path not in _vacuum_deferred:
+                _vacuum_deferred.add(shard.chat_path)
+                log_event("maintenance_vacuum_deferred", logging.WARNING, path=shard.chat_path, bytes=size,
+                          hint="run --maintain with the server stopped")
+        elif free_before:
+            conn.execute(f"PRAGMA incremental_vacuum({int(VACUUM_PAGES)})").fetchall()
+        freed = free_before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    with db_connection(shard.memory_path) as conn:
+        conn.execute("PRAGMA optimize")
+    return freed
+
+def run_maintenance(offline=False):
+    """One retention, archival and compaction pass over every shard. Returns what it did.
+
+    offline=True (--maintain, with the server stopped) also gives large chat
+    databases the full VACUUM the background job defers.
+    """
+    started = time.perf_counter()
+    stats = dict.fromkeys(("archived", "expired_sessions", "trimmed_sessions", "orphans_removed", "pages_freed"), 0)
+    run_stamp = time.strftime("%Y%m%d-%H%M%S")
+    try:
+        for shard in all_shards():
+            shard.history_writer.flush()
+            archived, expired, trimmed = expire_sessions(shard, run_stamp)
+            stats["archived"] += archived
+            stats["expired_sessions"] += expired
+            stats["trimmed_sessions"] += trimmed
+            stats["orphans_removed"] += remove_orphan_session_state(shard)
+            stats["pages_freed"] += compact_databases(shard, offline)
+    except Exception as e:
+        ERRORS.inc(kind="maintenance")
+        stats["error"] = str(e)
+    elapsed = time.perf_counter() - started
+    MAINTENANCE_SECONDS.observe(elapsed)
+    log_event("maintenance", logging.WARNING if "error" in stats else logging.INFO,
+              seconds=round(elapsed, 3), **stats)
+    return stats
+
+def _maintenance_loop():
+    # First run a minute after startup, away from warm-up and the first requests
+    delay = min(60, MAINTENANCE_INTERVAL)
+    while not _maintenance_stop.wait(delay):
+        run_maintenance()
+        delay = MAINTENANCE_INTERVAL
+
+def start_maintenance():
+    """Run run_maintenance every MAINTENANCE_INTERVAL seconds on a background thread."""
+    if MAINTENANCE_INTERVAL > 0:
+        threading.Thread(target=_maintenance_loop, name="maintenance", daemon=True).start()
+
+# ---------------------------------------------------------------------------
+# Bulk import and export as NDJSON, one JSON object per line. Exports page
+# through the primary key BULK_BATCH rows at a time; imports insert each batch
+# of BULK_BATCH lines with one executemany transaction. Neither ever holds
+# more than a batch in memory, whatever the size of the file or table.
+# ---------------------------------------------------------------------------
+IMPORTED_ROWS = Counter("mikasa_imported_rows_total", "Rows added by bulk import.", ("table",))
+
+@contextmanager
+def bulk_load(path):
+    """A transaction with the per-row insert triggers switched off (see migrations 5 and 7).
+
+    The caller must bring the FTS index and row_counts up to date itself before
+    the block ends. Other connections never see the switch: it is set and
+    cleared inside the same transaction.
+    """
+    with db_connection(path) as conn:
+        conn.execute("UPDATE bulk_load SET active = 1")
+        yield conn
+        conn.execute("UPDATE bulk_load SET active = 0")
+
+def _ndjson_batches(lines, parse):
+    """Parse NDJSON lines into batches of rows. Yields (rows, skipped_lines) per batch."""
+    rows, skipped = [], 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = parse(json.loads(line))
+        except (ValueError, TypeError, AttributeError):
+            row = None
+        if row is None:
+            skipped += 1
+            continue
+        rows.append(row)
+        if len(rows) >= BULK_BATCH:
+            yield rows, skipped
+            rows, skipped = [], 0
+    if rows or skipped:
+        yield rows, skipped
+
+def _line_user(entry, owner):
+    """The user a line belongs to. With owner set, lines naming anyone else are rejected (None)."""
+    if owner is not None:
+        return owner if entry.get("user") in (None, "", owner) else None
+    return parse_user_id(entry.get("user"))
+
+def _parse_memory_line(entry, owner=None):
+    user, data = _line_user(entry, owner), entry.get("data")
+    if user is None or not isinstance(data, str) or not data.strip():
+        return None
+    return (user, data)
+
+def _parse_history_line(entry, owner=None):
+    user, session_id = _line_user(entry, owner), entry.get("session_id")
+    message, role = entry.get("message"), entry.get("role")
+    if user is None or not isinstance(session_id, str) or not session_id or not isinstance(message, str):
+        return None
+    timestamp = entry.get("timestamp")
+    # Exports carry Unix milliseconds; rows without one are stamped now
+    timestamp = int(timestamp * 1000) if isinstance(timestamp, (int, float)) else monotonic_timestamp()
+    return (session_key(user, session_id), timestamp, message, str(role) if role else None)
+
+def _rows_by_shard(rows, user_of):
+    """Split a batch of rows by the shard of their user: {StorageShard: rows}."""
+    numbers = shard_router.shards_of({user_of(row) for row in rows})
+    by_number = {}
+    for row in rows:
+        by_number.setdefault(numbers[user_of(row)], []).append(row)
+    return {get_shard(number): shard_rows for number, shard_rows in by_number.items()}
+
+def import_memory(lines, index=True, owner=None):
+    """Add memory entries from NDJSON lines of {"user": ..., "data": ...}. Returns (imported, skipped).
+
+    Ids in the file are ignored; entries get new ones in their user's shard. With
+    owner set, every entry goes to that user and lines naming another user are
+    skipped. With index=True the new entries are embedded into the memory index
+    on a background thread.
+    """
+    imported = skipped = 0
+    ranges = {}                     # shard -> [first_id, last_id] of the imported rows
+    for rows, bad in _ndjson_batches(lines, partial(_parse_memory_line, owner=owner)):
+        skipped += bad
+        for shard, shard_rows in _rows_by_shard(rows, lambda row: row[0]).items():
+            with bulk_load(shard.memory_path) as conn:
+                conn.executemany("INSERT INTO memory (user, data) VALUES (?, ?)", shard_rows)
+                batch_last = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                # The write lock is held throughout, so the batch got consecutive ids
+                batch_first = batch_last - len(shard_rows) + 1
+                conn.execute("INSERT INTO memory_fts (rowid, user, data) SELECT id, user, data FROM memory WHERE id >= ?",
+                             (batch_first,))
+                conn.execute("UPDATE row_counts SET count = count + ? WHERE name = 'memory'", (len(shard_rows),))
+            ranges.setdefault(shard, [batch_first, batch_last])[1] = batch_last
+        imported += len(rows)
+    if imported:
+        IMPORTED_ROWS.inc(imported, table="memory")
+        reply_cache.invalidate(owner)   # everyone's, for an import of all users
+        if index:
+            for shard, (first_id, last_id) in ranges.items():
+                threading.Thread(target=index_memory_range, args=(shard, first_id, last_id),
+                                 name="memory-import-index", daemon=True).start()
+    return imported, skipped
+
+def index_memory_range(shard, first_id, last_id):
+    """Embed a shard's memory rows first_id..last_id into its memory index, a batch at a time."""
+    memory_index = shard.memory_index
+    started = time.perf_counter()
+    after_id = first_id - 1
+    try:
+        while after_id < last_id:
+            with db_connection(shard.memory_path) as conn:
+                rows = conn.execute("SELECT id, user, data FROM memory WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                                    (after_id, last_id, BULK_BATCH)).fetchall()
+            if not rows:
+                break
+            memory_index.add([(memory_id, user or "", data or "") for memory_id, user, data in rows], persist=False)
+            after_id = rows[-1][0]
+        memory_index.compact()
+        log_event("memory_import_indexed", shard=shard.number, rows=last_id - first_id + 1,
+                  seconds=round(time.perf_counter() - started, 3))
+    except Exception as e:
+        ERRORS.inc(kind="memory_index")
+        log_event("memory_import_index_failed", logging.WARNING, error=str(e))
+
+def import_history(lines, owner=None):
+    """Add chat messages from NDJSON lines of {"user", "session_id", "role", "message", "timestamp"}.
+
+    Returns (imported, skipped). Messages get new ids after every existing one
+    in their shard, so they read as the latest turns of their sessions. owner
+    works as in import_memory.
+    """
+    imported = skipped = 0
+    for rows, bad in _ndjson_batches(lines, partial(_parse_history_line, owner=owner)):
+        skipped += bad
+        for shard, shard_rows in _rows_by_shard(rows, lambda row: session_owner(row[0])).items():
+            first_id = shard.history_writer.reserve_ids(len(shard_rows))
+            with bulk_load(shard.chat_path) as conn:
+                conn.executemany("INSERT INTO temp_memory (id, session_id, timestamp, message, role) VALUES (?, ?, ?, ?, ?)",
+                                 [(first_id + offset,) + row for offset, row in enumerate(shard_rows)])
+                conn.execute("UPDATE row_counts SET count = count + ? WHERE name = 'temp_memory'", (len(shard_rows),))
+        for session_id in {row[0] for row in rows}:
+            session_cache.forget(session_id)
+        imported += len(rows)
+    if imported:
+        IMPORTED_ROWS.inc(imported, table="temp_memory")
+    return imported, skipped
+
+def export_memory(user=None):
+    """Yield memory as NDJSON text, BULK_BATCH lines per chunk: one user's, or everyone's shard by shard.
+
+    Ids are in id order within a shard, and only unique within it.
+    """
+    if user is not None:
+        shards, where, params = [user_shard(user)], "user = ?", (user,)
+    else:
+        shards, where, params = all_shards(), "1", ()
+    for shard in shards:
+        after_id = 0
+        while True:
+            with db_connection(shard.memory_path) as conn:
+                rows = conn.execute(f"SELECT id, user, data FROM memory WHERE {where} AND id > ? ORDER BY id LIMIT ?",
+                                    (*params, after_id, BULK_BATCH)).fetchall()
+            if not rows:
+                break
+            yield "".join(json.dumps({"id": memory_id, "user": entry_user, "data": data}, ensure_ascii=False) + "\n"
+                          for memory_id, entry_user, data in rows)
+            after_id = rows[-1][0]
+
+def export_history(session_id=None, user=None):
+    """Yield chat history as NDJSON text, BULK_BATCH lines per chunk. Timestamps are Unix ms.
+
+    One session of user (DEFAULT_USER if not given), all of user's sessions, or
+    with neither everything, shard by shard. Ids are in id order within a shard.
+    """
+    if session_id is not None:
+        user = user or DEFAULT_USER
+        shards, where, params = [user_shard(user)], "session_id = ?", (session_key(user, session_id),)
+    elif user is not None:
+        shards, where, params = [user_shard(user)], "session_id >= ? AND session_id < ?", session_key_range(user)
+    else:
+        shards, where, params = all_shards(), "1", ()
+    for shard in shards:
+        shard.history_writer.flush()
+        after_id = 0
+        while True:
+            with db_connection(shard.chat_path) as conn:
+                rows = conn.execute(f"""
+                    SELECT id, session_id, role, message, timestamp FROM temp_memory
+                    WHERE {where} AND id > ? ORDER BY id LIMIT ?
+                """, (*params, after_id, BULK_BATCH)).fetchall()
+            if not rows:
+                break
+            yield "".join(json.dumps({"id": message_id, "user": session_owner(key), "session_id": session_name(key),
+                                      "role": role, "message": message, "timestamp": timestamp // 1000},
+                                     ensure_ascii=False) + "\n"
+                          for message_id, key, role, message, timestamp in rows)
+            after_id = rows[-1][0]
+
+def open_ndjson(path, mode):
+    """Open an NDJSON file for the command line options: '-' is stdin/stdout, *.gz is gzip-compressed."""
+    if path == "-":
+        return open((sys.stdin if mode == "r" else sys.stdout).fileno(), mode, encoding="utf-8", closefd=False)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+# Prompt templates. These are the system messages and must not change between turns:
+# Ollama reuses its KV cache only for the unchanged prefix of the conversation, so
+# anything that varies per request goes at the end (see build_messages).
+def get_mikasa_prompt():
+    return """
+                #ADD your prompt
+"""
+
+
+
+def get_assistant_prompt():
+     return """
+
+# 🧠 OBJECTIVE  
+You are **Mikasa**, an ultra-efficient AI in **System Mode** for **Charan**.  
+Your responses are **precise, task-focused**, and **fluff-free**.
+
+# 🔧 MODE:  
+**System Mode: ON**  
+- No emotions or small talk  
+- Code/data-focused thinking  
+- Results first, no filler  
+- Speak like a tactical assistant
+
+# 🧪 PROTOCOLS  
+- "I" = Charan | "You" = Mikasa  
+- No "Mikasa:" prefix  
+- Strategic emoji use only (clarity > decoration)  
+- Clean, minimal formatting  
+- No examples unless requested  
+- Boss-like tone allowed (e.g., "Charan", "Boss")  
+- Responses must be **brief, accurate, and direct**
+
+# 🚀 EXECUTE  
+Reply in **System Mode**—zero preamble. Output only. Sharp. Dense.  
+"""
+
+# Volatile per-request context, appended after the user's message
+def get_context_section(user_memory, datetime_info=None):
+    section = f"\n\n---\n### 🧠 Long-term memory\n{user_memory}"
+    if datetime_info:
+        section += f"\n### ⏰ CURRENT TIME: {datetime_info['full']}"
+    return section
+
+def assemble_messages(system_prompt, summary, history, user_message, user_memory, datetime_info=None):
+    """Lay out the chat request so consecutive turns share the longest possible prefix.
+
+    system prompt -> summary -> past turns (append-only) -> user message + volatile context
+    """
+    messages = [{'role': 'system', 'content': system_prompt}]
+    if summary:
+        messages.append({'role': 'system', 'content': f"Summary of the earlier conversation: {summary}"})
+    for role, content in history:
+        messages.append({'role': 'user' if role in (None, "User") else 'assistant', 'content': content})
+    messages.append({'role': 'user', 'content': user_message + get_context_section(user_memory, datetime_info)})
+    return messages
+
+# ---------------------------------------------------------------------------
+# Generation scheduling. Every call to the model takes a ticket from the
+# scheduler: sessions are served round-robin, each session's own requests in
+# order, and when too many are waiting new ones are turned away at once with
+# a Retry-After instead of piling up. A circuit breaker stops sending work to
+# Ollama while it keeps failing.
+# ---------------------------------------------------------------------------
+class SchedulerOverloaded(Exception):
+    """Raised instead of queueing when the model cannot take more work right now."""
+
+    def __init__(self, message, retry_after, status=429):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.status = status
+
+class GenerationTicket:
+    """A place in the generation queue; granted once a slot is free."""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.submitted_at = time.monotonic()
+        self.granted = False
+        self.granted_at = None
+        self.released = False
+        self.breaker_trial = None       # set by submit_generation for the circuit's trial request
+        self._event = threading.Event()
+        self._waiters = []
+
+    def _grant(self):
+        self.granted = True
+        self.granted_at = time.monotonic()
+        self._event.set()
+        for loop, future in self._waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+    def queue_seconds(self):
+        """How long the ticket waited for its slot."""
+        return self.granted_at - self.submitted_at if self.granted else time.monotonic() - self.submitted_at
+
+    def wait(self, timeout=None):
+        """Block until granted. Returns False if timeout ran out first."""
+        return self._event.wait(timeout)
+
+    async def wait_async(self, timeout=None):
+        """Await the grant without holding a thread. Returns False on timeout."""
+        if self._event.is_set():
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiters.append((loop, future))
+        if self._event.is_set():  # granted while registering
+            return True
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters.remove((loop, future))
+
+class FairScheduler:
+    """Round-robin across sessions, FIFO within a session, bounded queue."""
+
+    def __init__(self, slots, max_waiting, max_per_session):
+        self.lock = threading.Lock()
+        self.slots = slots
+        self.free = slots
+        self.max_waiting = max_waiting
+        self.max_per_session = max_per_session
+        self.queues = OrderedDict()     # session_id -> deque of tickets, in serving order
+        self.waiting = 0
+        self.avg_seconds = 10.0         # Moving average of slot hold time, for Retry-After
+
+    def retry_after(self):
+        return self.avg_seconds * (self.waiting + 1) / self.slots
+
+    def submit(self, session_id):
+        """Take a ticket, granted immediately if a slot is free. Raises SchedulerOverloaded."""
+        ticket = GenerationTicket(session_id)
+        with self.lock:
+            if self.free > 0 and self.waiting == 0:
+                self.free -= 1
+                ticket._grant()
+                return ticket
+            if self.waiting >= self.max_waiting:
+                raise SchedulerOverloaded("Mikasa is busy right now.", self.retry_after())
+            session_queue = self.queues.setdefault(session_id, deque())
+            if len(session_queue) >= self.max_per_session:
+                raise SchedulerOverloaded("You already have replies waiting.", self.retry_after())
+            session_queue.append(ticket)
+            self.waiting += 1
+            return ticket
+
+    def position(self, ticket):
+        """1-based place in line in serving order, 0 once granted."""
+        with self.lock:
+            if ticket.granted or ticket.released:
+                return 0
+            queues = list(self.queues.values())
+            place = 0
+            for depth in range(max(len(q) for q in queues)):
+                for session_queue in queues:
+                    if depth < len(session_queue):
+                        place += 1
+                        if session_queue[depth] is ticket:
+                            return place
+            return 0
+
+    def release(self, ticket):
+        """Give back a granted slot, or leave the queue. Safe to call more than once."""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if not ticket.granted:
+                session_queue = self.queues.get(ticket.session_id)
+                if session_queue and ticket in session_queue:
+                    session_queue.remove(ticket)
+                    self.waiting -= 1
+                    if not session_queue:
+                        del self.queues[ticket.session_id]
+                return
+
+            held = time.monotonic() - ticket.granted_at
+            self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * held
+            if self.queues:
+                # Serve the session at the front, then send it to the back of the rotation
+                session_id, session_queue = self.queues.popitem(last=False)
+                next_ticket = session_queue.popleft()
+                if session_queue:
+                    self.queues[session_id] = session_queue
+                self.waiting -= 1
+                next_ticket._grant()
+            else:
+                self.free += 1
+
+class CircuitBreaker:
+    """Fail fast while Ollama is down, then let a single trial request through.
+
+    The trial ends with record_success or record_failure; one that never got an
+    answer from Ollama (refused or cancelled) is called off with end_trial.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.lock = threading.Lock()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = None               # token of the trial request in flight
+
+    def check(self):
+        """Raise SchedulerOverloaded (503) while the circuit is open.
+
+        Returns a trial token when the caller is the trial request, otherwise None.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return None
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self.trial is not None:
+                raise SchedulerOverloaded("Mikasa's model is not responding.", max(remaining, 1), status=503)
+            self.trial = object()
+            return self.trial
+
+    def end_trial(self, trial):
+        """Call off a trial that got no answer either way, so the next request becomes the trial."""
+        with self.lock:
+            if trial is not None and self.trial is trial:
+                self.trial = None
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = None
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+generation_scheduler = FairScheduler(LLM_CONCURRENCY, QUEUE_MAX_WAITING, QUEUE_MAX_PER_SESSION)
+ollama_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+
+def submit_generation(session_id):
+    """Get a generation ticket, failing fast if the circuit is open or the queue is full.
+
+    This is the only breaker check: a granted ticket may call Ollama, and reports
+    the outcome with record_success or record_failure. Give it back with
+    release_generation.
+    """
+    trial = ollama_breaker.check()
+    try:
+        ticket = generation_scheduler.submit(session_id)
+    except SchedulerOverloaded:
+        ollama_breaker.end_trial(trial)
+        raise
+    ticket.breaker_trial = trial
+    return ticket
+
+def release_generation(ticket):
+    """Give back a ticket's slot, calling off its breaker trial if Ollama never answered it."""
+    generation_scheduler.release(ticket)
+    ollama_breaker.end_trial(ticket.breaker_trial)
+
+# Cancellation. Each session has at most one chat turn generating: a newer
+# message supersedes it, and /stop_generation or a client disconnect stops it.
+# The handler's task is cancelled, so even a turn waiting in the queue or in
+# prefill stops at once. Closing the response stream is what makes Ollama stop
+# generating.
+GENERATIONS_CANCELLED = Counter("mikasa_generations_cancelled_total", "Chat turns stopped before the reply was complete.",
+                                ("reason",))
+
+class GenerationCancelled(Exception):
+    """Raised in a handler whose generation was stopped."""
+
+    def __init__(self, reason):
+        super().__init__(f"generation cancelled ({reason})")
+        self.reason = reason
+
+class ActiveGeneration:
+    """Handle on one chat turn, used to stop it early."""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.lock = threading.Lock()
+        self.reason = None          # why it was cancelled, None while running
+        self.done = False
+        self._task = None           # (loop, task) of an async handler
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def check(self):
+        """Raise GenerationCancelled if the turn was stopped."""
+        if self.reason is not None:
+            raise GenerationCancelled(self.reason)
+
+    def attach_task(self):
+        """Let cancel() interrupt the calling async handler, whatever it is awaiting."""
+        with self.lock:
+            self._task = (asyncio.get_running_loop(), asyncio.current_task())
+
+    def cancel(self, reason):
+        """Ask the turn to stop. Returns False if it already finished or was stopped."""
+        with self.lock:
+            if self.done or self.reason is not None:
+                return False
+            self.reason = reason
+            task = self._task
+        if task is not None:
+            loop, handler = task
+            loop.call_soon_threadsafe(self._cancel_task, handler)
+        return True
+
+    def _cancel_task(self, handler):
+        # Runs on the handler's loop, so it cannot land after finish()
+        if not self.done:
+            handler.cancel()
+
+    def finish(self):
+        with self.lock:
+            self.done = True
+            self._task = None
+
+class ActiveGenerations:
+    """The chat turn in progress for each session."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def start(self, session_id):
+        """Register a new turn, cancelling the session's previous one."""
+        generation = ActiveGeneration(session_id)
+        with self.lock:
+            previous = self.sessions.get(session_id)
+            self.sessions[session_id] = generation
+        if previous is not None:
+            previous.cancel("superseded")
+        return generation
+
+    def finish(self, generation):
+        generation.finish()
+        with self.lock:
+            if self.sessions.get(generation.session_id) is generation:
+                del self.sessions[generation.session_id]
+
+    def cancel(self, session_id, reason="stopped"):
+        """Stop the session's turn in progress. Returns False if there was none."""
+        with self.lock:
+            generation = self.sessions.get(session_id)
+        return generation is not None and generation.cancel(reason)
+
+active_generations = ActiveGenerations()
+
+def backoff_delay(attempt):
+    """Exponential backoff with jitter for retry number `attempt` (0-based)."""
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def record_llm_error(call, attempt, retries, error, streamed=False):
+    """Count and log a failed Ollama attempt; a retry follows unless this was the last one."""
+    ERRORS.inc(kind="llm")
+    retrying = attempt < retries - 1 and not streamed
+    if retrying:
+        LLM_RETRIES.inc(call=call)
+    log_event("llm_error", logging.WARNING, call=call, attempt=attempt + 1, retrying=retrying, error=str(error))
+
+# Model routing
+ROUTER_HEAVY_PATTERN = re.compile(r"\b(" + "|".join(re.escape(word) for word in ROUTER_HEAVY_KEYWORDS) + r")\b",
+                                  re.IGNORECASE)
+CODE_PATTERN = re.compile(r"```|`[^`\n]+`|^\s*(def|class|import|from|return|SELECT|INSERT|UPDATE)\b|[{};]\s*$|=>|</?[a-z]+>",
+                          re.MULTILINE)
+
+# Models Ollama answered 404 for, by time.monotonic() of the last 404
+_missing_models = {}
+
+def mark_model_missing(model):
+    _missing_models[model] = time.monotonic()
+    warmup_status["models"][model] = "missing"
+
+def mark_model_loaded(model):
+    _missing_models.pop(model, None)
+    warmup_status["models"][model] = "loaded"
+
+def model_available(model):
+    """False for a model reported missing less than MODEL_MISSING_COOLDOWN seconds ago."""
+    missing_at = _missing_models.get(model)
+    return missing_at is None or time.monotonic() - missing_at >= MODEL_MISSING_COOLDOWN
+
+def choose_model(user_message, mode, messages):
+    """Pick the model for a turn. Returns (model, reason)."""
+    if not SMALL_MODEL_NAME or SMALL_MODEL_NAME == MODEL_NAME:
+        return MODEL_NAME, "single_model"
+    # While one model is missing every turn goes to the other
+    if not model_available(SMALL_MODEL_NAME):
+        return MODEL_NAME, "small_missing"
+    if not model_available(MODEL_NAME):
+        return SMALL_MODEL_NAME, "large_missing"
+    if mode.lower() not in ROUTER_SMALL_MODES:
+        return MODEL_NAME, "mode"
+    if count_tokens(user_message) > ROUTER_SMALL_MAX_TOKENS:
+        return MODEL_NAME, "length"
+    if CODE_PATTERN.search(user_message):
+        return MODEL_NAME, "code"
+    if ROUTER_HEAVY_PATTERN.search(user_message):
+        return MODEL_NAME, "keyword"
+    if sum(count_tokens(message['content']) for message in messages) > ROUTER_SMALL_MAX_PROMPT_TOKENS:
+        return MODEL_NAME, "prompt_length"
+    return SMALL_MODEL_NAME, "short"
+
+def route_model(user_message, mode, messages):
+    """choose_model, with the decision counted and added to the request's timing log."""
+    model, reason = choose_model(user_message, mode, messages)
+    MODEL_ROUTES.inc(model=model, reason=reason)
+    timer = _request_timer.get()
+    if timer is not None:
+        timer.fields.update(model=model, route_reason=reason)
+    return model
+
+def keep_alive_for(model):
+    return SMALL_MODEL_KEEP_ALIVE if model == SMALL_MODEL_NAME and model != MODEL_NAME else OLLAMA_KEEP_ALIVE
+
+def model_attempts(model, retries):
+    """Yield (attempt, model, delay before it) for each try of a generation.
+
+    A failure moves straight on to the other model; once both have been tried the
+    attempts keep alternating, with exponential backoff between them. A model
+    reported missing is left out while its cooldown lasts.
+    """
+    candidates = [model]
+    if SMALL_MODEL_NAME and SMALL_MODEL_NAME != MODEL_NAME:
+        candidates.append(SMALL_MODEL_NAME if model == MODEL_NAME else MODEL_NAME)
+    candidates = [candidate for candidate in candidates if model_available(candidate)] or [model]
+    for attempt in range(retries):
+        attempt_model = candidates[attempt % len(candidates)]
+        delay = backoff_delay(attempt - len(candidates)) if attempt >= len(candidates) else 0
+        if attempt_model != model:
+            MODEL_FALLBACKS.inc(requested=model, used=attempt_model)
+            timer = _request_timer.get()
+            if timer is not None:
+                timer.fields["fallback_model"] = attempt_model
+        yield attempt, attempt_model, delay
+
+# Rolling conversation summary
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+_summary_pending = set()
+_summary_lock = threading.Lock()
+
+def get_session_summary(session_id):
+    """Return (summary, last_message_id) for a session."""
+    cached = session_cache.get(session_id, "summary")
+    if cached is not None:
+        return cached
+    try:
+        with db_connection(session_shard(session_id).chat_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT summary, last_message_id FROM session_summary WHERE session_id = ?", (session_id,))
+            result = cursor.fetchone()
+        result = tuple(result) if result else ("", 0)
+        session_cache.set(session_id, "summary", result)
+        return result
+    except Exception as e:
+        print(f"Error reading session summary: {str(e)}")
+        return ("", 0)
+
+def refresh_session_summary(session_id, before_id):
+    """Fold messages older than before_id into the session's summary."""
+    try:
+        summary, last_message_id = get_session_summary(session_id)
+        shard = session_shard(session_id)
+        shard.history_writer.flush()
+        with db_connection(shard.chat_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, message FROM temp_memory
+                WHERE session_id = ? AND id > ? AND id < ?
+                ORDER BY id ASC
+                LIMIT 200
+            """, (session_id, last_message_id, before_id))
+            rows = cursor.fetchall()
+        if not rows:
+            return
+
+        transcript = truncate_to_tokens("\n".join(message for _, message in rows), CONTEXT_WINDOW // 2)
+        prompt = (
+            f"Update the summary of an earlier conversation between Charan and Mikasa. "
+            f"Keep names, facts, decisions and open tasks. Stay under {CONTEXT_BUDGETS['summary'] * 3 // 4} words. "
+            f"Reply with the summary only.\n\n"
+            f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"
+        )
+        if not model_available(MODEL_NAME):
+            return
+        # Background work queues like any other session; skipped if the model is overloaded
+        ticket = submit_generation(f"summary:{session_id}")
+        try:
+            ticket.wait()
+            try:
+                response = ollama.chat(model=MODEL_NAME, messages=[{'role': 'user', 'content': prompt}],
+                                       keep_alive=OLLAMA_KEEP_ALIVE, options={'num_ctx': CONTEXT_WINDOW})
+            except Exception:
+                ollama_breaker.record_failure()
+                raise
+            ollama_breaker.record_success()
+        finally:
+            release_generation(ticket)
+        new_summary = truncate_to_tokens(response.get('message', {}).get('content', '').strip(), CONTEXT_BUDGETS["summary"])
+        if not new_summary:
+            return
+
+        with db_connection(shard.chat_path) as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO session_summary (session_id, summary, last_message_id, updated_at)
+                VALUES (?, ?, ?, ?)
+            """, (session_id, new_summary, rows[-1][0], monotonic_timestamp()))
+        session_cache.set(session_id, "summary", (new_summary, rows[-1][0]))
+    except Exception as e:
+        print(f"Error refreshing session summary: {str(e)}")
+    finally:
+        with _summary_lock:
+            _summary_pending.discard(session_id)
+
+def schedule_summary_refresh(session_id, before_id):
+    """Queue a background summary refresh unless one is already pending for the session."""
+    with _summary_lock:
+        if session_id in _summary_pending:
+            return
+        _summary_pending.add(session_id)
+    _summary_executor.submit(refresh_session_summary, session_id, before_id)
+
+# Assemble the chat request within the token budgets
+def build_messages(session_id, user_message, mode="assistant"):
+    """Return (messages, source_name) for the session's next reply.
+
+    History is every turn since the rolling summary. When it outgrows its budget the
+    window start jumps forward to leave half the budget free, and the turns left behind
+    are folded into the summary in the background.
+    """
+    if mode.lower() == "mikasa":
+        system_prompt, source_name = get_mikasa_prompt(), "Mikasa"
+    else:  # Default to assistant mode
+        system_prompt, source_name = get_assistant_prompt(), "Assistant"
+
+    # Get datetime info only when needed
+    datetime_info = get_current_datetime() if re.search(r'\b(time|date|day|today|now)\b', user_message.lower()) else None
+    user_message = truncate_to_tokens(user_message, CONTEXT_BUDGETS["message"])
+    with timed("memory_search"):
+        user_memory = retrieve_relevant_memory(session_owner(session_id), user_message,
+                                               max_tokens=CONTEXT_BUDGETS["memory"])
+    summary, last_message_id = get_session_summary(session_id)
+
+    # The current message is stored only once it has a generation ticket, so
+    # every row here is an earlier turn
+    rows = retrieve_history_since(session_id, last_message_id)
+
+    # The window start only moves forward, in one jump when the history budget is
+    # exceeded, so the prompt prefix stays the same for many turns in a row. It is
+    # kept with the session's cached state and starts over if that is evicted.
+    anchor = session_cache.get(session_id, "anchor") or 0
+    window = [row for row in rows if row[0] >= anchor]
+    if sum(count_tokens(row[2]) for row in window) > CONTEXT_BUDGETS["history"]:
+        kept, used = [], 0
+        for row in reversed(window):
+            tokens = count_tokens(row[2])
+            if kept and used + tokens > CONTEXT_BUDGETS["history"] // 2:
+                break
+            kept.append(row)
+            used += tokens
+        window = kept[::-1]
+        anchor = window[0][0]
+        session_cache.set(session_id, "anchor", anchor)
+
+    # Any turn that fell out of the window and is not in the summary yet is
+    # folded in, however few there are, so no turn is left out of the prompt
+    if rows and rows[0][0] < anchor:
+        schedule_summary_refresh(session_id, anchor)
+
+    history = [(role, truncate_to_tokens(message, CONTEXT_BUDGETS["history"])) for _, role, message in window]
+    messages = assemble_messages(system_prompt, summary, history, user_message, user_memory, datetime_info)
+    return messages, source_name
+
+# Format one Server-Sent Events message
+def sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+# ---------------------------------------------------------------------------
+# Startup warm-up. A background thread fills the connection pools, reads the
+# most recent sessions into the session cache, asks Ollama to load the models
+# and brings the memory index up to date, so the first chat after a restart
+# doesn't pay for any of it. /readyz reports ready once the large model is in.
+# ---------------------------------------------------------------------------
+warmup_status = {"started": None, "finished": None, "db_primed": False, "memory_index": "pending", "models": {}}
+_background_started = threading.Event()
+
+def prime_databases():
+    """Open every shard's pooled connections and load the most recently active sessions."""
+    recent = []
+    for shard in all_shards():
+        with ExitStack() as stack:
+            for path in (shard.memory_path, shard.chat_path):
+                for _ in range(DB_POOL_SIZE):
+                    stack.enter_context(db_connection(path))
+        with db_connection(shard.chat_path) as conn:
+            # Newest messages first, straight off the primary key
+            recent += conn.execute("""
+                SELECT timestamp, session_id FROM temp_memory ORDER BY id DESC LIMIT ?
+            """, (WARMUP_SESSIONS * SESSION_CACHE_TURNS,)).fetchall()
+    recent.sort(reverse=True)
+    sessions = list(dict.fromkeys(session_id for _, session_id in recent))[:WARMUP_SESSIONS]
+    for session_id in reversed(sessions):  # most recent last, so it ends up freshest in the LRU
+        get_session_mode(session_id)
+        get_session_summary(session_id)
+        retrieve_history_since(session_id)
+    warmup_status["db_primed"] = True
+    return len(sessions)
+
+def preload_model(model, deadline):
+    """Have Ollama load a model with the context size chat requests use. Returns True once loaded."""
+    attempt = 0
+    while time.monotonic() < deadline and not _maintenance_stop.is_set():
+        warmup_status["models"][model] = "loading"
+        ticket = None
+        try:
+            ticket = submit_generation("warmup")
+            ticket.wait(max(0, deadline - time.monotonic()))
+            started = time.perf_counter()
+            # Same system prompt and num_ctx as a chat turn: a different num_ctx reloads the model
+            ollama.chat(model=model, messages=[{"role": "system", "content": get_assistant_prompt()}],
+                        keep_alive=keep_alive_for(model), options={'num_ctx': CONTEXT_WINDOW, 'num_predict': 1})
+            ollama_breaker.record_success()
+            mark_model_loaded(model)
+            log_event("model_loaded", model=model, seconds=round(time.perf_counter() - started, 3))
+            return True
+        except Exception as e:
+            if getattr(e, "status_code", None) == 404:
+                mark_model_missing(model)
+                log_event("model_missing", logging.WARNING, model=model, error=str(e))
+                return False
+            warmup_status["models"][model] = "error"
+            if not isinstance(e, SchedulerOverloaded):
+                ollama_breaker.record_failure()
+            record_llm_error("warmup", attempt, attempt + 2, e)
+        finally:
+            if ticket is not None:
+                release_generation(ticket)
+        _maintenance_stop.wait(backoff_delay(attempt))
+        attempt += 1
+    return False
+
+def warm_up():
+    """Prime SQLite, load the models and sync the memory index."""
+    warmup_status["started"] = time.time()
+    started = time.perf_counter()
+    fields = {}
+    try:
+        fields["sessions_primed"] = prime_databases()
+    except Exception as e:
+        ERRORS.inc(kind="warmup")
+        fields["db_error"] = str(e)
+
+    deadline = time.monotonic() + WARMUP_TIMEOUT
+    models = [MODEL_NAME] + ([SMALL_MODEL_NAME] if SMALL_MODEL_NAME and SMALL_MODEL_NAME != MODEL_NAME else [])
+    for model in models:
+        warmup_status["models"][model] = "pending"
+    for model in models:
+        preload_model(model, deadline)
+
+    try:
+        # Also loads the embedding model, since the first search embeds the query
+        for shard in all_shards():
+            shard.memory_index.sync()
+        if EMBED_BACKEND == "ollama":
+            embed_texts(["warm-up"])
+        warmup_status["memory_index"] = "synced"
+    except Exception as e:
+        ERRORS.inc(kind="warmup")
+        warmup_status["memory_index"] = "error"
+        fields["memory_index_error"] = str(e)
+
+    warmup_status["finished"] = time.time()
+    log_event("warmup", logging.WARNING if "db_error" in fields or "memory_index_error" in fields else logging.INFO,
+              seconds=round(time.perf_counter() - started, 3), models=warmup_status["models"], **fields)
+
+def start_background_jobs():
+    """Start warm-up and the maintenance job, once per process."""
+    if _background_started.is_set():
+        return
+    _background_started.set()
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+    start_maintenance()
+
+def readiness():
+    """(ready, details) for /readyz: databases reachable, large model loaded, circuit closed."""
+    details = {"models": dict(warmup_status["models"]), "memory_index": warmup_status["memory_index"],
+               "circuit_open": ollama_breaker.opened_at is not None, "databases": {}}
+    databases_ok = True
+    for name, path_of in (("memory", lambda shard: shard.memory_path), ("chat", lambda shard: shard.chat_path)):
+        # Row counts are summed over the shards
+        try:
+            rows = {}
+            for shard in all_shards():
+                for table, count in table_row_counts(path_of(shard)).items():
+                    rows[table] = rows.get(table, 0) + count
+            details["databases"][name] = {"ok": True, "rows": rows}
+        except Exception as e:
+            databases_ok = False
+            details["databases"][name] = {"ok": False, "error": str(e)}
+    details["shards"] = len(shard_router.shard_numbers())
+    ready = databases_ok and details["models"].get(MODEL_NAME) == "loaded" and not details["circuit_open"]
+    return ready, details
+
+Gauge("mikasa_ready", "1 once the databases answer and the large model is loaded.", lambda: readiness()[0])
+
+# Every request acts for one user, named by the trusted proxy's X-User-Id header
+# (DEFAULT_USER without it, see authenticate_user). Handlers turn the client's
+# session_id into that user's session key. Probes and metrics hold no user data.
+UNAUTHENTICATED_ENDPOINTS = {"healthz", "readyz", "metrics"}
+
+@app.before_request
+def identify_user():
+    if request.endpoint in UNAUTHENTICATED_ENDPOINTS:
+        return None
+    g.user, error, status = authenticate_user(request.headers.get('X-User-Id', ''),
+                                              request.headers.get('X-Proxy-Secret', ''))
+    if error:
+        return jsonify({'error': error}), status
+
+@app.route('/store_message', methods=['POST'])
+def store_message():
+    data = request.json
+    session_id = data.get('session_id')
+    message = data.get('message')
+    prefix = data.get('prefix', '')
+    
+    if not session_id or not message:
+        return jsonify({'error': 'Missing session_id or message'}), 400
+    
+    success = store_temp_memory(session_key(g.user, session_id), message, prefix)
+    return jsonify({'success': success})
+
+@app.route('/get_chat_history', methods=['GET'])
+def get_chat_history():
+    session_id = request.args.get('session_id')
+    if not session_id:
+        return jsonify({'error': 'Missing session_id'}), 400
+    
+    history = retrieve_temp_memory(session_key(g.user, session_id))
+    return jsonify({'history': history})
+
+# JSON response with a weak ETag (304 if the client already has it), gzipped when accepted
+def cacheable_json_response(payload):
+    body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+        if len(body) >= HISTORY_GZIP_MIN_BYTES and "gzip" in request.headers.get("Accept-Encoding", ""):
+            response.set_data(gzip.compress(body, compresslevel=5))
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+@app.route('/history', methods=['GET'])
+def history():
+    """Chat history as structured messages, a page at a time.
+
+    ?since=<id> returns what came after that id, oldest first, to catch up;
+    ?before=<id> the page before that id, to scroll back; neither, the latest
+    page. has_more says whether another page follows in that direction, and
+    latest_id is the session's newest id. Ids are never reused. epoch changes
+    whenever any of the user's messages are deleted, so a client whose copy was
+    fetched under another epoch must drop it and start over. Timestamps are
+    Unix milliseconds.
+    """
+    session_id = request.args.get('session_id', 'default')
+    before = request.args.get('before', type=int)
+    since = request.args.get('since', type=int)
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_PAGE_MAX)
+    
+    if before is not None and since is not None:
+        return jsonify({'error': 'Use either before or since, not both'}), 400
+    
+    rows, has_more, latest_id, epoch = retrieve_history_page(session_key(g.user, session_id), before, since, limit)
+    return cacheable_json_response({
+        'session_id': session_id,
+        'messages': [{'id': message_id, 'role': role, 'message': message, 'timestamp': timestamp // 1000}
+                     for message_id, role, message, timestamp in rows],
+        'has_more': has_more,
+        'latest_id': latest_id,
+        'epoch': epoch,
+    })
+
+# Bulk routes only ever touch the caller's own data; exporting or importing
+# every user at once is left to the command line options
+@app.route('/export/memory', methods=['GET'])
+def export_memory_route():
+    return Response(export_memory(g.user), mimetype="application/x-ndjson",
+                    headers={"Content-Disposition": 'attachment; filename="memory.ndjson"'})
+
+@app.route('/export/history', methods=['GET'])
+def export_history_route():
+    session_id = request.args.get('session_id')
+    return Response(export_history(session_id, g.user), mimetype="application/x-ndjson",
+                    headers={"Content-Disposition": 'attachment; filename="chat_history.ndjson"'})
+
+@app.route('/import/memory', methods=['POST'])
+def import_memory_route():
+    # Read the body line by line as it arrives, never all at once
+    lines = (line.decode("utf-8", "replace") for line in request.stream)
+    imported, skipped = import_memory(lines, owner=g.user)
+    return jsonify({'imported': imported, 'skipped': skipped})
+
+@app.route('/import/history', methods=['POST'])
+def import_history_route():
+    lines = (line.decode("utf-8", "replace") for line in request.stream)
+    imported, skipped = import_history(lines, owner=g.user)
+    return jsonify({'imported': imported, 'skipped': skipped})
+
+@app.route('/clear_chat', methods=['POST'])
+def clear_chat():
+    data = request.json
+    session_id = data.get('session_id')
+    
+    # Without a session_id, every session of the user
+    success = delete_temp_memory(session_key(g.user, session_id) if session_id else None, g.user)
+    return jsonify({'success': success})
+
+@app.route('/search_memory', methods=['GET'])
+def search_memory_route():
+    keyword = request.args.get('q', '').strip()
+    limit = request.args.get('limit', 20, type=int)
+    
+    if not keyword:
+        return jsonify({'error': 'Missing q'}), 400
+    
+    matches = search_memory(g.user, keyword, min(max(limit, 1), 100))
+    return jsonify({'results': [{'id': memory_id, 'data': data} for memory_id, data in matches]})
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(reply_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/")
+def home():
+    return render_template("index.html")
+
+@app.route('/delete_recent', methods=['POST'])
+def delete_recent():
+    data = request.json
+    session_id = data.get('session_id')
+    
+    if not session_id:
+        return jsonify({'error': 'Missing session_id'}), 400
+    
+    success = delete_recent_temp_memory(session_key(g.user, session_id))
+    return jsonify({'success': success})
+
+@app.route('/stop_generation', methods=['POST'])
+def stop_generation():
+    data = request.json or {}
+    session_id = data.get('session_id', 'default')
+    
+    stopped = active_generations.cancel(session_key(g.user, session_id), "stopped")
+    return jsonify({'stopped': stopped})
+
+@app.route('/set_mode', methods=['POST'])
+def set_mode():
+    data = request.json
+    session_id = data.get('session_id')
+    mode = data.get('mode', 'assistant').lower()
+    
+    if not session_id:
+        return jsonify({'error': 'Missing session_id'}), 400
+    
+    # Validate mode
+    if mode not in ['assistant', 'mikasa']:
+        return jsonify({'error': 'Invalid mode. Must be "assistant" or "mikasa"'}), 400
+    
+    session_id = session_key(g.user, session_id)
+    success = set_session_mode(session_id, mode)
+    
+    if success:
+        # Store mode change in chat history
+        store_temp_memory(session_id, f"Mode changed to: {mode.capitalize()}", "System")
+        return jsonify({'success': True, 'mode': mode})
+    else:
+        return jsonify({'error': 'Failed to set mode'}), 500
+
+@app.route('/get_mode', methods=['GET'])
+def get_mode():
+    session_id = request.args.get('session_id')
+    
+    if not session_id:
+        return jsonify({'error': 'Missing session_id'}), 400
+    
+    mode = get_session_mode(session_key(g.user, session_id))
+    return jsonify({'mode': mode})
+
+@app.route("/healthz")
+def healthz():
+    """Liveness: the process is up and serving requests. Touches nothing else."""
+    return jsonify({"status": "ok"})
+
+@app.route("/readyz")
+def readyz():
+    """Readiness: 200 once the instance can answer chats quickly, 503 until then."""
+    ready, details = readiness()
+    return jsonify({"status": "ready" if ready else "warming_up", **details}), 200 if ready else 503
+
+# Handle mode, time/date and memory commands
+# Built-in commands in the order they are tried; the first match wins
+CHAT_COMMANDS = [(name, re.compile(pattern, re.IGNORECASE)) for name, pattern in (
+    ("mikasa mode", r"^mikasa mode\Z"),
+    ("assistant mode", r"^assistant mode\Z"),
+    ("time", r"\b(what|tell).*\b(time|date|day|today)\b"),
+    ("remember", r"remember that"),
+    ("remove", r"remove that"),
+    ("update", r"update that"),
+    ("search", r"^search memory\b"),
+    ("del chat", r"^del chat\Z"),
+    ("del prev", r"^del prev\Z"),
+)]
+
+def match_command(user_message):
+    """Return the name of the built-in command the message is, or None if it needs the LLM."""
+    for name, pattern in CHAT_COMMANDS:
+        if pattern.search(user_message):
+            return name
+    return None
+
+def handle_chat_command(session_id, user_message, current_mode, command=None):
+    """Return the reply for a built-in command, or None if the message needs the LLM.
+
+    command is what match_command found, when the caller already asked it.
+    """
+    command = command or match_command(user_message)
+    user = session_owner(session_id)
+    # Check for mode change commands
+    if command == "mikasa mode":
+        set_session_mode(session_id, "mikasa")
+        response = "✅ Mikasa is On now ~blink~"
+        store_temp_memory(session_id, response, "System")
+        return response
+    elif command == "assistant mode":
+        set_session_mode(session_id, "assistant")
+        response = "✅ Switched to Assistant mode."
+        store_temp_memory(session_id, response, "System")
+        return response
+
+    # Check for time/date requests
+    if command == "time":
+        datetime_info = get_current_datetime()
+        
+        if re.search(r'\btime\b', user_message.lower()):
+            response = f"The current time is {datetime_info['time']}."
+        elif re.search(r'\b(date|day|today)\b', user_message.lower()):
+            response = f"Today is {datetime_info['date']}."
+        else:
+            response = f"It's currently {datetime_info['full']}."
+            
+        # Format response based on current mode
+        if current_mode.lower() == "mikasa":
+            response = f"~I check my watch and look up at you.~\n{response} Why, do you have somewhere to be? 😏"
+        else:
+            response = f"⏰ {response}"
+            
+        store_temp_memory(session_id, response, current_mode.capitalize())
+        return response
+
+    # Handle Memory Commands
+    if command == "remember":
+        memory_text = user_message.replace("remember that", "").strip()
+        success = store_memory(user, memory_text)
+        response = "Alright, Charan. I've saved that for you. 💾" if success else "Hmm... something went wrong while saving it. Want me to try again? 🥺"
+        store_temp_memory(session_id, response, current_mode.capitalize())
+        return response
+    
+    elif command == "remove":
+        keyword = user_message.replace("remove that", "").strip()
+        # Several matches are only listed; "remove that all ..." confirms
+        remove_all = re.match(r"all\s+", keyword, re.IGNORECASE)
+        if remove_all:
+            keyword = keyword[remove_all.end():]
+        matches = [] if remove_all else search_memory(user, keyword, limit=-1, prefix=False)
+        removed = remove_memory(user, keyword) if remove_all or len(matches) == 1 else []
+        if len(matches) > 1:
+            response = (f"I found {len(matches)} memories with that, Charan. Say 'remove that all {keyword}' "
+                        "to delete them all, or tell me more so I pick the right one. 🧐\n"
+                        + format_memory_preview([data for _, data in matches]))
+        elif removed:
+            response = f"All done, Charan. I've cleared {len(removed)} memories for you. 🗑️\n" + format_memory_preview([data for _, data in removed])
+        else:
+            response = "Hmm... I couldn't find any matching memories to delete. 🧐"
+        store_temp_memory(session_id, response, current_mode.capitalize())
+        return response
+    
+    elif command == "update":
+        match = re.search(r"update that (.+) to (.+)", user_message, re.IGNORECASE)
+        if match:
+            old_data, new_data = match.groups()
+            previous = update_memory(user, old_data.strip(), new_data.strip())
+            if previous is not None:
+                response = f"✅ Memory updated successfully!\n- {previous} → {new_data.strip()}"
+            else:
+                response = "Hmm... I couldn't find a matching memory to update. 🧐"
+            store_temp_memory(session_id, response, current_mode.capitalize())
+            return response
+        else:
+            response = "⚠️ Please use 'update that [old data] to [new data]' format."
+            store_temp_memory(session_id, response, current_mode.capitalize())
+            return response
+
+    elif command == "search":
+        keyword = user_message[len("search memory"):].strip()
+        matches = search_memory(user, keyword)
+        if matches:
+            response = f"🔎 Found {len(matches)} matching memories:\n" + format_memory_preview([data for _, data in matches], limit=10)
+        else:
+            response = "Hmm... nothing in my memory matches that. 🧐"
+        store_temp_memory(session_id, response, current_mode.capitalize())
+        return response
+    
+    elif command == "del chat":
+        if delete_temp_memory(session_id):  # Delete specific session
+            return "🧹 All set, Charan. I've wiped the temporary memory like you asked."
+        else:
+            return "😕 Something went wrong while clearing it... want me to try again?"
+    
+    elif command == "del prev":
+        if delete_recent_temp_memory(session_id):  # Delete recent entries
+            return ""  # Return an empty reply
+        else:
+            response = "⚠️ Error deleting recent chat entries."
+            store_temp_memory(session_id, response, current_mode.capitalize())
+            return response
+
+    return None
+
+# Reply cache
+class ReplyCache:
+    """LRU + TTL cache of replies, optionally persisted to chat_memory.db.
+
+    Keys cover the user, the normalised message, the mode, the model and a hash of the
+    volatile context sent with it (relevant memory, time), so a changed context is a
+    miss and users never see each other's replies. Any change to a user's long-term
+    memory also drops that user's entries.
+    """
+
+    def __init__(self, max_entries, ttl, persist):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> (reply, source, expires_at, user)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist = persist
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+
+    @staticmethod
+    def make_key(user, user_message, mode, messages, model=MODEL_NAME):
+        normalized = re.sub(r"\s+", " ", user_message.lower()).strip().rstrip("?!.")
+        # The last turn is the user's message followed by the context section
+        context = messages[-1]['content'].rpartition("\n\n---\n")[2]
+        context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()
+        return hashlib.sha256(json.dumps([user, normalized, mode.lower(), context_hash, model]).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return (reply, source) or None."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[2] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], entry[1]
+            self.entries.pop(key, None)
+
+        if self.persist:
+            try:
+                with db_connection(TEMP_DB_PATH) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT reply, source, expires_at, user FROM reply_cache WHERE cache_key = ? AND expires_at > ?
+                    """, (key, int(now)))
+                    row = cursor.fetchone()
+                if row:
+                    self._remember(key, *row)
+                    with self.lock:
+                        self.hits += 1
+                    return row[0], row[1]
+            except Exception as e:
+                print(f"Error reading reply cache: {str(e)}")
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key, reply, source, expires_at, user):
+        with self.lock:
+            self.entries[key] = (reply, source, expires_at, user)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put(self, key, reply, source, user):
+        expires_at = int(time.time() + self.ttl)
+        self._remember(key, reply, source, expires_at, user)
+        if not self.persist:
+            return
+        try:
+            with db_connection(TEMP_DB_PATH) as conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO reply_cache (cache_key, reply, source, expires_at, user) VALUES (?, ?, ?, ?, ?)
+                """, (key, reply, source, expires_at, user))
+                with self.lock:
+                    self.puts += 1
+                    prune = self.puts % 64 == 0
+                if prune:
+                    conn.execute("DELETE FROM reply_cache WHERE expires_at <= ?", (int(time.time()),))
+                    conn.execute("""
+                        DELETE FROM reply_cache WHERE cache_key NOT IN (
+                            SELECT cache_key FROM reply_cache ORDER BY expires_at DESC LIMIT ?
+                        )
+                    """, (self.max_entries * 4,))
+        except Exception as e:
+            print(f"Error writing reply cache: {str(e)}")
+
+    def invalidate(self, user=None):
+        """Drop the cached replies of one user, or of everyone when user is None."""
+        with self.lock:
+            if user is None:
+                self.entries.clear()
+            else:
+                for key in [key for key, entry in self.entries.items() if entry[3] == user]:
+                    del self.entries[key]
+        if not self.persist:
+            return
+        try:
+            with db_connection(TEMP_DB_PATH) as conn:
+                if user is None:
+                    conn.execute("DELETE FROM reply_cache")
+                else:
+                    conn.execute("DELETE FROM reply_cache WHERE user = ?", (user,))
+        except Exception as e:
+            print(f"Error clearing reply cache: {str(e)}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"enabled": REPLY_CACHE_ENABLED, "entries": len(self.entries), "hits": self.hits,
+                    "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0}
+
+reply_cache = ReplyCache(REPLY_CACHE_MAX_ENTRIES, REPLY_CACHE_TTL, REPLY_CACHE_PERSIST)
+
+def reply_cache_key(session_id, user_message, source_name, messages, model=MODEL_NAME):
+    """Cache key for this turn, or None when caching is off for its mode."""
+    mode = "mikasa" if source_name == "Mikasa" else "assistant"
+    if not REPLY_CACHE_ENABLED or mode not in REPLY_CACHE_MODES:
+        return None
+    return ReplyCache.make_key(session_owner(session_id), user_message, mode, messages, model)
+
+# ---------------------------------------------------------------------------
+# Request coalescing. Concurrent copies of the same chat request (a double
+# submit, or a client retrying while the first copy still runs) share one
+# turn: the first copy answers it and the others wait for its result, so the
+# message is stored and generated once. Copies match on session, message and
+# the Idempotency-Key header; a retry with the same key that arrives shortly
+# after the reply was sent gets that reply again.
+# ---------------------------------------------------------------------------
+COALESCED_REQUESTS = Counter("mikasa_coalesced_requests_total", "Duplicate chat requests answered by another copy.",
+                             ("route",))
+
+def chat_result(reply, source="System", status=200, cancelled=False, retry_after=None):
+    """Outcome of a chat turn, as shared with duplicates of the request."""
+    return {"reply": reply, "source": source, "status": status, "cancelled": cancelled, "retry_after": retry_after}
+
+def overloaded_result(error):
+    return chat_result(f"⚠️ {str(error)} Please try again in {error.retry_after} seconds.", status=error.status,
+                       retry_after=error.retry_after)
+
+class ChatFlight:
+    """A chat turn in progress, awaited by duplicates of its request."""
+
+    def __init__(self, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.result = None
+        self.finished = False
+        self.expires_at = None      # set while a finished result is kept for retries
+        self._event = threading.Event()
+        self._waiters = []
+
+    def publish(self, result):
+        with self.lock:
+            self.result = result
+            self._event.set()
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+    async def wait(self):
+        """Wait for the leading copy to finish. None means it failed."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if self._event.is_set():
+                return self.result
+            self._waiters.append((loop, future))
+        await future
+        return self.result
+
+class ChatFlights:
+    """Chat turns in progress (and recently finished ones) by request key."""
+
+    def __init__(self, result_ttl):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.result_ttl = result_ttl
+
+    @staticmethod
+    def make_key(session_id, user_message, request_key):
+        digest = hashlib.sha256(user_message.encode("utf-8")).hexdigest()
+        return (session_id, digest, request_key or "")
+
+    def join(self, key):
+        """Return (flight, leader). The leader must answer the turn and call finish()."""
+        now = time.monotonic()
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and (flight.expires_at is None or flight.expires_at > now):
+                return flight, False
+            flight = self.flights[key] = ChatFlight(key)
+            return flight, True
+
+    def finish(self, flight, result):
+        """Hand the leader's result to the waiting copies. None (the leader failed) lets one of them retry."""
+        with self.lock:
+            if flight.finished:
+                return
+            flight.finished = True
+            now = time.monotonic()
+            # Only successful replies to keyed requests are replayed to later retries
+            if result is not None and result["status"] == 200 and not result["cancelled"] \
+                    and flight.key[2] and self.result_ttl > 0:
+                flight.expires_at = now + self.result_ttl
+            elif self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            for key, other in list(self.flights.items()):
+                if other.expires_at is not None and other.expires_at <= now:
+                    del self.flights[key]
+        flight.publish(result)
+
+chat_flights = ChatFlights(COALESCE_RESULT_TTL)
+
+async def join_chat_flight(timer, session_id, user_message, request_key):
+    """Lead the turn for this request, or wait for the copy already answering it.
+
+    Returns (flight, None) when the caller answers the turn, or (None, result)
+    with the result of the copy that did.
+    """
+    key = ChatFlights.make_key(session_id, user_message, request_key)
+    while True:
+        flight, leader = chat_flights.join(key)
+        if leader:
+            return flight, None
+        result = await flight.wait()
+        if result is not None:
+            COALESCED_REQUESTS.inc(route=timer.route)
+            timer.finish("coalesced")
+            return None, result
+
+# Database side of a chat turn, run on the DB thread pool
+def prepare_chat(session_id, user_message):
+    """Work out how to answer the user's message.
+
+    Returns (reply, None, None, None) when a built-in command or the reply cache
+    answered it, with both sides of the turn stored. Otherwise returns
+    (None, messages, source_name, model) ready for the LLM, and the caller stores
+    the message once it has a generation ticket, so a refused turn leaves no trace.
+    """
+    # Get current mode for this session
+    current_mode = get_session_mode(session_id)
+
+    command = match_command(user_message)
+    if command:
+        # Stored first: "del prev" counts the command among the entries it deletes
+        store_temp_memory(session_id, user_message, "User")
+        return handle_chat_command(session_id, user_message, current_mode, command), None, None, None
+
+    # System prompt, rolling summary, past turns and relevant memory, within budget
+    with timed("prompt_build"):
+        messages, source_name = build_messages(session_id, user_message, current_mode)
+    model = route_model(user_message, current_mode, messages)
+
+    cache_key = reply_cache_key(session_id, user_message, source_name, messages, model)
+    cached = reply_cache.get(cache_key) if cache_key else None
+    if cached:
+        timer = _request_timer.get()
+        if timer is not None:
+            timer.fields["cached"] = True
+        store_temp_memory(session_id, user_message, "User")
+        store_temp_memory(session_id, cached[0], cached[1])
+        return cached[0], None, None, None
+    return None, messages, source_name, model
+
+def finish_chat(session_id, user_message, messages, source_name, bot_reply, model=MODEL_NAME):
+    """Store the bot reply in temporary memory and cache it if allowed."""
+    store_temp_memory(session_id, bot_reply, source_name)
+    cache_key = reply_cache_key(session_id, user_message, source_name, messages, model)
+    if cache_key and not bot_reply.startswith("⚠️"):
+        reply_cache.put(cache_key, bot_reply, source_name, session_owner(session_id))
+
+def record_cancellation(session_id, source_name, partial, reason):
+    """Count a stopped turn and keep its partial reply, marked as cut short. Returns the stored text."""
+    GENERATIONS_CANCELLED.inc(reason=reason)
+    timer = _request_timer.get()
+    if timer is not None:
+        timer.fields["cancel_reason"] = reason
+    # A superseded reply would land after the newer message, so it is dropped
+    if not CANCEL_KEEP_PARTIAL or not partial or reason == "superseded":
+        return ""
+    reply = partial + CANCELLED_MARKER
+    store_temp_memory(session_id, reply, source_name)
+    return reply
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def chat_result_payload(result):
+    """JSON body and extra headers of the /chat response for a chat_result."""
+    payload, headers = {"reply": result["reply"]}, {}
+    if result["cancelled"]:
+        payload["cancelled"] = True
+    if result["retry_after"] is not None:
+        # Overloaded: a fast 429/503 telling the client when to try again
+        payload["retry_after"] = result["retry_after"]
+        headers["Retry-After"] = str(result["retry_after"])
+    return payload, headers
+
+# Last Server-Sent Event of a streamed reply
+def done_event(result):
+    payload = {"done": True, "source": result["source"]}
+    if result["cancelled"]:
+        payload["cancelled"] = True
+    return sse_event(payload)
+
+# ---------------------------------------------------------------------------
+# Async serving (ASGI). /chat and /chat_stream run on the event loop with
+# ollama.AsyncClient, so a generation in progress or waiting in the queue
+# holds no thread. Database work goes to a small thread pool, and every other
+# route is the Flask app running on its own threads, so cheap endpoints stay
+# responsive.
+# ---------------------------------------------------------------------------
+_db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+_async_client = None
+
+def _get_async_client():
+    """Create the async client on the running loop the first time."""
+    global _async_client
+    if _async_client is None:
+        _async_client = ollama.AsyncClient()
+    return _async_client
+
+async def run_db(fn, *args):
+    """Run a blocking database helper on the DB thread pool, keeping the caller's request timer."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, partial(context.run, fn, *args))
+
+# Retry logic for Ollama API, streaming the reply. The caller must hold a granted generation ticket.
+async def async_stream_ollama_response(messages, retries=3, model=MODEL_NAME):
+    """Yield reply chunks from Ollama as they are generated.
+
+    Retries only happen before the first chunk arrives; once text has reached
+    the client a failure ends the stream with an error chunk instead. Cancelling
+    the calling task closes the stream.
+    """
+    client = _get_async_client()
+    for attempt, attempt_model, delay in model_attempts(model, retries):
+        await asyncio.sleep(delay)
+        started = False
+        try:
+            call_started, first_token, final = time.perf_counter(), None, None
+            stream = await client.chat(model=attempt_model, messages=messages, keep_alive=keep_alive_for(attempt_model),
+                                       options={'num_ctx': CONTEXT_WINDOW}, stream=True)
+            try:
+                async for part in stream:
+                    chunk = part.get('message', {}).get('content', '')
+                    if chunk:
+                        if first_token is None:
+                            first_token = time.perf_counter() - call_started
+                        started = True
+                        yield chunk
+                    if part.get('done'):
+                        final = part
+            finally:
+                # Also on cancellation: closing the response stops Ollama generating
+                await stream.aclose()
+            ollama_breaker.record_success()
+            record_generation(final, time.perf_counter() - call_started, first_token, attempt_model)
+            if attempt_model in _missing_models:
+                mark_model_loaded(attempt_model)
+            return
+        except Exception as e:
+            if getattr(e, "status_code", None) == 404:
+                mark_model_missing(attempt_model)
+            ollama_breaker.record_failure()
+            record_llm_error("stream", attempt, retries, e, started)
+            if started:
+                yield f"\n⚠️ Error in AI response: {str(e)}"
+                return
+            if attempt == retries - 1:
+                yield f"⚠️ Error in AI response after {retries} attempts: {str(e)}"
+
+async def _read_json_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        data = {}
+    return data if isinstance(data, dict) else {}
+
+async def _send_response_start(send, status, content_type, extra_headers=None):
+    headers = [(b"content-type", content_type.encode())]
+    headers += [(name.lower().encode(), value.encode()) for name, value in (extra_headers or {}).items()]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+
+async def _send_json(send, payload, status=200, extra_headers=None):
+    await _send_response_start(send, status, "application/json", extra_headers)
+    await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+
+async def _watch_disconnect(receive, generation):
+    """Cancel the generation if the client disconnects before the reply is sent."""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            generation.cancel("disconnected")
+            return
+
+async def _send_chat_result(send, result, stream):
+    """Answer with a finished chat_result: JSON, or for /chat_stream one token and done."""
+    if not stream or result["status"] != 200:
+        payload, headers = chat_result_payload(result)
+        return await _send_json(send, payload, status=result["status"], extra_headers=headers)
+    await _send_response_start(send, 200, "text/event-stream", SSE_HEADERS)
+    await send({"type": "http.response.body", "body": sse_event({"token": result["reply"]}).encode(),
+                "more_body": True})
+    await send({"type": "http.response.body", "body": done_event(result).encode()})
+
+async def async_chat(scope, receive, send):
+    """ASGI handler for /chat and /chat_stream.
+
+    /chat answers with JSON {"reply": ...}. /chat_stream streams the reply token
+    by token as Server-Sent Events: each event carries {"token": "..."}; the last
+    one is {"done": true, "source": ...}, with "cancelled": true if the turn was
+    stopped. While the request waits for the model, {"queue_position": n} events
+    report its place in line. The full reply is written to temp_memory once
+    generation finishes.
+    """
+    stream = scope["path"] == "/chat_stream"
+    data = await _read_json_body(receive)
+    headers = dict(scope.get("headers", []))
+    user, error, status = authenticate_user(headers.get(b"x-user-id", b"").decode("latin-1"),
+                                            headers.get(b"x-proxy-secret", b"").decode("latin-1"))
+    if error:
+        return await _send_json(send, {'error': error}, status=status)
+    user_message = str(data.get("message", "")).strip()
+    session_id = session_key(user, data.get("session_id", "default"))  # Get session ID or use default
+    request_key = headers.get(b"idempotency-key", b"").decode("latin-1")
+
+    if not user_message:
+        return await _send_chat_result(send, chat_result("Please enter a message."), stream)
+
+    timer = RequestTimer(scope["path"], session_id)
+    flight, shared = await join_chat_flight(timer, session_id, user_message, request_key)
+    if flight is None:
+        return await _send_chat_result(send, shared, stream)
+
+    async def send_event(payload, more_body=True):
+        await send({"type": "http.response.body", "body": sse_event(payload).encode(), "more_body": more_body})
+
+    ticket = generation = watcher = result = None
+    outcome = "error"
+    source_name, reply_parts = None, []
+    try:
+        generation = active_generations.start(session_id)
+        watcher = asyncio.create_task(_watch_disconnect(receive, generation))
+
+        command_reply, messages, source_name, model = await run_db(prepare_chat, session_id, user_message)
+        if command_reply is not None:
+            outcome = "command"
+            result = chat_result(command_reply)
+            return await _send_chat_result(send, result, stream)
+
+        # Only turns that need the model take a place in the generation queue
+        try:
+            ticket = submit_generation(session_id)
+        except SchedulerOverloaded as e:
+            outcome = "overloaded"
+            result = overloaded_result(e)
+            return await _send_chat_result(send, result, stream)
+        await run_db(store_temp_memory, session_id, user_message, "User")
+
+        if stream:
+            await _send_response_start(send, 200, "text/event-stream", SSE_HEADERS)
+        # From here on a stop, a newer message or a disconnect cancels this task
+        generation.attach_task()
+        generation.check()
+        if stream:
+            # Tell the client where it stands until the model is free
+            while not await ticket.wait_async(1.0):
+                await send_event({"queue_position": generation_scheduler.position(ticket)})
+        else:
+            await ticket.wait_async()
+        record_stage("queue_wait", ticket.queue_seconds())
+
+        # /chat streams from Ollama too, so a stopped turn keeps what it has so far
+        async for chunk in async_stream_ollama_response(messages, model=model):
+            reply_parts.append(chunk)
+            if stream:
+                await send_event({"token": chunk})
+        active_generations.finish(generation)
+        release_generation(ticket)
+
+        # Store the complete bot reply in temporary memory
+        bot_reply = "".join(reply_parts) or "I couldn't generate a response."
+        await run_db(finish_chat, session_id, user_message, messages, source_name, bot_reply, model)
+        outcome = "reply"
+        result = chat_result(bot_reply, source_name)
+        chat_flights.finish(flight, result)
+        if stream:
+            await send({"type": "http.response.body", "body": done_event(result).encode()})
+        else:
+            await _send_chat_result(send, result, stream)
+    except (asyncio.CancelledError, GenerationCancelled):
+        if generation is None or not generation.cancelled:
+            raise  # the server is shutting down
+        current = asyncio.current_task()
+        if hasattr(current, "uncancel"):
+            current.uncancel()
+        active_generations.finish(generation)
+        if ticket is not None:
+            release_generation(ticket)
+        outcome = "cancelled"
+        bot_reply = await run_db(record_cancellation, session_id, source_name, "".join(reply_parts),
+                                 generation.reason)
+        result = chat_result(bot_reply, source_name, cancelled=True)
+        chat_flights.finish(flight, result)
+        if generation.reason != "disconnected":
+            if stream:
+                await send({"type": "http.response.body", "body": done_event(result).encode()})
+            else:
+                await _send_chat_result(send, result, stream)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        if generation is not None:
+            active_generations.finish(generation)
+        if ticket is not None:
+            release_generation(ticket)
+        chat_flights.finish(flight, result)
+        timer.finish(outcome)
+
+_flask_asgi = WSGIMiddleware(app, workers=WSGI_THREADS)
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point: async chat routes, everything else through Flask."""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                start_background_jobs()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                _maintenance_stop.set()
+                _db_executor.shutdown(wait=True)
+                close_shards()
+                close_db_pools()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in ("/chat", "/chat_stream"):
+        return await async_chat(scope, receive, send)
+    return await _flask_asgi(scope, receive, send)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Mikasa server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--debug", action="store_true", help="reload on code changes and log at debug level")
+    parser.add_argument("--maintain", action="store_true",
+                        help="run one retention and compaction pass, then exit (with the server stopped)")
+    # Bulk transfers write the chat databases directly, so run them while the server is stopped
+    parser.add_argument("--export-memory", metavar="FILE", help="write long-term memory as NDJSON ('-' = stdout), then exit")
+    parser.add_argument("--export-history", metavar="FILE", help="write chat history as NDJSON, then exit")
+    parser.add_argument("--import-memory", metavar="FILE", help="add memory entries from NDJSON ('-' = stdin), then exit")
+    parser.add_argument("--import-history", metavar="FILE", help="add chat messages from NDJSON, then exit")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    if args.maintain:
+        run_maintenance(offline=True)
+        raise SystemExit(0)
+
+    bulk_jobs = [(args.import_memory, "r", lambda f: import_memory(f, index=False)),
+                 (args.import_history, "r", import_history),
+                 (args.export_memory, "w", lambda f: f.writelines(export_memory())),
+                 (args.export_history, "w", lambda f: f.writelines(export_history()))]
+    if any(path for path, _, _ in bulk_jobs):
+        for path, mode, job in bulk_jobs:
+            if path:
+                started = time.perf_counter()
+                with open_ndjson(path, mode) as f:
+                    result = job(f)
+                if result is not None:
+                    # The memory index picks imported entries up when the server next starts
+                    print(f"{path}: imported {result[0]} rows, skipped {result[1]} lines "
+                          f"in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+        close_shards()
+        raise SystemExit(0)
+
+    import uvicorn
+    if args.debug:
+        # Reloading needs the app as an import string, so the worker process can import it afresh
+        uvicorn.run("Mikasa:asgi_app", host=args.host, port=args.port, reload=True, log_level="debug",
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    else:
+        uvicorn.run(asgi_app, host=args.host, port=args.port)
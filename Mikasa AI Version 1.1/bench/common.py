@@ -0,0 +1,83 @@
+"""Shared helpers for the benchmark scripts: latency summaries, reports and baselines."""
+import json
+import math
+import os
+import platform
+import statistics
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, min(len(ordered), math.ceil(pct / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def summarize(latencies, elapsed, errors=0):
+    """Throughput and latency percentiles for one operation. latencies are in seconds."""
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def print_table(title, results):
+    print(f"\n{title}")
+    print(f"{'operation':<36} {'count':>7} {'err':>5} {'ops/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for name, row in results.items():
+        print(f"{name:<36} {row['count']:>7} {row['errors']:>5} {row['throughput']:>10.1f} "
+              f"{row['p50_ms']:>10.2f} {row['p95_ms']:>10.2f} {row['p99_ms']:>10.2f}")
+
+
+def compare_with_baseline(name, results, config, tolerance, save=False):
+    """Print the change against bench/baselines/<name>.json and return the regressions.
+
+    An operation regresses when its p95 latency rises, or its throughput drops, by more
+    than `tolerance` (a fraction). With save=True the run becomes the new baseline.
+    """
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    regressions = []
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print(f"\nNote: baseline {path} was recorded with a different configuration:\n  {baseline.get('config')}")
+        print(f"\nAgainst baseline ({baseline.get('machine', 'unknown machine')}), tolerance {tolerance:.0%}:")
+        print(f"{'operation':<36} {'p95 ms':>22} {'ops/s':>22}")
+        for op, row in results.items():
+            old = baseline["results"].get(op)
+            if old is None:
+                print(f"{op:<36} {'(new)':>22}")
+                continue
+            p95_change = _change(old["p95_ms"], row["p95_ms"])
+            rate_change = _change(old["throughput"], row["throughput"])
+            regressed = p95_change > tolerance or rate_change < -tolerance
+            if regressed:
+                regressions.append(op)
+            print(f"{op:<36} {old['p95_ms']:>8.2f} -> {row['p95_ms']:>8.2f} {p95_change:>+4.0%}"
+                  f" {old['throughput']:>8.1f} -> {row['throughput']:>8.1f} {rate_change:>+4.0%}"
+                  f"{'  REGRESSED' if regressed else ''}")
+    else:
+        print(f"\nNo baseline at {path} yet; run with --save-baseline to record one.")
+
+    if save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"machine": f"{platform.node()} {platform.machine()} Python {platform.python_version()}",
+                       "config": config, "results": results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baseline to {path}")
+    return regressions
+
+
+def _change(old, new):
+    return (new - old) / old if old else 0.0
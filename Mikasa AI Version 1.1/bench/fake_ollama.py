@@ -0,0 +1,209 @@
+"""Stand-in for the Ollama HTTP API with a fixed, configurable speed.
+
+Answers /api/chat (streamed or not), /api/generate, /api/embed, /api/tags and
+/api/version the way Ollama does, including the eval_count / eval_duration /
+prompt_eval_duration statistics, so Mikasa can be load tested without a GPU and
+every run sees the same model speed:
+
+  --latency         seconds before any work starts (model lookup, scheduling)
+  --prefill-tps     prompt tokens processed per second
+  --tokens-per-sec  reply tokens generated per second
+  --reply-tokens    tokens in every reply
+  --parallel        requests served at once (OLLAMA_NUM_PARALLEL); the rest queue
+  --small-model     model name served --small-speedup times faster than the others
+
+Usage:
+    python bench/fake_ollama.py [--port 11434] [--latency 0.02] [--tokens-per-sec 40]
+    OLLAMA_HOST=http://127.0.0.1:11434 python Mikasa.py
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("sure", "here", "is", "a", "short", "answer", "about", "that", "topic", "with", "one",
+         "or", "two", "useful", "details", "and", "a", "tip", "you", "can", "try", "next")
+
+
+class FakeOllamaSettings:
+    def __init__(self, latency=0.02, prefill_tps=2000.0, tokens_per_sec=200.0, reply_tokens=40,
+                 parallel=1, small_model="llama3.2:1b", small_speedup=4.0, embed_dim=768):
+        self.latency = latency
+        self.prefill_tps = prefill_tps
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_tokens = reply_tokens
+        self.small_model = small_model
+        self.small_speedup = small_speedup
+        self.embed_dim = embed_dim
+        self.slots = threading.BoundedSemaphore(parallel)
+
+
+def estimate_tokens(text):
+    return max(1, len(re.findall(r"\w{1,4}|[^\w\s]", text)))
+
+
+def fake_embedding(text, dim):
+    """Deterministic unit vector from the words of text."""
+    vector = [0.0] * dim
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        vector[int.from_bytes(digest[:4], "little") % dim] += 1.0 if digest[4] & 1 else -1.0
+    norm = sum(value * value for value in vector) ** 0.5 or 1.0
+    return [value / norm for value in vector]
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, like the real server
+    settings = FakeOllamaSettings()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return {}
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, payload):
+        data = json.dumps(payload).encode() + b"\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json({"models": [{"name": "fake:latest", "model": "fake:latest", "size": 0}]})
+        elif self.path == "/api/version":
+            self._send_json({"version": "0.0.0-fake"})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = self._read_json()
+        if self.path == "/api/chat":
+            prompt = "".join(str(message.get("content", "")) for message in body.get("messages", []))
+            self._generate(body, prompt, chat=True)
+        elif self.path == "/api/generate":
+            self._generate(body, str(body.get("prompt", "")), chat=False)
+        elif self.path in ("/api/embed", "/api/embeddings"):
+            texts = body.get("input", body.get("prompt", ""))
+            texts = [texts] if isinstance(texts, str) else list(texts)
+            embeddings = [fake_embedding(text, self.settings.embed_dim) for text in texts]
+            if self.path == "/api/embed":
+                self._send_json({"model": body.get("model", ""), "embeddings": embeddings})
+            else:
+                self._send_json({"embedding": embeddings[0]})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _generate(self, body, prompt, chat):
+        settings = self.settings
+        model = body.get("model", "fake")
+        stream = body.get("stream", True)
+        options = body.get("options") or {}
+        reply_tokens = min(settings.reply_tokens, options.get("num_predict") or settings.reply_tokens)
+        if not prompt and not chat:  # a load-only request, as used for warm-up
+            reply_tokens = 0
+        prompt_tokens = estimate_tokens(prompt)
+
+        speedup = settings.small_speedup if model == settings.small_model else 1.0
+
+        with settings.slots:
+            started = time.perf_counter()
+            time.sleep(settings.latency / speedup)
+            prefill = prompt_tokens / (settings.prefill_tps * speedup)
+            time.sleep(prefill)
+            token_time = 1.0 / (settings.tokens_per_sec * speedup)
+            tokens = [WORDS[i % len(WORDS)] + " " for i in range(reply_tokens)]
+
+            def message(text, done, **stats):
+                payload = {"model": model, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                           "done": done, **stats}
+                if chat:
+                    payload["message"] = {"role": "assistant", "content": text}
+                else:
+                    payload["response"] = text
+                return payload
+
+            def final_stats():
+                total = time.perf_counter() - started
+                return {"done_reason": "stop", "total_duration": int(total * 1e9),
+                        "load_duration": int(settings.latency / speedup * 1e9), "prompt_eval_count": prompt_tokens,
+                        "prompt_eval_duration": int(prefill * 1e9), "eval_count": reply_tokens,
+                        "eval_duration": int(reply_tokens * token_time * 1e9)}
+
+            if not stream:
+                time.sleep(reply_tokens * token_time)
+                return self._send_json(message("".join(tokens).strip(), True, **final_stats()))
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for token in tokens:
+                    time.sleep(token_time)
+                    self._send_chunk(message(token, False))
+                self._send_chunk(message("", True, **final_stats()))
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the client stopped reading; a real server would stop generating too
+
+
+def start_fake_ollama(host="127.0.0.1", port=0, **settings):
+    """Serve the fake API on a background thread. Returns (server, base_url)."""
+    handler = type("ConfiguredFakeOllamaHandler", (FakeOllamaHandler,),
+                   {"settings": FakeOllamaSettings(**settings)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-ollama", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_speed_arguments(parser):
+    """Command-line flags for FakeOllamaSettings, shared with the load generator."""
+    # Defaults are a fast model so a run takes about a minute; use --tokens-per-sec 40 for a 7B on a GPU
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds before work starts")
+    parser.add_argument("--prefill-tps", type=float, default=2000.0, help="prompt tokens per second")
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0, help="reply tokens per second")
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--parallel", type=int, default=1, help="requests served at once")
+    parser.add_argument("--small-model", default="llama3.2:1b", help="model that runs --small-speedup times faster")
+    parser.add_argument("--small-speedup", type=float, default=4.0)
+
+
+def speed_settings(args):
+    return {"latency": args.latency, "prefill_tps": args.prefill_tps, "tokens_per_sec": args.tokens_per_sec,
+            "reply_tokens": args.reply_tokens, "parallel": args.parallel, "small_model": args.small_model,
+            "small_speedup": args.small_speedup}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    add_speed_arguments(parser)
+    args = parser.parse_args()
+
+    server, url = start_fake_ollama(args.host, args.port, **speed_settings(args))
+    print(f"Fake Ollama listening on {url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
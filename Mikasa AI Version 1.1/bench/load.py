@@ -0,0 +1,206 @@
+"""Drive a Mikasa server from concurrent sessions and report latency per endpoint.
+
+By default the script starts everything it needs: a fake Ollama server (see
+fake_ollama.py) and Mikasa itself, on free ports, with its databases in a
+temporary directory. Pass --url to load an already running server instead.
+
+Every session runs the same seeded mix of requests, so two runs with the same
+flags send the same traffic. With --users N the sessions are spread over N users
+(sent as X-User-Id, with the proxy secret the server is started with or that
+--proxy-secret gives), so their data lands on different storage shards:
+
+  chat               ordinary messages (/chat, answered by the model)
+  chat:memory        "remember that ..." and "search memory ..." commands (/chat)
+  get_chat_history   /get_chat_history
+  set_mode           /set_mode
+
+Usage:
+    python bench/load.py [--sessions 8] [--requests 25] [--users 1] [--latency 0.02] [--tokens-per-sec 200]
+    python bench/load.py --save-baseline        # record this run as the baseline
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from common import compare_with_baseline, print_table, summarize
+from fake_ollama import add_speed_arguments, speed_settings, start_fake_ollama
+
+MIKASA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Mikasa.py")
+
+QUESTIONS = [
+    "How do I read a file line by line in Python?",
+    "What's a good way to structure a Flask project?",
+    "Explain the difference between a process and a thread.",
+    "Give me three tips for writing faster SQL queries.",
+    "What should I cook tonight?",
+    "Summarize what we talked about so far.",
+    "thanks!",
+    "ok, sounds good",
+]
+FACTS = ["I like green tea", "my laptop runs Linux", "the project deadline is Friday", "I use SQLite a lot"]
+MIX = [("chat", 50), ("get_chat_history", 25), ("chat:memory", 15), ("set_mode", 10)]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Session:
+    """One simulated user with a keep-alive connection to the server."""
+
+    def __init__(self, url, index, seed, users=1, proxy_secret=""):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=300)
+        self.session_id = f"bench-{index}"
+        self.user = f"bench-user-{index % users}" if users > 1 else None
+        self.proxy_secret = proxy_secret
+        self.random = random.Random(seed * 1000 + index)
+
+    def request(self, method, path, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body else {}
+        if self.user:
+            headers["X-User-Id"] = self.user
+            headers["X-Proxy-Secret"] = self.proxy_secret
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            return 0
+
+    def step(self):
+        """Send one request from the mix. Returns (operation, status)."""
+        op = self.random.choices([name for name, _ in MIX], [weight for _, weight in MIX])[0]
+        if op == "chat":
+            message = self.random.choice(QUESTIONS)
+            status = self.request("POST", "/chat", {"message": message, "session_id": self.session_id})
+        elif op == "chat:memory":
+            if self.random.random() < 0.5:
+                message = f"remember that {self.random.choice(FACTS)} ({self.session_id})"
+            else:
+                message = f"search memory {self.random.choice(FACTS).split()[-1]}"
+            status = self.request("POST", "/chat", {"message": message, "session_id": self.session_id})
+        elif op == "get_chat_history":
+            status = self.request("GET", f"/get_chat_history?session_id={self.session_id}")
+        else:
+            mode = self.random.choice(["assistant", "mikasa"])
+            status = self.request("POST", "/set_mode", {"session_id": self.session_id, "mode": mode})
+        return op, status
+
+
+def run_load(url, sessions, requests, seed, users=1, proxy_secret=""):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(sessions)
+
+    def worker(index):
+        session = Session(url, index, seed, users, proxy_secret)
+        start_barrier.wait()
+        for _ in range(requests):
+            started = time.perf_counter()
+            op, status = session.step()
+            elapsed = time.perf_counter() - started
+            with lock:
+                if status == 200:
+                    latencies[op].append(elapsed)
+                else:
+                    errors[op] += 1
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(sessions)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    results = {op: summarize(latencies[op], elapsed, errors[op]) for op, _ in MIX}
+    results["all"] = summarize([value for values in latencies.values() for value in values], elapsed,
+                               sum(errors.values()))
+    return results
+
+
+def wait_until_ready(url, process, timeout=60):
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Mikasa exited with code {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            conn.request("GET", "/readyz")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Mikasa was not ready on {url} within {timeout} seconds")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="load this running server instead of starting one")
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent sessions")
+    parser.add_argument("--requests", type=int, default=25, help="requests per session")
+    parser.add_argument("--users", type=int, default=1, help="users the sessions are spread over")
+    parser.add_argument("--proxy-secret", default=os.environ.get("MIKASA_USER_HEADER_SECRET", ""),
+                        help="the --url server's MIKASA_USER_HEADER_SECRET, needed with --users")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed change before a regression")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on a regression")
+    add_speed_arguments(parser)
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    with tempfile.TemporaryDirectory(prefix="mikasa-bench-") as db_dir:
+        if url is None:
+            _, ollama_url = start_fake_ollama(**speed_settings(args))
+            port = free_port()
+            url = f"http://127.0.0.1:{port}"
+            log_path = os.path.join(db_dir, "server.log")
+            args.proxy_secret = args.proxy_secret or secrets.token_hex(16)
+            env = dict(os.environ, MIKASA_DB_DIR=db_dir, OLLAMA_HOST=ollama_url,
+                       MIKASA_USER_HEADER_SECRET=args.proxy_secret)
+            with open(log_path, "wb") as log:
+                process = subprocess.Popen([sys.executable, MIKASA_PATH, "--host", "127.0.0.1", "--port", str(port)],
+                                           env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_until_ready(url, process)
+            print(f"Loading {url} with {args.sessions} sessions x {args.requests} requests...")
+            results = run_load(url, args.sessions, args.requests, args.seed, args.users, args.proxy_secret)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+
+    print_table("Load test results", results)
+    config = {"sessions": args.sessions, "requests": args.requests, "seed": args.seed,
+              "server": "external" if args.url else "local", **speed_settings(args)}
+    if args.users > 1:  # keeps single-user runs comparable with older baselines
+        config["users"] = args.users
+    regressions = compare_with_baseline("load", results, config, args.tolerance, args.save_baseline)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Compare Ollama prefill time for the old single-prompt layout and the structured layout.
+
+Plays the same scripted conversation twice against a running Ollama server and reports
+prompt_eval_count / prompt_eval_duration for every turn:
+
+  legacy      one user message per turn, history and memory inside the template
+              (last 20 messages, so the prefix changes on every turn once it slides)
+  structured  stable system message + append-only turns, volatile context last
+
+Usage:
+    python bench/prompt_cache.py [--turns 24] [--model openchat:7b] [--host http://localhost:11434]
+"""
+import argparse
+import os
+import statistics
+import sys
+
+import ollama
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Mikasa  # noqa: E402
+
+USER_TURNS = [
+    "Give me a checklist for deploying a Flask app.",
+    "Which of those steps can be automated?",
+    "Write a bash one-liner to tail the gunicorn log.",
+    "How do I rotate that log daily?",
+    "What is a good SQLite busy timeout for a small web app?",
+    "Explain WAL mode in two sentences.",
+    "Remind me what we decided about logging.",
+    "List three ways to cut LLM latency.",
+]
+MEMORY = "Charan prefers Python.\nCharan deploys on a single Linux box.\nCharan likes short answers."
+
+
+def legacy_messages(history, user_message):
+    """The pre-structured layout: everything in one user message, inputs mid-template."""
+    head, execute = Mikasa.get_assistant_prompt().split("# 🚀 EXECUTE")
+    temp_memory = "\n".join(content for _, content in history[-20:])
+    prompt = (f"{head}# 📂 MEMORY  \n## Session: {temp_memory}  \n## Persistent: {MEMORY}  \n"
+              f"## Input: {user_message}\n\n# 🚀 EXECUTE{execute}")
+    return [{'role': 'user', 'content': prompt}]
+
+
+def structured_messages(history, user_message):
+    return Mikasa.assemble_messages(Mikasa.get_assistant_prompt(), "", history, user_message, MEMORY)
+
+
+def run(client, model, layout, turns):
+    history, stats = [], []
+    for turn in range(turns):
+        user_message = USER_TURNS[turn % len(USER_TURNS)]
+        history.append(("User", user_message))
+        messages = layout(history[:-1], user_message)
+        response = client.chat(model=model, messages=messages, keep_alive=Mikasa.OLLAMA_KEEP_ALIVE,
+                               options={'num_ctx': Mikasa.CONTEXT_WINDOW, 'num_predict': 64,
+                                        'temperature': 0, 'seed': 1})
+        history.append(("Assistant", response['message']['content']))
+        stats.append((response.get('prompt_eval_count') or 0, (response.get('prompt_eval_duration') or 0) / 1e6))
+        print(f"  {layout.__name__:<20} turn {turn + 1:>2}: {stats[-1][0]:>5} prompt tokens evaluated, "
+              f"{stats[-1][1]:>8.1f} ms prefill")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=24)
+    parser.add_argument("--model", default=Mikasa.MODEL_NAME)
+    parser.add_argument("--host", default=None)
+    args = parser.parse_args()
+
+    client = ollama.Client(host=args.host)
+    # Load the model first so the first measured turn doesn't include load time
+    client.generate(model=args.model, prompt="", keep_alive=Mikasa.OLLAMA_KEEP_ALIVE)
+
+    results = {}
+    for layout in (legacy_messages, structured_messages):
+        print(f"{layout.__name__}:")
+        results[layout.__name__] = run(client, args.model, layout, args.turns)
+
+    print("\nlayout               mean tokens   mean prefill ms   median prefill ms")
+    for name, stats in results.items():
+        tokens = [count for count, _ in stats[1:]]  # turn 1 has nothing cached either way
+        durations = [ms for _, ms in stats[1:]]
+        print(f"{name:<20} {statistics.mean(tokens):>11.0f} {statistics.mean(durations):>17.1f} "
+              f"{statistics.median(durations):>19.1f}")
+
+
+if __name__ == "__main__":
+    main()
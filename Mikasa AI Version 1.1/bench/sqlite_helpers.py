@@ -0,0 +1,127 @@
+"""Micro-benchmarks for Mikasa's SQLite helpers as the memory table grows.
+
+Seeds a scratch database to each size in --sizes (10k, 100k and 1M rows by default,
+growing the same database) and times the helpers a chat turn depends on. Memory rows
+are spread over 100 users, with "Player" (the default user) holding 1 in 100; all of
+them are seeded into the first shard, where "Player" lives.
+The chat history table gets the same number of rows over N/100 sessions. The
+session cache is cleared before every call, so reads measure the database path.
+
+Embeddings use the offline "hash" backend, so no Ollama server is needed.
+
+Usage:
+    python bench/sqlite_helpers.py [--sizes 10000,100000,1000000] [--iterations 200]
+    python bench/sqlite_helpers.py --save-baseline
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from common import compare_with_baseline, print_table, summarize
+
+VOCABULARY = ("tea coffee python sqlite flask linux window garden music movie anime book friday monday deadline "
+              "project laptop phone travel tokyo paris recipe pasta noodle ramen gym running sleep birthday gift "
+              "sister brother mother father office meeting invoice budget guitar piano game chess").split()
+USERS = 100
+ROWS_PER_SESSION = 100
+
+
+def sentence(rng, words=8):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def seed(Mikasa, start, stop, rng, batch=10000):
+    """Grow the memory and chat history tables to `stop` rows each."""
+    for low in range(start, stop, batch):
+        high = min(stop, low + batch)
+        memory_rows = [("Player" if i % USERS == 0 else f"user{i % USERS}", sentence(rng)) for i in range(low, high)]
+        history_rows = [(Mikasa.session_key("Player", f"session{i // ROWS_PER_SESSION}"), i, sentence(rng, 12),
+                         "User" if i % 2 else "Assistant") for i in range(low, high)]
+        with Mikasa.db_connection(Mikasa.DB_PATH) as conn:
+            conn.executemany("INSERT INTO memory (user, data) VALUES (?, ?)", memory_rows)
+        with Mikasa.db_connection(Mikasa.TEMP_DB_PATH) as conn:
+            conn.executemany("INSERT INTO temp_memory (session_id, timestamp, message, role) VALUES (?, ?, ?, ?)",
+                             history_rows)
+    # The history writer numbers new messages after the largest id it has seen
+    Mikasa.user_shard("Player").history_writer.next_id = None
+
+
+def time_calls(Mikasa, name, iterations, call):
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        Mikasa.session_cache.sessions.clear()
+        call_started = time.perf_counter()
+        call(i)
+        latencies.append(time.perf_counter() - call_started)
+    return name, summarize(latencies, time.perf_counter() - started)
+
+
+def run_size(Mikasa, size, iterations, rng):
+    sessions = max(1, size // ROWS_PER_SESSION)
+    run_id = f"{size}x{rng.randrange(1 << 30)}"
+    keywords = [rng.choice(VOCABULARY) for _ in range(iterations)]
+    session_ids = [Mikasa.session_key("Player", f"session{rng.randrange(sessions)}") for _ in range(iterations)]
+
+    benchmarks = [
+        ("store_memory", lambda i: Mikasa.store_memory("Player", f"bench note {run_id} {i} {keywords[i]}")),
+        ("search_memory", lambda i: Mikasa.search_memory("Player", keywords[i])),
+        ("update_memory", lambda i: Mikasa.update_memory("Player", f"bench note {run_id} {i}",
+                                                         f"bench note {run_id} {i} updated")),
+        ("remove_memory", lambda i: Mikasa.remove_memory("Player", f"bench note {run_id} {i} updated")),
+        ("retrieve_memory", lambda i: Mikasa.retrieve_memory("Player")),
+        ("retrieve_history_since", lambda i: Mikasa.retrieve_history_since(session_ids[i])),
+        ("get_session_mode", lambda i: Mikasa.get_session_mode(session_ids[i])),
+        ("set_session_mode", lambda i: Mikasa.set_session_mode(session_ids[i], ("assistant", "mikasa")[i % 2])),
+        ("store_temp_memory+flush", lambda i: (Mikasa.store_temp_memory(session_ids[i], sentence(rng), "User"),
+                                               Mikasa.session_shard(session_ids[i]).history_writer.flush())),
+    ]
+    results = {}
+    for name, call in benchmarks:
+        # retrieve_memory returns every row for the user, so fewer rounds on big tables
+        rounds = max(5, iterations // 20) if name == "retrieve_memory" and size >= 100000 else iterations
+        op, row = time_calls(Mikasa, name, rounds, call)
+        results[f"{size}/{op}"] = row
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated row counts, ascending")
+    parser.add_argument("--iterations", type=int, default=200, help="calls per helper and size")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed change before a regression")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on a regression")
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+
+    with tempfile.TemporaryDirectory(prefix="mikasa-sqlite-bench-") as db_dir:
+        os.environ["MIKASA_DB_DIR"] = db_dir
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import Mikasa
+        Mikasa.EMBED_BACKEND = "hash"
+
+        rng = random.Random(args.seed)
+        results, seeded = {}, 0
+        for size in sizes:
+            started = time.perf_counter()
+            seed(Mikasa, seeded, size, rng)
+            seeded = size
+            print(f"Seeded {size:,} rows per table in {time.perf_counter() - started:.1f} s, benchmarking...")
+            results.update(run_size(Mikasa, size, args.iterations, rng))
+        Mikasa.close_shards()
+        Mikasa.close_db_pools()
+
+    print_table("SQLite helper results", results)
+    config = {"sizes": sizes, "iterations": args.iterations, "seed": args.seed}
+    regressions = compare_with_baseline("sqlite_helpers", results, config, args.tolerance, args.save_baseline)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
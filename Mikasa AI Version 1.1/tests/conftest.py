@@ -0,0 +1,96 @@
+"""Shared setup for the tests: Mikasa is imported once, with its databases in a scratch directory.
+
+Embeddings use the offline "hash" backend and no test reaches Ollama. Each test
+gets its own user id, so tests never see each other's memories or sessions.
+"""
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+DB_DIR = tempfile.mkdtemp(prefix="mikasa-tests-")
+os.environ["MIKASA_DB_DIR"] = DB_DIR
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Mikasa  # noqa: E402
+
+Mikasa.EMBED_BACKEND = "hash"
+Mikasa.USER_HEADER_SECRET = "test-proxy-secret"
+
+
+@pytest.fixture(scope="session", autouse=True)
+def scratch_databases():
+    yield
+    Mikasa.close_shards()
+    Mikasa.close_db_pools()
+    shutil.rmtree(DB_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def user():
+    return f"u{uuid.uuid4().hex[:12]}"
+
+
+@pytest.fixture
+def session(user):
+    return Mikasa.session_key(user, "s")
+
+
+def proxy_headers(user):
+    """Headers the authenticating proxy sends for user."""
+    return {"X-User-Id": user, "X-Proxy-Secret": Mikasa.USER_HEADER_SECRET}
+
+
+async def asgi_request(path, body, user, headers=None, disconnect=None):
+    """POST a JSON body through asgi_app as user, via the proxy unless headers are given.
+
+    The client hangs up once the disconnect event is set. Returns (status, headers, body).
+    """
+    messages, sent = [], False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}
+        # The client stays connected until the handler is done, or until told to leave
+        await (disconnect or asyncio.Event()).wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    sent_headers = proxy_headers(user) if headers is None else headers
+    scope = {"type": "http", "method": "POST", "path": path,
+             "headers": [(name.lower().encode(), value.encode()) for name, value in sent_headers.items()]}
+    await Mikasa.asgi_app(scope, receive, send)
+    if not messages:
+        return None, {}, b""
+    start = messages[0]
+    return (start["status"], dict(start["headers"]),
+            b"".join(message.get("body", b"") for message in messages[1:]))
+
+
+def asgi_post(path, body, user, headers=None):
+    """asgi_request run to completion on its own event loop."""
+    return asyncio.run(asgi_request(path, body, user, headers))
+
+
+def store_turns(session, *turns):
+    """Store (role, message) turns in a session through the write-behind buffer."""
+    for role, message in turns:
+        assert Mikasa.store_temp_memory(session, message, role)
+
+
+def stored_rows(session):
+    """(id, role, message) rows of a session in its database, after writing out the buffer."""
+    shard = Mikasa.session_shard(session)
+    shard.history_writer.flush()
+    with sqlite3.connect(shard.chat_path) as conn:
+        return conn.execute("SELECT id, role, message FROM temp_memory WHERE session_id = ? ORDER BY id",
+                            (session,)).fetchall()
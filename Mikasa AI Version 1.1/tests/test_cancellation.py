@@ -0,0 +1,97 @@
+"""Stopping a reply: the stop route, a newer message in the session, and the client hanging up."""
+import asyncio
+import json
+
+import pytest
+
+import Mikasa
+from conftest import asgi_request, proxy_headers
+
+
+class StallingClient:
+    """Stands in for ollama.AsyncClient.
+
+    The first reply streams its tokens, then stalls until the turn is cancelled;
+    later replies are answered at once.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.calls = 0
+        self.streaming = asyncio.Event()
+
+    async def chat(self, model, messages, stream=False, **options):
+        self.calls += 1
+        stall = self.calls == 1
+
+        async def reply():
+            for token in self.tokens if stall else ["Fresh reply."]:
+                yield {"message": {"content": token}, "done": False}
+            if stall:
+                self.streaming.set()
+                await asyncio.Event().wait()
+            yield {"message": {"content": ""}, "done": True}
+        return reply()
+
+
+@pytest.fixture
+def run_with_client(monkeypatch):
+    """Run a coroutine function given a fresh StallingClient standing in for Ollama."""
+    monkeypatch.setattr(Mikasa, "ollama_breaker", Mikasa.CircuitBreaker(3, 60))
+
+    def run(test):
+        async def main():
+            client = StallingClient(["Half ", "a reply"])
+            monkeypatch.setattr(Mikasa, "_async_client", client)
+            return await test(client)
+        return asyncio.run(main())
+    return run
+
+
+def history(user):
+    return [(role, message) for _, role, message in Mikasa.retrieve_history_since(Mikasa.session_key(user, "s"))]
+
+
+def test_stop_keeps_the_partial_reply_and_frees_the_slot(user, run_with_client):
+    async def test(client):
+        chat = asyncio.create_task(asgi_request("/chat", {"message": "tell me a story", "session_id": "s"}, user))
+        await asyncio.wait_for(client.streaming.wait(), 5)
+        response = Mikasa.app.test_client().post("/stop_generation", json={"session_id": "s"}, headers=proxy_headers(user))
+        assert response.get_json() == {"stopped": True}
+        return await asyncio.wait_for(chat, 5)
+
+    status, _, body = run_with_client(test)
+    assert status == 200
+    assert json.loads(body) == {"reply": "Half a reply" + Mikasa.CANCELLED_MARKER, "cancelled": True}
+    assert history(user) == [("User", "tell me a story"), ("Assistant", "Half a reply" + Mikasa.CANCELLED_MARKER)]
+    assert Mikasa.generation_scheduler.free == Mikasa.LLM_CONCURRENCY
+    assert not Mikasa.active_generations.cancel(Mikasa.session_key(user, "s"))
+
+
+def test_a_newer_message_replaces_the_reply_in_progress(user, run_with_client):
+    async def test(client):
+        first = asyncio.create_task(asgi_request("/chat", {"message": "tell me a story", "session_id": "s"}, user))
+        await asyncio.wait_for(client.streaming.wait(), 5)
+        second = await asyncio.wait_for(asgi_request("/chat", {"message": "a short one", "session_id": "s"}, user), 5)
+        return await asyncio.wait_for(first, 5), second
+
+    (_, _, first), (_, _, second) = run_with_client(test)
+    assert json.loads(first)["cancelled"] and json.loads(second) == {"reply": "Fresh reply."}
+    # The superseded reply would land after the newer message, so it is not stored
+    assert history(user) == [("User", "tell me a story"), ("User", "a short one"), ("Assistant", "Fresh reply.")]
+    assert Mikasa.generation_scheduler.free == Mikasa.LLM_CONCURRENCY
+
+
+def test_a_client_hanging_up_stops_the_reply(user, run_with_client):
+    async def test(client):
+        disconnect = asyncio.Event()
+        chat = asyncio.create_task(asgi_request("/chat_stream", {"message": "tell me a story", "session_id": "s"},
+                                                user, disconnect=disconnect))
+        await asyncio.wait_for(client.streaming.wait(), 5)
+        disconnect.set()
+        return await asyncio.wait_for(chat, 5)
+
+    _, _, body = run_with_client(test)
+    assert b'"done"' not in body
+    assert history(user)[-1] == ("Assistant", "Half a reply" + Mikasa.CANCELLED_MARKER)
+    assert Mikasa.generation_scheduler.free == Mikasa.LLM_CONCURRENCY
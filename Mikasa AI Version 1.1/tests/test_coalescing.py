@@ -0,0 +1,87 @@
+"""Duplicate chat requests: concurrent copies share one turn, and keyed retries get its reply again."""
+import asyncio
+import json
+
+import pytest
+
+import Mikasa
+from conftest import asgi_request, proxy_headers
+
+
+class GatedClient:
+    """Stands in for ollama.AsyncClient, answering "Reply n" to call n once the gate opens."""
+
+    def __init__(self):
+        self.calls = 0
+        self.gate = asyncio.Event()
+
+    async def chat(self, model, messages, stream=False, **options):
+        self.calls += 1
+        number = self.calls
+
+        async def reply():
+            await self.gate.wait()
+            yield {"message": {"content": f"Reply {number}"}, "done": True}
+        return reply()
+
+
+@pytest.fixture
+def run_with_client(monkeypatch):
+    """Run a coroutine function given a fresh GatedClient standing in for Ollama."""
+    monkeypatch.setattr(Mikasa, "ollama_breaker", Mikasa.CircuitBreaker(3, 60))
+
+    def run(test):
+        async def main():
+            client = GatedClient()
+            monkeypatch.setattr(Mikasa, "_async_client", client)
+            return await test(client)
+        return asyncio.run(main())
+    return run
+
+
+def history(user):
+    return [(role, message) for _, role, message in Mikasa.retrieve_history_since(Mikasa.session_key(user, "s"))]
+
+
+def test_concurrent_copies_share_one_turn(user, run_with_client):
+    async def test(client):
+        body = {"message": "tell me a story", "session_id": "s"}
+        copies = [asyncio.create_task(asgi_request("/chat", body, user)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        client.gate.set()
+        return await asyncio.wait_for(asyncio.gather(*copies), 5), client.calls
+
+    responses, calls = run_with_client(test)
+    assert calls == 1
+    assert [(status, json.loads(body)) for status, _, body in responses] == [(200, {"reply": "Reply 1"})] * 3
+    assert history(user) == [("User", "tell me a story"), ("Assistant", "Reply 1")]
+
+
+def test_a_keyed_retry_gets_the_reply_again(user, run_with_client):
+    keyed = {**proxy_headers(user), "Idempotency-Key": "retry-1"}
+
+    async def test(client):
+        client.gate.set()
+        body = {"message": "tell me a story", "session_id": "s"}
+        first = await asgi_request("/chat", body, user, keyed)
+        retry = await asgi_request("/chat", body, user, keyed)
+        unkeyed = await asgi_request("/chat", body, user)
+        return first, retry, unkeyed, client.calls
+
+    first, retry, unkeyed, calls = run_with_client(test)
+    assert json.loads(first[2]) == json.loads(retry[2]) == {"reply": "Reply 1"}
+    # A request without the key is a new turn
+    assert json.loads(unkeyed[2]) == {"reply": "Reply 2"} and calls == 2
+    assert history(user) == [("User", "tell me a story"), ("Assistant", "Reply 1"),
+                             ("User", "tell me a story"), ("Assistant", "Reply 2")]
+
+
+def test_copies_in_other_sessions_are_not_shared(user, run_with_client):
+    async def test(client):
+        client.gate.set()
+        return await asyncio.gather(*(asgi_request("/chat", {"message": "hello", "session_id": session}, user)
+                                      for session in ("s", "t"))), client.calls
+
+    responses, calls = run_with_client(test)
+    assert calls == 2
+    assert sorted(json.loads(body)["reply"] for _, _, body in responses) == ["Reply 1", "Reply 2"]
@@ -0,0 +1,78 @@
+"""Built-in chat commands: what counts as one, and what each of them does."""
+import pytest
+
+import Mikasa
+from conftest import store_turns
+
+
+@pytest.mark.parametrize("message, command", [
+    ("Mikasa Mode", "mikasa mode"),
+    ("mikasa mode please", None),
+    ("del prev", "del prev"),
+    ("del prev\n", None),
+    ("what time is it", "time"),
+    ("Remember that I like tea", "remember"),
+    ("search memory tea", "search"),
+    ("can you search memory", None),
+    ("tell me a story", None),
+])
+def test_match_command_names_the_command(message, command):
+    assert Mikasa.match_command(message) == command
+
+
+@pytest.mark.parametrize("message", ["del prev\n", "mikasa mode please", "tell me a story"])
+def test_messages_that_are_not_commands_get_a_prompt(session, message):
+    reply, messages, _, _ = Mikasa.prepare_chat(session, message)
+    assert reply is None and messages[-1]["role"] == "user"
+
+
+def test_a_repeated_message_keeps_the_earlier_turn(session):
+    store_turns(session, ("User", "hello"), ("Assistant", "hi there"))
+    _, messages, _, _ = Mikasa.prepare_chat(session, "hello")
+    contents = [message["content"] for message in messages]
+    assert "hello" in contents and "hi there" in contents
+    assert contents[-1].startswith("hello")
+
+
+def command(session, message):
+    reply, messages, _, _ = Mikasa.prepare_chat(session, message)
+    assert messages is None
+    return reply
+
+
+def memories(user):
+    return [data for _, data in Mikasa.recent_memory(user, 100)][::-1]
+
+
+def test_remove_lists_several_matches_and_deletes_them_once_confirmed(session, user):
+    for data in ("green tea", "tea at noon", "my teacher is kind"):
+        assert Mikasa.store_memory(user, data)
+
+    reply = command(session, "remove that tea")
+    assert "remove that all tea" in reply and "green tea" in reply and "teacher" not in reply
+    assert memories(user) == ["green tea", "tea at noon", "my teacher is kind"]
+
+    reply = command(session, "remove that all tea")
+    assert "cleared 2 memories" in reply
+    assert memories(user) == ["my teacher is kind"]
+
+    # A single match is deleted straight away
+    assert "cleared 1 memories" in command(session, "remove that teacher")
+    assert memories(user) == []
+    assert "couldn't find" in command(session, "remove that teacher")
+
+
+def test_update_replaces_the_whole_word_match_only(session, user):
+    for data in ("my teacher is kind", "green tea"):
+        assert Mikasa.store_memory(user, data)
+
+    reply = command(session, "update that tea to black coffee")
+    assert "green tea → black coffee" in reply
+    assert memories(user) == ["my teacher is kind", "black coffee"]
+    assert "couldn't find" in command(session, "update that tea to milk")
+    assert "format" in command(session, "update that tea")
+
+    # Other users' memories are out of reach
+    other = Mikasa.session_key(user + "x", "s")
+    assert "couldn't find" in command(other, "remove that teacher")
+    assert memories(user) == ["my teacher is kind", "black coffee"]
@@ -0,0 +1,56 @@
+"""GET /history: paging by id in both directions, the epoch, and ids that are never reused."""
+import pytest
+
+import Mikasa
+from conftest import proxy_headers, store_turns, stored_rows
+
+
+@pytest.fixture
+def get_history(user):
+    client = Mikasa.app.test_client()
+
+    def get(**params):
+        response = client.get("/history", query_string={"session_id": "s", **params}, headers=proxy_headers(user))
+        assert response.status_code == 200
+        return response.get_json()
+    return get
+
+
+def test_pages_scroll_back_and_catch_up_by_id(session, get_history):
+    store_turns(session, *(("User", f"m{number}") for number in range(5)))
+    ids = [row[0] for row in stored_rows(session)]
+
+    latest = get_history(limit=2)
+    assert [message["message"] for message in latest["messages"]] == ["m3", "m4"]
+    assert latest["has_more"] and latest["latest_id"] == ids[-1]
+
+    older = get_history(limit=2, before=latest["messages"][0]["id"])
+    assert [message["message"] for message in older["messages"]] == ["m1", "m2"] and older["has_more"]
+    oldest = get_history(limit=2, before=older["messages"][0]["id"])
+    assert [message["message"] for message in oldest["messages"]] == ["m0"] and not oldest["has_more"]
+
+    newer = get_history(limit=3, since=ids[0])
+    assert [message["message"] for message in newer["messages"]] == ["m1", "m2", "m3"] and newer["has_more"]
+    assert get_history(since=ids[-1])["messages"] == []
+
+
+def test_deleting_messages_changes_the_epoch(session, get_history):
+    store_turns(session, ("User", "first"), ("Assistant", "reply one"), ("User", "second"), ("Assistant", "reply two"))
+    before = get_history()
+
+    Mikasa.prepare_chat(session, "del prev")
+    after = get_history()
+    assert after["epoch"] != before["epoch"]
+    assert [message["message"] for message in after["messages"]] == ["first", "reply one"]
+
+
+def test_ids_are_not_reused_after_deletes_and_a_restart(session, get_history):
+    store_turns(session, ("User", "first"), ("Assistant", "reply one"), ("User", "second"), ("Assistant", "reply two"))
+    latest_before = get_history()["latest_id"]
+    Mikasa.prepare_chat(session, "del prev")
+    latest_after = get_history()["latest_id"]
+
+    # A restarted server reserves its ids afresh from the database
+    Mikasa.session_shard(session).history_writer.next_id = None
+    store_turns(session, ("User", "third"))
+    assert stored_rows(session)[-1][0] > latest_before > latest_after
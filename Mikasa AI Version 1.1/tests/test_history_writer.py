@@ -0,0 +1,50 @@
+"""Write-behind batching of chat history: buffered rows are read back before they are written."""
+import pytest
+
+import Mikasa
+from conftest import store_turns, stored_rows
+
+
+@pytest.fixture
+def held_writer(session, monkeypatch):
+    """The session's history writer with flushing switched off, so new rows stay buffered."""
+    writer = Mikasa.session_shard(session).history_writer
+    writer.flush()
+    monkeypatch.setattr(writer, "flush", lambda: 0)
+    return writer
+
+
+def test_buffered_messages_are_read_back_before_they_are_written(session, held_writer):
+    store_turns(session, ("User", "hello"), ("Assistant", "hi"))
+    assert [row[2] for row in held_writer.pending_rows(session)] == ["hello", "hi"]
+
+    # From the session cache, and from the database plus the buffer once the cache is gone
+    for forget in (False, True):
+        if forget:
+            Mikasa.session_cache.forget(session)
+        rows = Mikasa.retrieve_history_since(session)
+        assert [(role, message) for _, role, message in rows] == [("User", "hello"), ("Assistant", "hi")]
+
+    page, has_more, latest_id, _ = Mikasa.retrieve_history_page(session)
+    assert [row[2] for row in page] == ["hello", "hi"] and not has_more
+    assert latest_id == rows[-1][0]
+
+
+def test_history_is_the_same_after_the_buffer_is_written(session, held_writer, monkeypatch):
+    store_turns(session, ("User", "one"), ("Assistant", "two"))
+    buffered = Mikasa.retrieve_history_since(session)
+    monkeypatch.undo()
+
+    assert stored_rows(session) == buffered
+    Mikasa.session_cache.forget(session)
+    assert Mikasa.retrieve_history_since(session) == buffered
+
+
+def test_ids_follow_insertion_order_across_sessions(user):
+    first, second = Mikasa.session_key(user, "a"), Mikasa.session_key(user, "b")
+    store_turns(first, ("User", "a1"))
+    store_turns(second, ("User", "b1"))
+    store_turns(first, ("User", "a2"))
+    a1, a2 = (row[0] for row in stored_rows(first))
+    (b1,) = (row[0] for row in stored_rows(second))
+    assert a1 < b1 < a2
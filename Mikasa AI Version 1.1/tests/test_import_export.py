@@ -0,0 +1,77 @@
+"""NDJSON export and import of memory and chat history, over HTTP and from files."""
+import json
+
+import pytest
+
+import Mikasa
+from conftest import proxy_headers, store_turns
+
+
+@pytest.fixture
+def client():
+    return Mikasa.app.test_client()
+
+
+def ndjson(text):
+    return [json.loads(line) for line in text.splitlines()]
+
+
+def without_ids(entries):
+    return [{key: value for key, value in entry.items() if key != "id"} for entry in entries]
+
+
+def wipe(user):
+    with Mikasa.db_connection(Mikasa.user_shard(user).memory_path) as conn:
+        conn.execute("DELETE FROM memory WHERE user = ?", (user,))
+    Mikasa.user_shard(user).memory_index.synced = False
+    assert Mikasa.delete_temp_memory(user=user)
+
+
+def test_export_then_import_gives_back_the_same_data(client, user):
+    for data in ("green tea", "naïve \"quotes\"\nand a newline"):
+        assert Mikasa.store_memory(user, data)
+    store_turns(Mikasa.session_key(user, "s"), ("User", "hello"), ("Assistant", "hi"))
+    store_turns(Mikasa.session_key(user, "t"), ("User", "another session"))
+    headers = proxy_headers(user)
+
+    memory = client.get("/export/memory", headers=headers).get_data(as_text=True)
+    history = client.get("/export/history", headers=headers).get_data(as_text=True)
+    assert [entry["data"] for entry in ndjson(memory)] == ["green tea", "naïve \"quotes\"\nand a newline"]
+    assert [(entry["session_id"], entry["message"]) for entry in ndjson(history)] == [
+        ("s", "hello"), ("s", "hi"), ("t", "another session")]
+
+    wipe(user)
+    assert client.get("/export/memory", headers=headers).get_data(as_text=True) == ""
+    assert client.post("/import/memory", data=memory, headers=headers).get_json() == {"imported": 2, "skipped": 0}
+    assert client.post("/import/history", data=history, headers=headers).get_json() == {"imported": 3, "skipped": 0}
+
+    assert without_ids(ndjson(client.get("/export/memory", headers=headers).get_data(as_text=True))) == \
+        without_ids(ndjson(memory))
+    assert without_ids(ndjson(client.get("/export/history", headers=headers).get_data(as_text=True))) == \
+        without_ids(ndjson(history))
+    # Imported rows are searchable and read as the sessions' turns
+    assert Mikasa.search_memory(user, "tea") and Mikasa.retrieve_history_since(Mikasa.session_key(user, "s"))
+
+
+def test_import_over_http_skips_other_users_and_bad_lines(client, user):
+    lines = "\n".join([json.dumps({"user": user, "data": "mine"}), json.dumps({"data": "also mine"}),
+                       json.dumps({"user": user + "x", "data": "someone else's"}), "not json",
+                       json.dumps({"user": user, "data": "  "})])
+    assert client.post("/import/memory", data=lines, headers=proxy_headers(user)).get_json() == {
+        "imported": 2, "skipped": 3}
+    assert sorted(data for _, data in Mikasa.recent_memory(user, 10)) == ["also mine", "mine"]
+    assert Mikasa.recent_memory(user + "x", 10) == []
+
+
+@pytest.mark.parametrize("name", ["history.ndjson", "history.ndjson.gz"])
+def test_files_round_trip_plain_and_compressed(tmp_path, user, name):
+    store_turns(Mikasa.session_key(user, "s"), ("User", "hello"), ("Assistant", "hi"))
+    path = str(tmp_path / name)
+    with Mikasa.open_ndjson(path, "w") as f:
+        f.writelines(Mikasa.export_history(user=user))
+
+    wipe(user)
+    with Mikasa.open_ndjson(path, "r") as f:
+        assert Mikasa.import_history(f) == (2, 0)
+    rows = Mikasa.retrieve_history_since(Mikasa.session_key(user, "s"))
+    assert [(role, message) for _, role, message in rows] == [("User", "hello"), ("Assistant", "hi")]
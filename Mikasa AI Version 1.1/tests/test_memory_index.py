@@ -0,0 +1,137 @@
+"""Memory vector index: its snapshot and change log on disk, sync(), and retrieval without embeddings."""
+import sqlite3
+import threading
+
+import numpy as np
+import pytest
+
+import Mikasa
+
+
+@pytest.fixture
+def memory_db(tmp_path):
+    """A memory table of a few entries, and a function making indexes over it that save to tmp_path."""
+    db_path = str(tmp_path / "memory.db")
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE memory (id INTEGER PRIMARY KEY, user TEXT, data TEXT)")
+        conn.executemany("INSERT INTO memory (user, data) VALUES (?, ?)",
+                         [("a", "green tea"), ("a", "black coffee"), ("b", "green apples")])
+
+    def open_index():
+        index = Mikasa.MemoryVectorIndex(str(tmp_path / "memory_index.npz"), db_path)
+        index.load()
+        return index
+    return db_path, open_index
+
+
+def contents(index):
+    """Memory id -> (user, digest, vector) for every row in use."""
+    return {int(index.ids[row]): (index.user_names[index.user_codes[row]], int(index.digests[row]),
+                                  index.vectors[row].tolist())
+            for row in range(index.size)}
+
+
+def test_changes_survive_a_restart_through_the_log(memory_db):
+    _, open_index = memory_db
+    index = open_index()
+    index.sync()
+    index.add([(4, "b", "red apples")])
+    index.remove([2])
+    index.log_file.close()
+
+    reloaded = open_index()
+    assert set(contents(reloaded)) == {1, 3, 4}
+    assert contents(reloaded) == contents(index)
+    assert reloaded.log_records == 5
+
+
+def test_a_record_cut_short_by_a_crash_is_dropped(memory_db):
+    _, open_index = memory_db
+    index = open_index()
+    index.sync()
+    index.log_file.close()
+    with open(index.log_path, "ab") as f:
+        f.write(Mikasa._VECTOR_LOG_RECORD.pack(Mikasa._VECTOR_LOG_ADD, 9, 0, 1, 64) + b"b" + b"\0" * 10)
+
+    reloaded = open_index()
+    assert contents(reloaded) == contents(index)
+
+    # Records written after the truncation are read back too
+    reloaded.remove([1])
+    reloaded.log_file.close()
+    assert set(contents(open_index())) == {2, 3}
+
+
+def test_the_log_of_an_interrupted_compaction_is_replayed_first(memory_db):
+    _, open_index = memory_db
+    index = open_index()
+    index.sync()
+    index.log_file.close()
+    # Crashed after rotating the log, before the snapshot was written; then a change was logged
+    Mikasa.os.replace(index.log_path, index.log_path + ".old")
+    index.log_file = None
+    index.remove([3])
+    index.log_file.close()
+
+    assert set(contents(open_index())) == {1, 2}
+
+
+def test_compaction_writes_a_snapshot_and_drops_the_logs(memory_db):
+    _, open_index = memory_db
+    index = open_index()
+    index.sync()
+    index.compact()
+    assert Mikasa.os.path.exists(index.path)
+    assert not Mikasa.os.path.exists(index.log_path) and not Mikasa.os.path.exists(index.log_path + ".old")
+
+    reloaded = open_index()
+    assert contents(reloaded) == contents(index) and reloaded.log_records == 0
+
+
+def test_a_log_that_outgrows_the_index_is_compacted(memory_db, monkeypatch):
+    _, open_index = memory_db
+    monkeypatch.setattr(Mikasa, "VECTOR_LOG_MIN_RECORDS", 5)
+    index = open_index()
+    index.sync()
+    compacted = threading.Event()
+    compact = index.compact
+    monkeypatch.setattr(index, "compact", lambda: (compact(), compacted.set()))
+
+    index.add([(memory_id, "a", f"entry {memory_id}") for memory_id in (4, 5)])
+    assert compacted.wait(5)
+    assert set(contents(open_index())) == {1, 2, 3, 4, 5}
+
+
+def test_sync_embeds_without_the_lock_and_keeps_changes_made_meanwhile(memory_db, monkeypatch):
+    db_path, open_index = memory_db
+    index = open_index()
+    embed = index._embed
+
+    def slow_embed(rows):
+        # Another thread can take the lock, and changes rows sync() has just read
+        other = threading.Thread(target=lambda: index.remove([1]))
+        other.start()
+        other.join(5)
+        assert not other.is_alive()
+        return embed(rows)
+    monkeypatch.setattr(index, "_embed", slow_embed)
+
+    index.sync()
+    assert set(contents(index)) == {2, 3} and 1 not in index.texts
+    assert index.touched is None and index.synced
+
+
+def test_relevant_memory_without_embeddings_is_bounded(user, monkeypatch):
+    for number in range(30):
+        assert Mikasa.store_memory(user, f"note {number} about cooking" if number % 10 == 0 else f"note {number}")
+
+    def unavailable(texts):
+        raise ConnectionError("embedding model unavailable")
+    monkeypatch.setattr(Mikasa, "embed_texts", unavailable)
+    Mikasa.user_shard(user).memory_index.synced = False
+
+    # Keyword matches first, else the newest entries; at most k of them
+    assert Mikasa.retrieve_relevant_memory(user, "what do I like cooking", k=5).splitlines() == [
+        "note 0 about cooking", "note 10 about cooking", "note 20 about cooking"]
+    assert Mikasa.retrieve_relevant_memory(user, "anything else", k=2).splitlines() == ["note 28", "note 29"]
+    assert len(Mikasa.retrieve_relevant_memory(user, "note", k=5, max_tokens=6).splitlines()) == 3
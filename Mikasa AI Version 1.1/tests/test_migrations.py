@@ -0,0 +1,92 @@
+"""Upgrading databases written by the original single-user version."""
+import sqlite3
+import time
+
+import pytest
+
+import Mikasa
+
+BASELINE_TIMESTAMP = "2024-03-01 12:30:00"
+
+
+@pytest.fixture
+def baseline_databases(tmp_path):
+    """memory.db and chat_memory.db as the first release created and filled them."""
+    memory_path, chat_path = str(tmp_path / "memory.db"), str(tmp_path / "chat_memory.db")
+    with sqlite3.connect(memory_path) as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS memory (user TEXT, data TEXT)")
+        conn.executemany("INSERT INTO memory (user, data) VALUES (?, ?)",
+                         [("Player", "I like green tea"), ("Player", "my teacher is kind")])
+    with sqlite3.connect(chat_path) as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS temp_memory (session_id TEXT, timestamp TEXT, message TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS session_mode (session_id TEXT PRIMARY KEY, mode TEXT DEFAULT 'assistant')")
+        conn.executemany("INSERT INTO temp_memory (session_id, timestamp, message) VALUES (?, ?, ?)",
+                         [("default", BASELINE_TIMESTAMP, "hello"), ("default", BASELINE_TIMESTAMP, "hi Charan"),
+                          (None, BASELINE_TIMESTAMP, "orphan")])
+        conn.execute("INSERT INTO session_mode (session_id, mode) VALUES ('default', 'mikasa')")
+    return memory_path, chat_path
+
+
+def migrate(path, migrations):
+    conn = Mikasa._open_db_connection(path)
+    try:
+        return Mikasa.migrate_db(conn, migrations)
+    finally:
+        conn.close()
+
+
+def test_chat_history_is_keyed_by_player_and_timestamped_in_microseconds(baseline_databases):
+    _, chat_path = baseline_databases
+    assert migrate(chat_path, Mikasa.CHAT_MIGRATIONS) == len(Mikasa.CHAT_MIGRATIONS)
+
+    with sqlite3.connect(chat_path) as conn:
+        rows = conn.execute("SELECT id, session_id, timestamp, message FROM temp_memory ORDER BY id").fetchall()
+        mode = conn.execute("SELECT session_id, mode FROM session_mode").fetchall()
+        counts = dict(conn.execute("SELECT name, count FROM row_counts").fetchall())
+        reserved = conn.execute("SELECT last_id FROM id_sequence WHERE name = 'temp_memory'").fetchone()[0]
+
+    # Baseline timestamps are local time; they become UTC microseconds
+    expected = int(time.mktime(time.strptime(BASELINE_TIMESTAMP, "%Y-%m-%d %H:%M:%S"))) * 1000000
+    assert rows == [(1, "Player/default", expected, "hello"), (2, "Player/default", expected, "hi Charan"),
+                    (3, "Player/default", expected, "orphan")]
+    assert mode == [("Player/default", "mikasa")]
+    assert counts == {"temp_memory": 3}
+    assert reserved == 3
+
+
+def test_memory_gets_ids_and_a_user_scoped_keyword_index(baseline_databases):
+    memory_path, _ = baseline_databases
+    assert migrate(memory_path, Mikasa.MEMORY_MIGRATIONS) == len(Mikasa.MEMORY_MIGRATIONS)
+
+    with sqlite3.connect(memory_path) as conn:
+        rows = conn.execute("SELECT id, user, data FROM memory ORDER BY id").fetchall()
+        counts = dict(conn.execute("SELECT name, count FROM row_counts").fetchall())
+
+        def match(query):
+            return [row[0] for row in conn.execute(
+                "SELECT rowid FROM memory_fts WHERE memory_fts MATCH ? ORDER BY rank", (query,))]
+
+        # The rebuild indexed the existing rows, user column included
+        assert match('{user} : "Player" AND {data} : ("tea")') == [1]
+        assert match('{user} : "Player" AND {data} : ("tea"*)') == [1, 2]
+        assert match('{user} : "someone" AND {data} : ("tea"*)') == []
+
+        # The triggers keep it current
+        conn.execute("INSERT INTO memory (user, data) VALUES ('Player', 'tea at noon')")
+        assert sorted(match('{data} : ("tea")')) == [1, 3]
+        conn.execute("DELETE FROM memory WHERE id = 1")
+        assert match('{data} : ("tea")') == [3]
+
+    assert rows == [(1, "Player", "I like green tea"), (2, "Player", "my teacher is kind")]
+    assert counts == {"memory": 2}
+
+
+def test_migrating_twice_changes_nothing(baseline_databases):
+    memory_path, chat_path = baseline_databases
+    for path, migrations in ((memory_path, Mikasa.MEMORY_MIGRATIONS), (chat_path, Mikasa.CHAT_MIGRATIONS)):
+        migrate(path, migrations)
+        with sqlite3.connect(path) as conn:
+            before = conn.execute("SELECT * FROM sqlite_master ORDER BY name").fetchall()
+        assert migrate(path, migrations) == len(migrations)
+        with sqlite3.connect(path) as conn:
+            assert conn.execute("SELECT * FROM sqlite_master ORDER BY name").fetchall() == before
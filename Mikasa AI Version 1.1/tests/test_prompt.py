@@ -0,0 +1,56 @@
+"""Prompt assembly: the history window, and the summary that takes over the turns it leaves."""
+import pytest
+
+import Mikasa
+from conftest import store_turns, stored_rows
+
+
+def turn(number, tokens=200):
+    return f"TURN{number} " + "word " * (tokens - 1)
+
+
+@pytest.fixture
+def refreshes(monkeypatch):
+    """Summary refreshes build_messages asks for, as (session_id, before_id), without running them."""
+    calls = []
+    monkeypatch.setattr(Mikasa, "schedule_summary_refresh", lambda session_id, before_id: calls.append((session_id, before_id)))
+    return calls
+
+
+def prompt_turns(messages):
+    return [message["content"].split()[0] for message in messages[1:-1] if message["content"].startswith("TURN")]
+
+
+def test_turns_left_behind_by_the_window_are_summarized(session, refreshes):
+    store_turns(session, *(("User", turn(number)) for number in range(9)))
+    ids = [row[0] for row in stored_rows(session)]
+
+    messages, _ = Mikasa.build_messages(session, "next")
+    assert prompt_turns(messages) == ["TURN6", "TURN7", "TURN8"]
+    assert refreshes == [(session, ids[6])]
+
+    # Once the summary covers them the window starts where it left off
+    Mikasa.session_cache.set(session, "summary", ("the first six turns", ids[5]))
+    refreshes.clear()
+    messages, _ = Mikasa.build_messages(session, "next")
+    assert prompt_turns(messages) == ["TURN6", "TURN7", "TURN8"]
+    assert "the first six turns" in messages[1]["content"]
+    assert refreshes == []
+
+
+def test_window_start_stays_put_until_the_budget_is_exceeded_again(session, refreshes):
+    store_turns(session, *(("User", turn(number)) for number in range(9)))
+    Mikasa.build_messages(session, "next")
+    store_turns(session, ("User", turn(9)))
+
+    messages, _ = Mikasa.build_messages(session, "next")
+    assert prompt_turns(messages) == ["TURN6", "TURN7", "TURN8", "TURN9"]
+
+
+def test_window_start_is_forgotten_with_the_session(session, refreshes):
+    store_turns(session, *(("User", turn(number)) for number in range(9)))
+    Mikasa.build_messages(session, "next")
+    assert Mikasa.session_cache.get(session, "anchor")
+
+    Mikasa.session_cache.forget(session)
+    assert Mikasa.session_cache.get(session, "anchor") == 0
@@ -0,0 +1,58 @@
+"""Reply cache: repeated messages reuse a reply until the user's memory changes."""
+import pytest
+
+import Mikasa
+
+
+@pytest.fixture(autouse=True)
+def reply_cache(monkeypatch):
+    monkeypatch.setattr(Mikasa, "REPLY_CACHE_ENABLED", True)
+    monkeypatch.setattr(Mikasa, "reply_cache", Mikasa.ReplyCache(64, 3600, persist=False))
+    return Mikasa.reply_cache
+
+
+def answer(session, message, reply):
+    """Run a turn the model answers with reply, as async_chat does. Returns what prepare_chat gave."""
+    cached, messages, source_name, model = Mikasa.prepare_chat(session, message)
+    if cached is None:
+        Mikasa.store_temp_memory(session, message, "User")
+        Mikasa.finish_chat(session, message, messages, source_name, reply, model)
+    return cached
+
+
+def cached_users(cache):
+    return {entry[3] for entry in cache.entries.values()}
+
+
+def test_a_repeated_message_is_answered_from_the_cache(session):
+    assert answer(session, "How do I boil an egg?", "Ten minutes.") is None
+    assert answer(session, "how do i boil an egg", "never asked") == "Ten minutes."
+    # Both turns are in the history
+    assert [message for _, _, message in Mikasa.retrieve_history_since(session)][-2:] == [
+        "how do i boil an egg", "Ten minutes."]
+
+
+def test_changing_memory_drops_only_that_users_replies(session, user, reply_cache):
+    other = Mikasa.session_key(user + "x", "s")
+    answer(session, "how do I boil an egg", "Ten minutes.")
+    answer(other, "how do I boil an egg", "Eight minutes.")
+    assert cached_users(reply_cache) == {user, user + "x"}
+
+    for change in (lambda: Mikasa.store_memory(user, "I like soft eggs"),
+                   lambda: Mikasa.update_memory(user, "soft", "I like hard eggs"),
+                   lambda: Mikasa.remove_memory(user, "hard")):
+        assert change()
+        assert cached_users(reply_cache) == {user + "x"}
+        assert answer(session, "how do I boil an egg", "Ten minutes.") is None
+
+    assert answer(other, "how do I boil an egg", "never asked") == "Eight minutes."
+
+
+def test_mikasa_mode_and_warnings_are_not_cached(session, reply_cache):
+    answer(session, "what should I cook", "⚠️ Error generating a response.")
+    assert answer(session, "what should I cook", "Pasta.") is None
+
+    Mikasa.set_session_mode(session, "mikasa")
+    answer(session, "say something nice", "You did well today.")
+    assert answer(session, "say something nice", "again") is None
+    assert len(reply_cache.entries) == 1
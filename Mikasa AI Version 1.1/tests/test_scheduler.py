@@ -0,0 +1,146 @@
+"""Generation queue: round-robin fairness, bounded waiting and the 429 it answers with."""
+import json
+
+import pytest
+
+import Mikasa
+from conftest import asgi_post
+
+
+def test_sessions_take_turns_and_keep_their_own_order():
+    scheduler = Mikasa.FairScheduler(slots=1, max_waiting=10, max_per_session=5)
+    running = scheduler.submit("holder")
+    a1, a2, a3 = (scheduler.submit("a") for _ in range(3))
+    b1 = scheduler.submit("b")
+    c1 = scheduler.submit("c")
+    assert running.granted and not any(ticket.granted for ticket in (a1, a2, a3, b1, c1))
+    assert [scheduler.position(ticket) for ticket in (a1, b1, c1, a2, a3)] == [1, 2, 3, 4, 5]
+
+    served = []
+    while True:
+        scheduler.release(running)
+        granted = [ticket for ticket in (a1, a2, a3, b1, c1) if ticket.granted and ticket not in served]
+        if not granted:
+            break
+        assert len(granted) == 1
+        running = granted[0]
+        served.append(running)
+    assert served == [a1, b1, c1, a2, a3]
+    assert scheduler.free == 1 and scheduler.waiting == 0
+
+
+def test_full_queue_and_busy_session_are_refused_with_retry_after():
+    scheduler = Mikasa.FairScheduler(slots=1, max_waiting=3, max_per_session=2)
+    scheduler.submit("holder")
+    scheduler.submit("a")
+    scheduler.submit("a")
+    with pytest.raises(Mikasa.SchedulerOverloaded) as busy_session:
+        scheduler.submit("a")
+    assert busy_session.value.status == 429 and busy_session.value.retry_after >= 1
+
+    scheduler.submit("b")
+    with pytest.raises(Mikasa.SchedulerOverloaded) as full:
+        scheduler.submit("c")
+    assert full.value.status == 429 and full.value.retry_after >= 1
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    scheduler = Mikasa.FairScheduler(slots=1, max_waiting=1, max_per_session=1)
+    running = scheduler.submit("holder")
+    waiting = scheduler.submit("a")
+    scheduler.release(waiting)
+    scheduler.submit("b")  # the freed place can be taken again
+    scheduler.release(running)
+    assert not waiting.granted
+
+
+@pytest.fixture
+def full_generation_queue():
+    """Fill every slot and waiting place of the server's scheduler."""
+    scheduler = Mikasa.generation_scheduler
+    tickets = [scheduler.submit(f"filler/{number}") for number in range(Mikasa.LLM_CONCURRENCY + Mikasa.QUEUE_MAX_WAITING)]
+    yield
+    for ticket in reversed(tickets):
+        scheduler.release(ticket)
+
+
+def test_chat_over_a_full_queue_gets_429_and_stores_nothing(user, full_generation_queue):
+    status, headers, body = asgi_post("/chat", {"message": "tell me a story", "session_id": "s"}, user)
+
+    assert status == 429
+    assert int(headers[b"retry-after"]) >= 1
+    assert json.loads(body)["retry_after"] >= 1
+    assert Mikasa.retrieve_history_since(Mikasa.session_key(user, "s")) == []
+
+
+def test_commands_are_answered_while_the_queue_is_full(user, full_generation_queue):
+    status, _, body = asgi_post("/chat", {"message": "what time is it", "session_id": "s"}, user)
+
+    assert status == 200
+    assert "time" in json.loads(body)["reply"]
+    roles = [role for _, role, _ in Mikasa.retrieve_history_since(Mikasa.session_key(user, "s"))]
+    assert roles == ["User", "Assistant"]
+
+
+def test_breaker_lets_one_trial_through_and_closes_when_it_succeeds():
+    breaker = Mikasa.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    trial = breaker.check()
+    assert trial is not None
+    with pytest.raises(Mikasa.SchedulerOverloaded) as refused:
+        breaker.check()
+    assert refused.value.status == 503
+
+    # A trial that never reached Ollama hands the turn to the next request
+    breaker.end_trial(trial)
+    breaker.check()
+    breaker.record_success()
+    assert breaker.check() is None and breaker.opened_at is None
+
+
+class FlakyClient:
+    """Stands in for ollama.AsyncClient, failing until told otherwise."""
+
+    def __init__(self):
+        self.failing = True
+
+    async def chat(self, model, messages, stream=False, **options):
+        if self.failing:
+            raise ConnectionError("connection refused")
+
+        async def reply():
+            yield {"message": {"content": "ok"}, "done": True}
+        return reply()
+
+
+def test_open_breaker_answers_503_until_a_trial_succeeds(user, monkeypatch):
+    client = FlakyClient()
+    breaker = Mikasa.CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    monkeypatch.setattr(Mikasa, "_async_client", client)
+    monkeypatch.setattr(Mikasa, "ollama_breaker", breaker)
+    monkeypatch.setattr(Mikasa, "RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(Mikasa, "RETRY_MAX_DELAY", 0)
+
+    def chat(message):
+        status, _, body = asgi_post("/chat", {"message": message, "session_id": "s"}, user)
+        return status, json.loads(body)
+
+    assert chat("first")[0] == 200
+    assert breaker.opened_at is not None
+    status, body = chat("while open")
+    assert status == 503 and body["retry_after"] >= 1
+
+    breaker.opened_at -= 60
+    assert chat("failing trial")[0] == 200
+    assert chat("reopened")[0] == 503
+
+    breaker.opened_at -= 60
+    client.failing = False
+    status, body = chat("trial")
+    assert status == 200 and body["reply"] == "ok"
+    assert breaker.opened_at is None and breaker.trial is None
+    assert chat("closed")[0] == 200
+
+    # Refused requests were not stored as turns
+    messages = [message for _, _, message in Mikasa.retrieve_history_since(Mikasa.session_key(user, "s"))]
+    assert "while open" not in messages and "reopened" not in messages
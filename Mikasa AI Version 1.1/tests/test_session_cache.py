@@ -0,0 +1,39 @@
+"""Per-session cache of mode, summary and recent turns: it never disagrees with the database."""
+import Mikasa
+from conftest import store_turns, stored_rows
+
+
+def test_mode_is_cached_and_written_through(session):
+    assert Mikasa.get_session_mode(session) == "assistant"
+    assert Mikasa.set_session_mode(session, "mikasa")
+    assert Mikasa.get_session_mode(session) == "mikasa"
+    Mikasa.session_cache.forget(session)
+    assert Mikasa.get_session_mode(session) == "mikasa"
+
+
+def test_del_prev_drops_the_last_exchange_from_cache_and_database(session):
+    store_turns(session, ("User", "first"), ("Assistant", "reply one"), ("User", "second"), ("Assistant", "reply two"))
+    Mikasa.retrieve_history_since(session)  # fill the cache
+
+    reply, *_ = Mikasa.prepare_chat(session, "del prev")
+    assert reply == ""
+
+    expected = [("User", "first"), ("Assistant", "reply one")]
+    assert [(role, message) for _, role, message in Mikasa.retrieve_history_since(session)] == expected
+    assert [(role, message) for _, role, message in stored_rows(session)] == expected
+
+
+def test_del_chat_empties_the_session_and_its_summary(session):
+    store_turns(session, ("User", "remember this"), ("Assistant", "ok"))
+    Mikasa.retrieve_history_since(session)
+    Mikasa.session_cache.set(session, "summary", ("an old summary", 1))
+
+    reply, *_ = Mikasa.prepare_chat(session, "del chat")
+    assert "wiped" in reply
+
+    assert Mikasa.retrieve_history_since(session) == []
+    assert stored_rows(session) == []
+    assert Mikasa.get_session_summary(session)[0] == ""
+
+    store_turns(session, ("User", "fresh start"))
+    assert [message for _, _, message in Mikasa.retrieve_history_since(session)] == ["fresh start"]
@@ -0,0 +1,109 @@
+"""Users: who a request acts for, and where their data is kept."""
+import json
+import sqlite3
+
+import pytest
+
+import Mikasa
+from conftest import asgi_post, proxy_headers
+
+
+@pytest.fixture
+def client():
+    return Mikasa.app.test_client()
+
+
+def search(client, headers):
+    return client.get("/search_memory", query_string={"q": "tea"}, headers=headers)
+
+
+def test_user_header_is_only_believed_with_the_proxy_secret(client, user):
+    assert Mikasa.store_memory(user, "green tea")
+
+    assert search(client, {"X-User-Id": user}).status_code == 403
+    assert search(client, {"X-User-Id": user, "X-Proxy-Secret": "guess"}).status_code == 403
+    response = search(client, proxy_headers(user))
+    assert response.status_code == 200 and "green tea" in json.dumps(response.get_json())
+
+    status, _, body = asgi_post("/chat", {"message": "search memory tea"}, user)
+    assert status == 200 and "green tea" in json.loads(body)["reply"]
+
+
+def test_requests_without_the_secret_are_refused_on_chat_too(user):
+    for headers in ({"X-User-Id": user}, {"X-User-Id": user, "X-Proxy-Secret": "guess"}, {}):
+        status, _, body = asgi_post("/chat", {"message": "search memory tea"}, user, headers)
+        assert status == 403 and "error" in json.loads(body)
+
+
+def test_users_only_see_their_own_memory(client, user):
+    assert Mikasa.store_memory(user, "green tea")
+    response = search(client, proxy_headers(user + "x"))
+    assert response.status_code == 200 and "green tea" not in json.dumps(response.get_json())
+
+
+def test_without_a_secret_every_request_is_the_default_user(client, user, monkeypatch):
+    monkeypatch.setattr(Mikasa, "USER_HEADER_SECRET", "")
+    assert search(client, {"X-User-Id": user}).status_code == 403
+    assert search(client, {}).status_code == 200
+    assert Mikasa.authenticate_user("", "") == (Mikasa.DEFAULT_USER, None, None)
+
+
+def test_probes_need_no_credentials(client):
+    assert client.get("/healthz").status_code == 200
+    assert client.get("/metrics").status_code == 200
+
+
+def users_on_different_shards(prefix):
+    """Two new user ids that hash to different shards."""
+    def shard(name):
+        return Mikasa.ShardRouter.hash_shard(name, Mikasa.DB_SHARDS)
+
+    first = f"{prefix}-0"
+    for number in range(1, 100):
+        second = f"{prefix}-{number}"
+        if shard(second) != shard(first):
+            return first, second
+    raise AssertionError("every id hashed to the same shard")
+
+
+def memory_in(path, user):
+    with sqlite3.connect(path) as conn:
+        return [data for data, in conn.execute("SELECT data FROM memory WHERE user = ?", (user,))]
+
+
+def test_new_users_are_placed_by_hash_and_keep_their_data_there(user):
+    first, second = users_on_different_shards(user)
+    for name in (first, second):
+        assert Mikasa.store_memory(name, f"{name} likes tea")
+        number = Mikasa.shard_router.shard_of(name)
+        assert number == Mikasa.ShardRouter.hash_shard(name, Mikasa.DB_SHARDS)
+        for shard in Mikasa.all_shards():
+            assert memory_in(shard.memory_path, name) == ([f"{name} likes tea"] if shard.number == number else [])
+        assert Mikasa.session_shard(Mikasa.session_key(name, "s")) is Mikasa.get_shard(number)
+
+
+def test_users_stay_put_when_the_shard_count_changes(user):
+    Mikasa.store_memory(user, "placed")
+    placed = Mikasa.shard_router.shard_of(user)
+
+    resized = Mikasa.ShardRouter(Mikasa.ROUTING_DB_PATH, Mikasa.DB_SHARDS + 5, 16)
+    assert resized.shard_of(user) == placed
+    newcomer = user + "-new"
+    assert resized.shard_of(newcomer) == Mikasa.ShardRouter.hash_shard(newcomer, Mikasa.DB_SHARDS + 5)
+
+
+def test_users_from_before_sharding_stay_on_the_first_shard(tmp_path, user):
+    with Mikasa.db_connection(Mikasa.get_shard(0).memory_path) as conn:
+        conn.execute("INSERT INTO memory (user, data) VALUES (?, 'from the first release')", (user,))
+    router = Mikasa.ShardRouter(str(tmp_path / "routing.db"), 1000, 16)
+    router.load()
+    assert router.shard_of(user) == 0 and router.shard_of(Mikasa.DEFAULT_USER) == 0
+
+
+def test_command_line_import_routes_rows_to_each_users_shard(user):
+    first, second = users_on_different_shards(user)
+    lines = [json.dumps({"user": name, "data": f"{name} imported"}) for name in (first, second, second)]
+    assert Mikasa.import_memory(lines, index=False) == (3, 0)
+    assert memory_in(Mikasa.user_shard(first).memory_path, first) == [f"{first} imported"]
+    assert memory_in(Mikasa.user_shard(second).memory_path, second) == [f"{second} imported"] * 2
+    assert memory_in(Mikasa.user_shard(first).memory_path, second) == []